@@ -0,0 +1,100 @@
+"""Benchmark cold start: module import time and time to the first email sent.
+
+Each measurement runs in a fresh interpreter. Time to first send runs
+order_fulfill.py against a small local orders sheet and a local SMTP sink,
+once with the pandas-free small-sheet path and once forcing pandas.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--orders N]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from smtp_sink import SMTPSink  # noqa: E402
+from generate_data import write_orders_csv  # noqa: E402
+
+IMPORT_SNIPPET = (
+    "import sys, time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start, 'pandas' in sys.modules)"
+)
+
+
+def measure_import(module, runs):
+    """Return the median import time in seconds and whether pandas was imported"""
+    times = []
+    loaded_pandas = False
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    # Importing a notifier opens its log file in the working directory, so keep that out of the repo
+    with tempfile.TemporaryDirectory() as work_dir:
+        for _ in range(runs):
+            out = subprocess.run(
+                [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+                cwd=work_dir, env=env, capture_output=True, text=True, check=True,
+            ).stdout.split()
+            times.append(float(out[0]))
+            loaded_pandas = out[1] == "True"
+    return statistics.median(times), loaded_pandas
+
+
+def measure_first_send(sink, orders_path, runs, extra_env):
+    """Return the median seconds from process start to the sink accepting the first email"""
+    env = dict(
+        os.environ,
+        ORDERS_SHEET_URL=str(orders_path),
+        EMAIL_SERVER=sink.address[0],
+        SMTP_PORT=str(sink.address[1]),
+        SMTP_STARTTLS="0",
+        EMAIL="bench@example.com",
+        PASSWORD="",
+        SMTP_RATE="100000",
+        SMTP_BURST="100000",
+        **extra_env,
+    )
+    env.pop("SHEET_CACHE_DIR", None)
+    env.pop("ORDERS_CHUNK_SIZE", None)
+    times = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as work_dir:
+            sink.reset()
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, str(REPO_DIR / "order_fulfill.py")],
+                cwd=work_dir, env=env, capture_output=True, check=True,
+            )
+            if sink.first_message_at is None:
+                raise RuntimeError("order_fulfill.py did not send any email")
+            times.append(sink.first_message_at - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=20)
+    args = parser.parse_args()
+
+    for module in ("pandas", "order_fulfill", "static_email_remainder"):
+        seconds, loaded_pandas = measure_import(module, args.runs)
+        note = "imports pandas" if loaded_pandas else "no pandas"
+        print(f"import {module:<24} {seconds * 1000:>8.1f} ms  ({note})")
+
+    with tempfile.TemporaryDirectory() as data_dir, SMTPSink() as sink:
+        orders_path = Path(data_dir) / "orders.csv"
+        write_orders_csv(orders_path, args.orders)
+        light = measure_first_send(sink, orders_path, args.runs, {})
+        full = measure_first_send(sink, orders_path, args.runs, {"SMALL_SHEET_BYTES": "0"})
+    print(f"first send, small-sheet path       {light * 1000:>8.1f} ms")
+    print(f"first send, pandas path            {full * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
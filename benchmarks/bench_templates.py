@@ -0,0 +1,67 @@
+"""Benchmark email rendering: compiled templates vs building an EmailMessage per send.
+
+Usage: python benchmarks/bench_templates.py [--messages N]
+"""
+import sys
+import time
+import argparse
+from email.message import EmailMessage
+from email.utils import formataddr
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from email_templates import EmailTemplate  # noqa: E402
+
+SUBJECT = "Order Confirmation #${order_id}"
+FROM_HEADER = formataddr(("Amazing Store", "store@example.com"))
+
+
+def make_rows(count):
+    return [
+        (
+            f"customer{i}@example.com",
+            {
+                'customer_name': f"Customer {i}",
+                'order_id': str(100000 + i),
+                'order_details': f"Product {i % 50} x {i % 5 + 1} - $19.99 each",
+                'total_amount': f"{(i % 5 + 1) * 19.99:.2f}",
+            },
+        )
+        for i in range(count)
+    ]
+
+
+def build_email_message(template, to_addr, fields):
+    """What the create_*_email builders did before templates: a new EmailMessage per send"""
+    msg = EmailMessage()
+    msg["Subject"] = template.subject.substitute(fields)
+    msg["From"] = FROM_HEADER
+    msg["To"] = to_addr
+    msg.set_content(template.plain.substitute(fields))
+    msg.add_alternative(template.html.substitute(fields), subtype="html")
+    return msg.as_bytes()
+
+
+def measure(label, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {count / elapsed:>12,.0f} messages/s  ({elapsed:.3f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    template = EmailTemplate.load("order_confirmation", SUBJECT, FROM_HEADER)
+    rows = make_rows(args.messages)
+
+    measure("EmailMessage per send", len(rows), lambda: [build_email_message(template, to, f) for to, f in rows])
+    measure("EmailTemplate.render", len(rows), lambda: [template.render(to, f) for to, f in rows])
+    measure("EmailTemplate.render_batch", len(rows), lambda: template.render_batch(rows))
+
+
+if __name__ == "__main__":
+    main()
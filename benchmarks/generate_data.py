@@ -0,0 +1,153 @@
+"""Generate order and event sheets of any size for the benchmarks.
+
+Sizes accept a k or M suffix, e.g. 1k, 100k, 1M.
+
+Usage: python benchmarks/generate_data.py [--orders 1k,100k] [--events 1k] [--out DIR] [--seed N]
+           [--max-lines N]
+"""
+import io
+import csv
+import random
+import argparse
+import datetime
+from pathlib import Path
+
+ORDER_COLUMNS = [
+    'order_id', 'customer_email', 'customer_name', 'product_name', 'quantity', 'unit_price',
+    'status', 'order_date', 'ship_date', 'delivery_date', 'shipping_carrier', 'tracking_number',
+]
+EVENT_COLUMNS = ['Date', 'Time', 'Details', 'Reminder Before (minutes)']
+
+# Status mix of a typical day's sheet; processing and cancelled orders get no email
+STATUS_WEIGHTS = {'new': 35, 'shipped': 30, 'delivered': 25, 'processing': 5, 'cancelled': 5}
+PRODUCTS = [
+    ("Wireless Mouse", 24.99), ("USB-C Cable", 9.99), ("Laptop Stand", 39.50),
+    ("Mechanical Keyboard", 89.00), ("Webcam", 54.25), ("Desk Lamp", 32.00),
+    ("Noise Cancelling Headphones", 199.99), ("Monitor 27in", 249.00),
+]
+CARRIERS = ["UPS", "FedEx", "USPS", "DHL"]
+FIRST_NAMES = ["Alice", "Bob", "Carmen", "Deepak", "Elena", "Farid", "Grace", "Hiro", "Ines", "José"]
+LAST_NAMES = ["Smith", "Garcia", "Chen", "Okafor", "Müller", "Rossi", "Kim", "Novak"]
+EVENT_TOPICS = ["Team standup", "Client call", "Design review", "1:1", "Sprint planning", "Lunch & learn"]
+REMINDER_MINUTES = [5, 10, 15, 30, 60]
+
+
+def parse_size(text):
+    """Parse a row count such as 500, 1k or 1M"""
+    text = text.strip()
+    multiplier = {'k': 1000, 'm': 1000000}.get(text[-1:].lower(), 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+
+def order_rows(count, seed=0, today=None, max_lines=1):
+    """Yield ``count`` order rows with a realistic mix of statuses, dates and repeat customers.
+
+    Orders have between 1 and ``max_lines`` product lines, one row each.
+    """
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    statuses = list(STATUS_WEIGHTS)
+    weights = list(STATUS_WEIGHTS.values())
+    customers = max(1, count // 3)
+    i = 0
+    order_id = 100000
+    while i < count:
+        customer = rng.randrange(customers)
+        status = rng.choices(statuses, weights)[0]
+        order_date = today - datetime.timedelta(days=rng.randint(0, 30))
+        ship_date = delivery_date = tracking_number = ""
+        if status in ('shipped', 'delivered'):
+            shipped = order_date + datetime.timedelta(days=rng.randint(1, 3))
+            ship_date = shipped.isoformat()
+            delivery_date = (shipped + datetime.timedelta(days=rng.randint(2, 5))).isoformat()
+            if rng.random() < 0.7:
+                tracking_number = f"1Z{rng.randrange(10**10):010d}"
+        carrier = rng.choice(CARRIERS)
+        for _ in range(min(rng.randint(1, max_lines), count - i)):
+            product, price = rng.choice(PRODUCTS)
+            yield [
+                order_id,
+                f"customer{customer}@example.com",
+                f"{FIRST_NAMES[customer % len(FIRST_NAMES)]} {LAST_NAMES[customer % len(LAST_NAMES)]}",
+                product,
+                rng.choices([1, 2, 3, 4, 5], [60, 20, 10, 5, 5])[0],
+                f"{price:.2f}",
+                status,
+                order_date.isoformat(),
+                ship_date,
+                delivery_date,
+                carrier,
+                tracking_number,
+            ]
+            i += 1
+        order_id += 1
+
+
+def event_rows(count, first_reminder, window_seconds, seed=0, past_fraction=0.05):
+    """Yield ``count`` event rows whose reminders fall due within ``window_seconds``.
+
+    About ``past_fraction`` of the events have a reminder time before
+    ``first_reminder`` and are expected to be ignored.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        minutes = rng.choice(REMINDER_MINUTES)
+        offset = window_seconds * i / max(1, count)
+        if rng.random() < past_fraction:
+            offset = -rng.uniform(60, 3600)
+        reminder_time = first_reminder + datetime.timedelta(seconds=offset)
+        # The sheet only has whole seconds; round up so the reminder stays in the window
+        if reminder_time.microsecond:
+            reminder_time += datetime.timedelta(microseconds=1000000 - reminder_time.microsecond)
+        event_time = reminder_time + datetime.timedelta(minutes=minutes)
+        yield [
+            event_time.strftime("%m/%d/%Y"),
+            event_time.strftime("%I:%M:%S %p"),
+            f"{rng.choice(EVENT_TOPICS)} #{i}",
+            minutes,
+        ]
+
+
+def to_csv_bytes(columns, rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue().encode('utf-8')
+
+
+def write_orders_csv(path, count, seed=0, max_lines=1):
+    Path(path).write_bytes(to_csv_bytes(ORDER_COLUMNS, order_rows(count, seed, max_lines=max_lines)))
+
+
+def write_events_csv(path, count, first_reminder=None, window_seconds=3600, seed=0):
+    if first_reminder is None:
+        first_reminder = datetime.datetime.now() + datetime.timedelta(minutes=5)
+    Path(path).write_bytes(to_csv_bytes(EVENT_COLUMNS, event_rows(count, first_reminder, window_seconds, seed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", default="1k,100k,1M", help="comma separated order sheet sizes")
+    parser.add_argument("--events", default="1k,100k", help="comma separated event sheet sizes")
+    parser.add_argument("--out", default="benchmarks/data", help="output directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-lines", type=int, default=1, help="most product lines per order (default: %(default)s)")
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    for size in filter(None, args.orders.split(",")):
+        path = out / f"orders_{size.strip()}.csv"
+        write_orders_csv(path, parse_size(size), args.seed, args.max_lines)
+        print(f"Wrote {path}")
+    for size in filter(None, args.events.split(",")):
+        path = out / f"events_{size.strip()}.csv"
+        write_events_csv(path, parse_size(size), seed=args.seed)
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
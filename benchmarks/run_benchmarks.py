@@ -0,0 +1,317 @@
+"""Run the order and reminder pipelines against generated sheets and a local SMTP sink.
+
+For every sheet size each stage (fetch, parse, plan, render, send) reports
+messages per second, p50/p99 per-message latency and peak RSS. Everything
+runs offline. Results can be written as JSON and compared with a baseline,
+exiting with status 1 on a regression, so the run can gate a deploy.
+
+Usage: python benchmarks/run_benchmarks.py [--orders 1k,100k] [--events 1k]
+           [--rtt SECONDS] [--latency SECONDS] [--error-rate FRACTION]
+           [--no-pipelining] [--json FILE]
+           [--baseline FILE] [--max-regression FRACTION]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+import contextlib
+import logging
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+from smtp_sink import SMTPSink  # noqa: E402
+from generate_data import (  # noqa: E402
+    EVENT_COLUMNS, ORDER_COLUMNS, event_rows, order_rows, parse_size, to_csv_bytes,
+)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        # Not Linux: fall back to the high-water mark (kilobytes on Linux, bytes on macOS)
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RSSSampler:
+    """Track the peak RSS while a stage runs by sampling it on a background thread"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TimedSender:
+    """Wrap a started SMTPSender to record each message's submit-to-accepted latency"""
+
+    def __init__(self, sender):
+        self._sender = sender
+        self.latencies = []
+
+    def __getattr__(self, name):
+        return getattr(self._sender, name)
+
+    def submit(self, msg):
+        start = time.perf_counter()
+        future = self._sender.submit(msg)
+        future.add_done_callback(
+            lambda f: f.exception() is None and self.latencies.append(time.perf_counter() - start)
+        )
+        return future
+
+
+def run_stage(results, scenario, stage, rows, func):
+    """Run one stage, record its result and return the stage's value.
+
+    ``func`` returns ``(value, messages, latency)``. ``latency`` is a list of
+    per-message seconds, a summary dict with p50 and p99, or None when the
+    stage has no per-message latency.
+    """
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        value, messages, latency = func()
+        seconds = time.perf_counter() - start
+    p50 = p99 = None
+    if isinstance(latency, dict):
+        if latency.get('count'):
+            p50, p99 = latency['p50'], latency['p99']
+    elif latency:
+        p50, p99 = percentile(latency, 0.50), percentile(latency, 0.99)
+    result = {
+        'scenario': scenario,
+        'stage': stage,
+        'rows': rows,
+        'messages': messages,
+        'seconds': seconds,
+        'messages_per_second': messages / seconds if seconds > 0 else 0.0,
+        'p50_latency': p50,
+        'p99_latency': p99,
+        'peak_rss_mb': rss.peak / 1e6,
+    }
+    results.append(result)
+    print_result(result)
+    return value
+
+
+def print_result(result):
+    def ms(value):
+        return f"{value * 1000:9.2f}" if value is not None else f"{'-':>9}"
+    print(
+        f"{result['scenario']:<14} {result['stage']:<8} {result['rows']:>9,} rows "
+        f"{result['messages']:>9,} msgs {result['seconds']:8.3f}s "
+        f"{result['messages_per_second']:>11,.0f}/s p50 {ms(result['p50_latency'])}ms "
+        f"p99 {ms(result['p99_latency'])}ms rss {result['peak_rss_mb']:8.1f}MB"
+    )
+
+
+def head(sheet, count):
+    """The first ``count`` rows of a parsed sheet, keeping its type"""
+    if hasattr(sheet, 'iloc'):
+        return sheet.iloc[:count]
+    return type(sheet)(sheet[:count], columns=sheet.columns)
+
+
+def bench_orders(results, of, size, send_rows, work_dir):
+    scenario = f"orders-{size}"
+    count = parse_size(size)
+    path = work_dir / f"orders_{size}.csv"
+    path.write_bytes(to_csv_bytes(ORDER_COLUMNS, order_rows(count)))
+
+    data = run_stage(results, scenario, "fetch", count, lambda: (of.read_source(str(path)), 0, None))
+    sheet = run_stage(results, scenario, "parse", count, lambda: (of.parse_orders_bytes(data), 0, None))
+    del data
+
+    def plan():
+        with of.SentLedger(work_dir / f"plan_{size}.db") as ledger:
+            notifications = of.plan_notifications(sheet, ledger)
+        return notifications, len(notifications), None
+
+    def render():
+        return None, len(of.render_notification_emails(notifications)), None
+
+    notifications = run_stage(results, scenario, "plan", count, plan)
+    run_stage(results, scenario, "render", count, render)
+    del notifications
+
+    sheet = head(sheet, send_rows)
+    sender = TimedSender(of.open_smtp_sender())
+    sender.start()
+
+    def send():
+        sent_count, _ = of.process_and_send_notifications(sheet, sender=sender)
+        return None, sent_count, sender.latencies
+
+    try:
+        run_stage(results, scenario, "send", len(sheet), send)
+    finally:
+        sender.close()
+
+
+def bench_events(results, se, size, window, receiver):
+    scenario = f"events-{size}"
+    count = parse_size(size)
+
+    def make_sheet(first_reminder):
+        return to_csv_bytes(EVENT_COLUMNS, event_rows(count, first_reminder, window))
+
+    # Reminders must still be in the future once the sheet is generated and
+    # parsed, so time both once and start the real sheet's reminders after that
+    started = time.perf_counter()
+    se.parse_events_bytes(make_sheet(datetime.datetime.now()))
+    lead = 1.0 + 2 * (time.perf_counter() - started)
+
+    data = make_sheet(datetime.datetime.now() + datetime.timedelta(seconds=lead))
+    sheet = run_stage(results, scenario, "parse", count, lambda: (se.parse_events_bytes(data), 0, None))
+
+    def send():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = se.schedule_and_send_emails(sheet, receiver_email=receiver)
+        # Per-message latency of a reminder is how late it went out
+        return None, result['total_scheduled'] - result.get('failed', 0), result.get('lateness')
+
+    run_stage(results, scenario, "send", count, send)
+
+
+def compare(results, baseline, max_regression):
+    """Return a list of regressions against a baseline results file"""
+    previous = {(r['scenario'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['scenario'], result['stage']))
+        if before is None:
+            continue
+        key = f"{result['scenario']} {result['stage']}"
+        if before['messages'] and result['messages_per_second'] < before['messages_per_second'] * (1 - max_regression):
+            regressions.append(
+                f"{key}: {result['messages_per_second']:,.0f} msgs/s, baseline {before['messages_per_second']:,.0f}"
+            )
+        if before['p99_latency'] and result['p99_latency'] and result['p99_latency'] > before['p99_latency'] * (1 + max_regression):
+            regressions.append(
+                f"{key}: p99 {result['p99_latency'] * 1000:.2f}ms, baseline {before['p99_latency'] * 1000:.2f}ms"
+            )
+        if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + max_regression):
+            regressions.append(
+                f"{key}: peak RSS {result['peak_rss_mb']:.1f}MB, baseline {before['peak_rss_mb']:.1f}MB"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", default="1k,100k", help="comma separated order sheet sizes, e.g. 1k,100k,1M")
+    parser.add_argument("--events", default="1k", help="comma separated event sheet sizes")
+    parser.add_argument("--send-rows", type=parse_size, default=10000,
+                        help="order rows sent through the sink per size (default: %(default)s)")
+    parser.add_argument("--event-window", type=float, default=5.0,
+                        help="seconds over which event reminders fall due (default: %(default)s)")
+    parser.add_argument("--rtt", type=float, default=0.0, help="sink delay per round trip in seconds")
+    parser.add_argument("--latency", type=float, default=0.0, help="sink delay per message in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of messages the sink defers")
+    parser.add_argument("--no-pipelining", action="store_true", help="sink does not advertise PIPELINING")
+    parser.add_argument("--pool-size", type=int, default=4, help="SMTP connections (default: %(default)s)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed slowdown against the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    with SMTPSink(latency=args.latency, error_rate=args.error_rate, rtt=args.rtt,
+                  pipelining=not args.no_pipelining) as sink, \
+            tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        # The scripts read their settings from the environment when imported
+        os.environ.update(
+            EMAIL_SERVER=sink.address[0],
+            SMTP_PORT=str(sink.address[1]),
+            SMTP_STARTTLS="0",
+            EMAIL="bench@example.com",
+            PASSWORD="",
+            SMTP_POOL_SIZE=str(args.pool_size),
+            SMTP_RATE="1000000",
+            SMTP_BURST="1000000",
+            FINAL_NOTIFICATION_DELAY_MINUTES="0",
+        )
+        for name in ("SHEET_CACHE_DIR", "ORDERS_CHUNK_SIZE"):
+            os.environ.pop(name, None)
+        os.chdir(work_dir)
+        import order_fulfill as of
+        import static_email_remainder as se
+        # Per-message logging, including the sink's simulated failures, would swamp the report
+        logging.disable(logging.ERROR)
+
+        results = []
+        for size in filter(None, args.orders.split(",")):
+            bench_orders(results, of, size.strip(), args.send_rows, work_dir)
+        for size in filter(None, args.events.split(",")):
+            bench_events(results, se, size.strip(), args.event_window, "bench@example.com")
+        os.chdir(REPO_DIR)
+        print(f"SMTP sink accepted {sink.received} messages and deferred {sink.rejected}")
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'settings': {
+            'rtt': args.rtt,
+            'latency': args.latency,
+            'pipelining': not args.no_pipelining,
+            'error_rate': args.error_rate,
+            'pool_size': args.pool_size,
+            'send_rows': args.send_rows,
+        },
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Local SMTP server that accepts and discards messages, for offline benchmarks.
+
+It can add a network round trip to every reply, wait before accepting each
+message, to stand in for a slow provider, and defer a fraction of messages
+with a 4xx reply.
+
+Usage: python benchmarks/smtp_sink.py [--port N] [--rtt SECONDS] [--latency SECONDS]
+           [--error-rate FRACTION] [--no-pipelining]
+"""
+import time
+import random
+import argparse
+import threading
+import socketserver
+
+
+class _SinkHandler(socketserver.BaseRequestHandler):
+    """Answer SMTP commands, writing every reply to the commands received so far at once.
+
+    Replies wait ``rtt`` seconds before they are written, like a network
+    round trip, so a client that pipelines its commands pays it once for
+    the whole batch.
+    """
+
+    def handle(self):
+        sink = self.server.sink
+        sock = self.request
+        replies = ["220 smtp-sink ready"]
+        buffer = b""
+        in_data = False
+        while True:
+            if replies:
+                if sink.rtt:
+                    time.sleep(sink.rtt)
+                sock.sendall("".join(reply + "\r\n" for reply in replies).encode('ascii'))
+                replies = []
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            *lines, buffer = (buffer + chunk).split(b"\r\n")
+            for line in lines:
+                if in_data:
+                    if line == b".":
+                        in_data = False
+                        replies.append(sink._message_received())
+                    continue
+                command = line.decode('ascii', 'replace').strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    replies.append("250-smtp-sink")
+                    if sink.pipelining:
+                        replies.append("250-PIPELINING")
+                    replies.append("250 8BITMIME")
+                elif command.startswith("DATA"):
+                    in_data = True
+                    replies.append("354 End data with <CR><LF>.<CR><LF>")
+                elif command.startswith("QUIT"):
+                    sock.sendall("".join(reply + "\r\n" for reply in replies + ["221 Bye"]).encode('ascii'))
+                    return
+                else:
+                    replies.append("250 OK")
+
+
+class _SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """SMTP server on a background thread that counts the messages it receives.
+
+    Every batch of replies is delayed by ``rtt`` seconds and each message is
+    answered after a further ``latency`` seconds; a random ``error_rate``
+    fraction of messages is rejected with ``error_code``. PIPELINING is
+    advertised unless ``pipelining`` is False.
+    ``first_message_at`` is the ``time.perf_counter()`` value when the first
+    message was accepted, so callers can measure time to first send.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, error_code=451, seed=0,
+                 rtt=0.0, pipelining=True):
+        self._server = _SinkServer((host, port), _SinkHandler)
+        self._server.sink = self
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._thread = None
+        self.latency = latency
+        self.rtt = rtt
+        self.pipelining = pipelining
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.received = 0
+        self.rejected = 0
+        self.first_message_at = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _message_received(self):
+        """Count a message and return the reply to send for it"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.rejected += 1
+                return f"{self.error_code} Requested action aborted: simulated failure"
+            if self.first_message_at is None:
+                self.first_message_at = time.perf_counter()
+            self.received += 1
+        return "250 OK"
+
+    def reset(self):
+        with self._lock:
+            self.received = 0
+            self.rejected = 0
+            self.first_message_at = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--rtt", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering each message")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of messages to reject")
+    parser.add_argument("--error-code", type=int, default=451, help="reply code for rejected messages")
+    parser.add_argument("--no-pipelining", action="store_true", help="do not advertise PIPELINING")
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.latency, args.error_rate, args.error_code,
+                    rtt=args.rtt, pipelining=not args.no_pipelining)
+    sink.start()
+    print(f"SMTP sink listening on {args.host}:{sink.address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        print(f"Received {sink.received} messages, rejected {sink.rejected}")
+
+
+if __name__ == "__main__":
+    main()
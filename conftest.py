@@ -0,0 +1 @@
+# Lets the tests import the scripts' modules, which live at the top of the repository
@@ -0,0 +1,123 @@
+import random
+import string
+import email
+import email.policy
+from email import quoprimime
+from email.header import Header
+from email.utils import formatdate, parseaddr
+from collections import namedtuple
+from pathlib import Path
+
+TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+
+# A fully serialized message, ready for smtplib's sendmail()
+RenderedEmail = namedtuple('RenderedEmail', ['from_addr', 'to_addrs', 'data'])
+
+# RFC 5322 hard limit on line length, excluding CRLF
+_MAX_LINE_LENGTH = 998
+
+# Part headers for every (subtype, transfer encoding) combination, built once
+_PART_HEADERS = {
+    (subtype, cte): f'Content-Type: text/{subtype}; charset="utf-8"\nContent-Transfer-Encoding: {cte}\n\n'
+    for subtype in ("plain", "html")
+    for cte in ("7bit", "quoted-printable")
+}
+
+
+def _new_boundary():
+    return "===============" + "".join(random.choices(string.digits, k=19)) + "=="
+
+
+def _header_value(value):
+    """Make a field safe to use as a header value"""
+    value = " ".join(str(value).splitlines())
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode()
+
+
+def _encode_part(text):
+    """Return (Content-Transfer-Encoding, encoded body) for a text part"""
+    body = "\n".join(text.splitlines()) + "\n"
+    if body.isascii() and max(len(line) for line in body.split("\n")) <= _MAX_LINE_LENGTH:
+        return "7bit", body
+    return "quoted-printable", quoprimime.body_encode(body.encode('utf-8').decode('latin-1'), 76)
+
+
+class EmailTemplate:
+    """A plain text + HTML email compiled once and rendered many times.
+
+    The subject and bodies are compiled to ``string.Template`` objects and
+    the MIME skeleton (headers, boundary and part headers) is built once.
+    Rendering only substitutes the variable fields and encodes the two
+    parts, then joins the pieces into wire-ready bytes.
+    """
+
+    def __init__(self, subject, plain, html, from_header, add_date=False):
+        self.subject = string.Template(subject)
+        self.plain = string.Template(plain)
+        self.html = string.Template(html)
+        self.from_header = from_header
+        self.from_addr = parseaddr(from_header)[1]
+        self.add_date = add_date
+        self.boundary = _new_boundary()
+        self._skeleton = self._build_skeleton(self.boundary)
+
+    @classmethod
+    def load(cls, name, subject, from_header, add_date=False, template_dir=TEMPLATE_DIR):
+        """Load templates/<name>.txt and templates/<name>.html"""
+        template_dir = Path(template_dir)
+        plain = (template_dir / f"{name}.txt").read_text(encoding='utf-8')
+        html = (template_dir / f"{name}.html").read_text(encoding='utf-8')
+        return cls(subject, plain, html, from_header, add_date=add_date)
+
+    def _build_skeleton(self, boundary):
+        content_type = f'Content-Type: multipart/alternative;\n boundary="{boundary}"\n'
+        return (
+            f"From: {_header_value(self.from_header)}\n",
+            f"MIME-Version: 1.0\n{content_type}\n",
+            f"--{boundary}\n",
+            f"\n--{boundary}\n",
+            f"\n--{boundary}--\n",
+        )
+
+    def _render_text(self, to_addr, fields):
+        from_line, mime_headers, first, middle, last = self._skeleton
+        plain_cte, plain = _encode_part(self.plain.substitute(fields))
+        html_cte, html = _encode_part(self.html.substitute(fields))
+        if self.boundary in plain or self.boundary in html:
+            from_line, mime_headers, first, middle, last = self._build_skeleton(_new_boundary())
+
+        headers = [
+            f"Subject: {_header_value(self.subject.substitute(fields))}\n",
+            from_line,
+            f"To: {_header_value(to_addr)}\n",
+        ]
+        if self.add_date:
+            headers.append(f"Date: {formatdate(localtime=True)}\n")
+
+        return "".join((
+            *headers,
+            mime_headers,
+            first,
+            _PART_HEADERS["plain", plain_cte],
+            plain,
+            middle,
+            _PART_HEADERS["html", html_cte],
+            html,
+            last,
+        ))
+
+    def render(self, to_addr, fields):
+        """Render one message as a RenderedEmail with CRLF-terminated bytes"""
+        data = self._render_text(to_addr, fields).replace("\n", "\r\n").encode('ascii')
+        return RenderedEmail(self.from_addr, [str(to_addr)], data)
+
+    def render_batch(self, rows):
+        """Render many messages; rows is an iterable of (to_addr, fields) pairs"""
+        render = self.render
+        return [render(to_addr, fields) for to_addr, fields in rows]
+
+    def render_message(self, to_addr, fields):
+        """Render one message as an EmailMessage, for callers that need the object"""
+        return email.message_from_string(self._render_text(to_addr, fields), policy=email.policy.default)
@@ -0,0 +1,154 @@
+import csv
+import io
+import math
+import datetime
+import urllib.request
+
+# Date formats tried, in order, on a column's first value. They match what
+# pandas infers for the same values; anything else goes to pandas instead.
+KNOWN_DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+]
+
+NAN = float('nan')
+
+# Strings pandas.read_csv reads as missing by default
+NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+
+class SheetRecords(list):
+    """Sheet rows as a list of dicts, a pandas-free stand-in for small DataFrames"""
+
+    def __init__(self, rows=(), columns=()):
+        super().__init__(rows)
+        self.columns = list(columns)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+
+class UnsupportedSheet(ValueError):
+    """The sheet needs pandas to be parsed the same way"""
+
+
+def is_missing(value):
+    """True for the values pandas treats as NA: None, NaN and NaT"""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def read_source(url, timeout=30):
+    """Return the raw bytes of a sheet export from a URL or local path"""
+    if url.startswith(("http://", "https://")):
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+    path = url[len("file://"):] if url.startswith("file://") else url
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _convert_column(values):
+    """Convert a column of strings the way pandas.read_csv infers its type"""
+    values = [NAN if v in NA_VALUES else v for v in values]
+    present = [v for v in values if v is not NAN]
+    if not present:
+        return values
+    if all(v.lower() in ("true", "false") for v in present):
+        raise UnsupportedSheet("boolean column")
+    try:
+        [float(v) for v in present]
+    except ValueError:
+        return values
+    if any("_" in v or v != v.strip() for v in present):
+        # Python's int() and float() accept these, pandas may not
+        raise UnsupportedSheet("ambiguous numeric text")
+    if len(present) == len(values):
+        try:
+            ints = [int(v) for v in values]
+        except ValueError:
+            ints = None
+        if ints is not None:
+            if any(not -2**63 <= v < 2**63 for v in ints):
+                raise UnsupportedSheet("integers outside int64")
+            return ints
+    return [NAN if v is NAN else float(v) for v in values]
+
+
+def parse_records(data, text_columns=()):
+    """Parse CSV bytes into SheetRecords with pandas-compatible value types.
+
+    Columns named in ``text_columns`` keep their values as strings, like a
+    ``str`` dtype in pandas.read_csv; missing values still become NaN.
+    """
+    reader = csv.reader(io.StringIO(data.decode('utf-8-sig')))
+    header = next(reader, None)
+    if header is None:
+        return SheetRecords()
+    rows = [row for row in reader if row]
+    if any(len(row) != len(header) for row in rows):
+        raise UnsupportedSheet("ragged rows")
+    if len(set(header)) != len(header):
+        raise UnsupportedSheet("duplicate column names")
+
+    if rows:
+        columns = [
+            [NAN if v in NA_VALUES else v for v in values] if name in text_columns else _convert_column(list(values))
+            for name, values in zip(header, zip(*rows))
+        ]
+    else:
+        columns = [[] for _ in header]
+    return SheetRecords(
+        (dict(zip(header, values)) for values in zip(*columns)),
+        columns=header,
+    )
+
+
+def guess_date_format(value):
+    """The first of KNOWN_DATE_FORMATS that parses ``value``, or None"""
+    for candidate in KNOWN_DATE_FORMATS:
+        try:
+            datetime.datetime.strptime(value, candidate)
+        except ValueError:
+            continue
+        return candidate
+    return None
+
+
+def parse_date_column(records, column, date_format=None):
+    """Convert a column to datetime in place, like pd.to_datetime(errors='coerce').
+
+    Without ``date_format`` the format is picked from the first non-missing
+    value. Missing or unparseable values become None.
+    """
+    if column not in records.columns:
+        return
+    if date_format is None:
+        first = next((row[column] for row in records if not is_missing(row[column])), None)
+        if first is None:
+            for row in records:
+                row[column] = None
+            return
+        if not isinstance(first, str):
+            raise UnsupportedSheet(f"non-text dates in {column}")
+        date_format = guess_date_format(first)
+        if date_format is None:
+            raise UnsupportedSheet(f"unrecognised date format in {column}: {first!r}")
+
+    strptime = datetime.datetime.strptime
+    for row in records:
+        value = row[column]
+        if is_missing(value):
+            row[column] = None
+            continue
+        try:
+            row[column] = strptime(str(value), date_format)
+        except ValueError:
+            row[column] = None
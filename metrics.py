@@ -0,0 +1,273 @@
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from sub-millisecond renders to slow sheet fetches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'stage_duration_seconds': "Time spent in each stage (fetch, parse, plan, render, smtp_connect, smtp_login, smtp_send)",
+    'rows_parsed_total': "Sheet rows parsed",
+    'rows_invalid_total': "Sheet rows dropped because a value failed the sheet's schema",
+    'notifications_planned_total': "Notifications planned to be sent",
+    'messages_sent_total': "Messages accepted by the SMTP server",
+    'messages_failed_total': "Messages that could not be sent",
+    'digest_emails_total': "Digest emails covering several notifications for one customer",
+    'outbox_enqueued_total': "Emails queued in the outbox for sender processes",
+    'smtp_connections_total': "SMTP connections opened",
+    'smtp_replies_total': "Outcome of each SMTP send attempt",
+    'smtp_retries_total': "Messages retried after a temporary SMTP failure",
+    'reminders_scheduled_total': "Reminders added to the schedule",
+    'reminders_ignored_total': "Events whose reminder time had already passed",
+    'reminder_recipients_total': "Reminder recipients accepted by the SMTP server",
+    'reminder_recipients_refused_total': "Reminder recipients the SMTP server refused for good",
+    'reminder_lateness_seconds': "How long after its scheduled time each reminder was accepted",
+}
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, as exported to Prometheus"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, values):
+        """Add the observations of a snapshot() taken from a histogram with the same buckets"""
+        bucket_counts = list(values['buckets'].values())
+        for i, count in enumerate(bucket_counts):
+            self.counts[i] += count
+        self.counts[-1] += values['count'] - sum(bucket_counts)
+        self.count += values['count']
+        self.sum += values['sum']
+        self.max = max(self.max, values['max'])
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.50),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """Counters and latency histograms for one process, keyed by name and labels.
+
+    Metric names are prefixed with ``namespace`` when exported. Every method
+    is thread safe, so SMTP worker threads can record into the same registry.
+
+    While a run is profiled, ``profiler`` is a profiling.RunProfiler and
+    every timed stage is also marked in its profile.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.profiler = None
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Record how long the block takes as one ``stage_duration_seconds`` observation"""
+        profiler = self.profiler
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                yield
+            else:
+                with profiler.stage(stage):
+                    yield
+        finally:
+            self.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    def timed_iter(self, stage, iterable):
+        """Yield from ``iterable``, timing how long each item takes to produce"""
+        iterator = iter(iterable)
+        while True:
+            profiler = self.profiler
+            start = time.perf_counter()
+            try:
+                if profiler is None:
+                    item = next(iterator)
+                else:
+                    with profiler.stage(stage):
+                        item = next(iterator)
+            except StopIteration:
+                return
+            self.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+            yield item
+
+    def snapshot(self):
+        """Return every metric as plain data, ready for JSON"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self._histograms.items())
+        return {
+            'namespace': self.namespace,
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in counters
+            ],
+            'histograms': [
+                {'name': name, 'labels': dict(labels), **values}
+                for (name, labels), values in histograms
+            ],
+        }
+
+    def merge(self, snapshot):
+        """Add the counters and histograms of another registry's snapshot(), e.g. from a worker process"""
+        with self._lock:
+            for counter in snapshot['counters']:
+                key = (counter['name'], tuple(sorted(counter['labels'].items())))
+                self._counters[key] = self._counters.get(key, 0) + counter['value']
+            for values in snapshot['histograms']:
+                key = (values['name'], tuple(sorted(values['labels'].items())))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.merge(values)
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            full_name = f"{self.namespace}_{name}"
+            if full_name not in described:
+                described.add(full_name)
+                lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} {kind}")
+            return full_name
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                full_name = describe(name, "counter")
+                lines.append(f"{full_name}{_label_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                full_name = describe(name, "histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{full_name}_sum{_label_text(labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{_label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        """Write <namespace>.json and <namespace>.prom into ``directory``"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for suffix, text in ((".json", self.to_json()), (".prom", self.to_prometheus())):
+            path = directory / f"{self.namespace}{suffix}"
+            tmp_path = path.with_suffix(suffix + ".tmp")
+            tmp_path.write_text(text, encoding='utf-8')
+            tmp_path.replace(path)
+        logging.info(f"Wrote metrics to {directory}")
+
+    def stage_summary(self):
+        """One line with the total time and call count of every stage"""
+        with self._lock:
+            stages = [
+                (dict(labels)['stage'], histogram.sum, histogram.count)
+                for (name, labels), histogram in sorted(self._histograms.items())
+                if name == 'stage_duration_seconds'
+            ]
+        return ", ".join(f"{stage} {total:.2f}s/{count}" for stage, total, count in stages)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == "/metrics":
+            body, content_type = registry.to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = registry.to_json(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request: {format % args}")
+
+
+class MetricsServer:
+    """Serve a registry at /metrics (Prometheus text) and /metrics.json on a background thread"""
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info(f"Serving metrics on http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
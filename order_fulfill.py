@@ -1,15 +1,30 @@
 import os
-import smtplib
-import pandas as pd
+import io
 import datetime
-from email.message import EmailMessage
 from email.utils import formataddr
 from pathlib import Path
 from dotenv import load_dotenv
 import logging
-import time
+import argparse
+import signal
+import threading
 import random
-import csv
+import time
+import zlib
+import queue
+import tempfile
+import multiprocessing
+from collections import namedtuple, deque
+from outbox import Outbox
+from sent_ledger import SentLedger, migrate_csv, owner_alive
+from smtp_pool import SMTPSender, SMTPSetupError, is_permanent_failure
+from rate_limiter import AdaptiveRateLimiter
+from sheet_cache import SheetSnapshotCache
+from email_templates import EmailTemplate
+from metrics import MetricsRegistry, MetricsServer
+from light_csv import SheetRecords, UnsupportedSheet, is_missing, read_source
+from sheet_schema import SheetSchema, report_problems
+from profiling import add_profiling_arguments, profiled
 
 # Configure logging
 logging.basicConfig(
@@ -21,334 +36,1253 @@ logging.basicConfig(
     ]
 )
 
-PORT = 587
-EMAIL_SERVER = "smtp.gmail.com"
+current_dir = Path(__file__).resolve().parent if "__file__" in locals() else Path.cwd()
+envars = current_dir / ".env"
+load_dotenv(envars)
+
+PORT = int(os.getenv("SMTP_PORT", "587"))
+EMAIL_SERVER = os.getenv("EMAIL_SERVER", "smtp.gmail.com")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
 
 # Google Sheet info
 SHEET_ID = "1ncMwNeHucQcmf6lgB1yT0M8PLcoJmfIfIRX9o9iRhUY"  # Update with your sheet ID
 SHEET_NAME = "Orders"  # Update with your sheet name
-URL = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/gviz/tq?tqx=out:csv&sheet={SHEET_NAME}"
-
-current_dir = Path(__file__).resolve().parent if "__file__" in locals() else Path.cwd()
-envars = current_dir / ".env"
-load_dotenv(envars)
+URL = os.getenv("ORDERS_SHEET_URL") or f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/gviz/tq?tqx=out:csv&sheet={SHEET_NAME}"
 
 # Read environment variables
 sender_email = os.getenv("EMAIL")
 password_email = os.getenv("PASSWORD")
 
-# Initialize sent orders tracking
+# Number of SMTP connections used to send notifications concurrently
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+
+# Send rate ceiling (messages per second) and burst size agreed with the provider
+SMTP_RATE = float(os.getenv("SMTP_RATE", "5"))
+SMTP_BURST = int(os.getenv("SMTP_BURST", "10"))
+
+# Attempts per message after temporary failures (4xx replies, dropped connections), and the
+# backoff between them: SMTP_RETRY_DELAY seconds, doubling up to SMTP_MAX_RETRY_DELAY
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", "4"))
+SMTP_RETRY_DELAY = float(os.getenv("SMTP_RETRY_DELAY", "2"))
+SMTP_MAX_RETRY_DELAY = float(os.getenv("SMTP_MAX_RETRY_DELAY", "60"))
+
+# Directory for sheet snapshots; when set, only new or changed rows are processed
+SHEET_CACHE_DIR = os.getenv("SHEET_CACHE_DIR")
+
+# Rows per chunk when streaming large order sheets; unset loads the whole sheet at once
+ORDERS_CHUNK_SIZE = int(os.getenv("ORDERS_CHUNK_SIZE", "0")) or None
+
+# Sheets smaller than this many bytes are parsed without importing pandas
+SMALL_SHEET_BYTES = int(os.getenv("SMALL_SHEET_BYTES", "1000000"))
+
+# Daemon mode: seconds between sheet polls, NOOP keepalive interval and default snapshot directory
+DAEMON_POLL_INTERVAL = float(os.getenv("DAEMON_POLL_INTERVAL", "15"))
+SMTP_KEEPALIVE_INTERVAL = float(os.getenv("SMTP_KEEPALIVE_INTERVAL", "60"))
+DAEMON_CACHE_DIR = ".sheet_cache"
+
+# Digest mode: one email per customer covering all of their pending notifications.
+# In daemon mode, DIGEST_WINDOW seconds of updates are collected before a digest is sent.
+DIGEST_MODE = os.getenv("DIGEST_MODE", "0") == "1"
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "0"))
+
+# Stage metrics: written to METRICS_DIR after each run, served on METRICS_PORT in daemon mode
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) or None
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS = MetricsRegistry("order_notifier")
+
+# Directory for the reports of runs started with --profile or --profile-memory
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Worker processes that split the orders between them by order_id (1 = no sharding)
+ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", "1"))
+
+# Sent notification ledger. The legacy CSV file is only read once, to migrate it.
 SENT_ORDERS_FILE = "sent_orders.csv"
+SENT_ORDERS_DB = "sent_orders.db"
+
+# Emails reserved in the ledger in one transaction before they are handed to the SMTP pool;
+# a crash leaves at most this many reserved but not sent
+RESERVE_BATCH_SIZE = int(os.getenv("RESERVE_BATCH_SIZE", "100"))
+
+# Outbox (--outbox / --send-outbox): seconds a claimed email stays hidden from other
+# senders, send attempts before it is given up, seconds before a failed send is retried
+# (doubling with every attempt up to OUTBOX_MAX_RETRY_DELAY) and how many emails a
+# sender claims at a time
+OUTBOX_VISIBILITY_TIMEOUT = float(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "60"))
+OUTBOX_MAX_RETRY_DELAY = float(os.getenv("OUTBOX_MAX_RETRY_DELAY", "3600"))
+OUTBOX_CLAIM_SIZE = int(os.getenv("OUTBOX_CLAIM_SIZE", "50"))
+
+# Number of --send-outbox processes run at once; each sends at its share of SMTP_RATE,
+# SMTP_BURST and SMTP_POOL_SIZE so that together they keep to the provider's limits
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "1"))
 
 def initialize_sent_orders_file():
-    """Create sent orders tracking file if it doesn't exist"""
-    if not os.path.exists(SENT_ORDERS_FILE):
-        with open(SENT_ORDERS_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['order_id', 'customer_email', 'notification_type', 'sent_timestamp'])
-        logging.info(f"Created new sent orders tracking file: {SENT_ORDERS_FILE}")
+    """Create the sent notification ledger, migrating a legacy CSV ledger if present"""
+    if os.path.exists(SENT_ORDERS_DB):
+        return
+    if os.path.exists(SENT_ORDERS_FILE):
+        # Migrate into a temporary file so an interrupted migration is redone next run
+        migrating_db = SENT_ORDERS_DB + ".migrating"
+        if os.path.exists(migrating_db):
+            os.remove(migrating_db)
+        migrate_csv(SENT_ORDERS_FILE, migrating_db)
+        os.replace(migrating_db, SENT_ORDERS_DB)
+    else:
+        SentLedger(SENT_ORDERS_DB).close()
+        logging.info(f"Created new sent notification ledger: {SENT_ORDERS_DB}")
 
 def get_sent_orders():
-    """Load the list of orders that have already been processed"""
-    if not os.path.exists(SENT_ORDERS_FILE):
-        initialize_sent_orders_file()
-        return set()
-    
-    sent_orders = set()
-    try:
-        with open(SENT_ORDERS_FILE, 'r') as f:
-            reader = csv.reader(f)
-            next(reader)  # Skip header
-            for row in reader:
-                if row:  # Make sure row is not empty
-                    order_id = row[0]
-                    notification_type = row[2]
-                    sent_orders.add(f"{order_id}_{notification_type}")
-        return sent_orders
-    except Exception as e:
-        logging.error(f"Error reading sent orders file: {e}")
-        return set()
+    """Open the ledger of orders that have already been processed"""
+    initialize_sent_orders_file()
+    return SentLedger(SENT_ORDERS_DB)
 
-def record_sent_order(order_id, customer_email, notification_type):
+def record_sent_order(ledger, order_id, customer_email, notification_type):
     """Record that a notification has been sent for an order"""
-    with open(SENT_ORDERS_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([order_id, customer_email, notification_type, datetime.datetime.now()])
+    ledger.record(order_id, customer_email, notification_type)
         
+# Format of the sheet's date columns; a sheet that uses another format has it inferred
+ORDER_DATE_FORMAT = os.getenv("ORDER_DATE_FORMAT", "%Y-%m-%d")
+
+# Column types of the orders sheet: order ids stay text, statuses and carriers are categories
+ORDERS_SCHEMA = SheetSchema(
+    "orders",
+    text=['order_id', 'customer_email', 'customer_name', 'product_name', 'tracking_number'],
+    categories=['status', 'shipping_carrier'],
+    integers=['quantity'],
+    floats=['unit_price'],
+    dates={column: ORDER_DATE_FORMAT for column in ('order_date', 'ship_date', 'delivery_date')},
+    required=['order_id', 'customer_email', 'status', 'quantity', 'unit_price'],
+)
+
+def validate_orders(df, date_formats=None):
+    """Apply ORDERS_SCHEMA, reporting and dropping invalid rows in one batch"""
+    df, problems = ORDERS_SCHEMA.apply(df, date_formats)
+    _report_invalid_rows(problems)
+    return df
+
+def _report_invalid_rows(problems):
+    if problems:
+        report_problems(ORDERS_SCHEMA.name, problems)
+        METRICS.inc('rows_invalid_total', len({problem.row for problem in problems}))
+
+def parse_orders_data(source):
+    """Parse an orders CSV export from a URL, path or file-like object"""
+    return validate_orders(ORDERS_SCHEMA.read_csv(source))
+
+def keep_orders_whole(chunks):
+    """Move the lines of each chunk's last order into the next chunk.
+
+    Lines of one order are listed together in the sheet, so this keeps an
+    order that straddles a chunk boundary in a single chunk and it gets one
+    notification covering all of its lines.
+    """
+    import pandas as pd
+
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        if chunk.empty:
+            continue
+        last_order = chunk['order_id'] == chunk['order_id'].iloc[-1]
+        carry = chunk.loc[last_order]
+        if not last_order.all():
+            yield chunk.loc[~last_order]
+    if carry is not None and not carry.empty:
+        yield carry
+
+def iter_orders_data(source, chunksize):
+    """Parse an orders CSV export as a stream of DataFrames of about chunksize rows"""
+    date_formats = {}
+    with ORDERS_SCHEMA.read_csv(source, chunksize=chunksize) as reader:
+        # Reading a chunk also fetches it, so streamed sheets only report parse time
+        chunks = keep_orders_whole(validate_orders(chunk, date_formats) for chunk in reader)
+        for chunk in METRICS.timed_iter('parse', chunks):
+            METRICS.inc('rows_parsed_total', len(chunk))
+            yield chunk
+
+def parse_orders_bytes(data):
+    """Parse an orders CSV export, without pandas when the sheet is small.
+
+    Small sheets become SheetRecords; anything the pure-Python parser
+    cannot read exactly like pandas is handed to pandas instead.
+    """
+    if len(data) < SMALL_SHEET_BYTES:
+        try:
+            records, problems = ORDERS_SCHEMA.parse_records(data)
+            _report_invalid_rows(problems)
+            return records
+        except UnsupportedSheet as e:
+            logging.debug(f"Parsing orders sheet with pandas: {e}")
+    return parse_orders_data(io.BytesIO(data))
+
+def _parse_fetched_orders(data):
+    with METRICS.timer('parse'):
+        df = parse_orders_bytes(data)
+    METRICS.inc('rows_parsed_total', len(df))
+    return df
+
 def load_orders_data(url):
     """Load orders data from Google Sheet"""
     try:
-        df = pd.read_csv(url)
-        
-        # Convert date columns to datetime if they exist
-        date_columns = ['order_date', 'ship_date', 'delivery_date']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
-        
-        return df
+        with METRICS.timer('fetch'):
+            data = read_source(url)
+        return _parse_fetched_orders(data)
+    except Exception as e:
+        logging.error(f"Error loading Google Sheet data: {e}")
+        return SheetRecords()
+
+def load_changed_orders(url, cache):
+    """Load only the order rows that are new or changed since the last committed run.
+
+    Returns the rows and the SheetChanges to commit once they are processed.
+    """
+    try:
+        with METRICS.timer('fetch'):
+            changes = cache.load_changes(url)
+        if changes.unchanged:
+            return SheetRecords(), changes
+        return _parse_fetched_orders(changes.csv_text.encode('utf-8')), changes
     except Exception as e:
         logging.error(f"Error loading Google Sheet data: {e}")
-        return pd.DataFrame()
+        return SheetRecords(), None
+
+# Email templates (templates/<name>.txt and .html) and their subjects
+EMAIL_SUBJECTS = {
+    'order_confirmation': "Order Confirmation #${order_id}",
+    'shipping_notification': "Your Order #${order_id} Has Been Shipped",
+    'delivery_confirmation': "Your Order #${order_id} Has Been Delivered",
+    'order_digest': "Updates on ${update_count} of Your Amazing Store Orders",
+}
+
+_email_templates = {}
+
+def get_email_template(name):
+    """Return a compiled email template, loading it on first use"""
+    template = _email_templates.get(name)
+    if template is None:
+        template = EmailTemplate.load(
+            name,
+            EMAIL_SUBJECTS[name],
+            formataddr(("Amazing Store", f"{sender_email}")),
+        )
+        _email_templates[name] = template
+    return template
+
+def order_confirmation_fields(customer_name, order_id, order_details, total_amount):
+    return {
+        'customer_name': customer_name,
+        'order_id': order_id,
+        'order_details': order_details,
+        'total_amount': f"{total_amount:.2f}",
+    }
+
+def shipping_notification_fields(customer_name, order_id, shipping_details, tracking_number):
+    return {
+        'customer_name': customer_name,
+        'order_id': order_id,
+        'shipping_details': shipping_details,
+        'tracking_number': tracking_number,
+    }
+
+def delivery_confirmation_fields(customer_name, order_id):
+    return {
+        'customer_name': customer_name,
+        'order_id': order_id,
+    }
 
 def create_order_confirmation_email(customer_email, customer_name, order_id, order_details, total_amount):
     """Create order confirmation email"""
-    subject = f"Order Confirmation #{order_id}"
-    
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr(("Amazing Store", f"{sender_email}"))
-    msg["To"] = customer_email
-   
-    
-    msg.set_content(
-        f"""
-        Dear {customer_name},
-        
-        Thank you for your order! We're pleased to confirm that we've received your order #{order_id}.
-        
-        Order Details:
-        {order_details}
-        
-        Total Amount: ${total_amount:.2f}
-        
-        We'll send you another email once your order has been shipped.
-        
-        If you have any questions about your order, please contact our customer service.
-        
-        Thank you for shopping with Amazing Store!
-        """
-    )
-    
-    msg.add_alternative(
-        f"""
-        <html>
-          <body style="font-family: Arial, sans-serif; line-height: 1.6;">
-            <h2>Order Confirmation</h2>
-            <p>Dear {customer_name},</p>
-            <p>Thank you for your order! We're pleased to confirm that we've received your order <strong>#{order_id}</strong>.</p>
-            
-            <h3>Order Details:</h3>
-            <p>{order_details}</p>
-            
-            <p><strong>Total Amount:</strong> ${total_amount:.2f}</p>
-            
-            <p>We'll send you another email once your order has been shipped.</p>
-            
-            <p>If you have any questions about your order, please contact our customer service.</p>
-            
-            <p>Thank you for shopping with Amazing Store!</p>
-          </body>
-        </html>
-        """,
-        subtype="html",
-    )
-    
-    return msg
+    fields = order_confirmation_fields(customer_name, order_id, order_details, total_amount)
+    return get_email_template('order_confirmation').render_message(customer_email, fields)
 
 def create_shipping_notification_email(customer_email, customer_name, order_id, shipping_details, tracking_number):
     """Create shipping notification email"""
-    subject = f"Your Order #{order_id} Has Been Shipped"
-    
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr(("Amazing Store", f"{sender_email}"))
-    msg["To"] = customer_email
-    
-    
-    msg.set_content(
-        f"""
-        Dear {customer_name},
-        
-        Great news! Your order #{order_id} has been shipped.
-        
-        Shipping Details:
-        {shipping_details}
-        
-        Tracking Number: {tracking_number}
-        
-        You can track your package using the tracking number above at our carrier's website.
-        
-        If you have any questions, please contact our customer service.
-        
-        Thank you for shopping with Amazing Store!
-        """
-    )
-    
-    msg.add_alternative(
-        f"""
-        <html>
-          <body style="font-family: Arial, sans-serif; line-height: 1.6;">
-            <h2>Shipping Confirmation</h2>
-            <p>Dear {customer_name},</p>
-            <p>Great news! Your order <strong>#{order_id}</strong> has been shipped.</p>
-            
-            <h3>Shipping Details:</h3>
-            <p>{shipping_details}</p>
-            
-            <p><strong>Tracking Number:</strong> {tracking_number}</p>
-            
-            <p>You can track your package using the tracking number above at our carrier's website.</p>
-            
-            <p>If you have any questions, please contact our customer service.</p>
-            
-            <p>Thank you for shopping with Amazing Store!</p>
-          </body>
-        </html>
-        """,
-        subtype="html",
-    )
-    
-    return msg
+    fields = shipping_notification_fields(customer_name, order_id, shipping_details, tracking_number)
+    return get_email_template('shipping_notification').render_message(customer_email, fields)
 
 def create_delivery_confirmation_email(customer_email, customer_name, order_id):
     """Create delivery confirmation email"""
-    subject = f"Your Order #{order_id} Has Been Delivered"
-    
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr(("Amazing Store", f"{sender_email}"))
-    msg["To"] = customer_email
-  
-    
-    msg.set_content(
-        f"""
-        Dear {customer_name},
-        
-        Your order #{order_id} has been delivered!
-        
-        We hope you're enjoying your purchase. If you have a moment, we'd appreciate it if you could leave a review of the products you purchased.
-        
-        If you have any questions or concerns about your order, please contact our customer service.
-        
-        Thank you for shopping with Amazing Store!
-        """
+    fields = delivery_confirmation_fields(customer_name, order_id)
+    return get_email_template('delivery_confirmation').render_message(customer_email, fields)
+
+# Order status that triggers each notification type
+NOTIFICATION_TYPES = {
+    'new': 'confirmation',
+    'shipped': 'shipping',
+    'delivered': 'delivery',
+}
+
+# A single notification that still has to be sent
+PendingNotification = namedtuple(
+    'PendingNotification',
+    ['notification_type', 'order_id', 'customer_email', 'customer_name',
+     'order_details', 'total_amount', 'shipping_details', 'tracking_number']
+)
+
+def _as_text(column):
+    """Format a column the way an f-string formats each of its values"""
+    return column.astype(str).fillna('nan')
+
+def plan_notifications(df, sent_orders, exclude=None):
+    """Work out which notifications still need to be sent, one column at a time.
+
+    Rows with the same order_id are lines of one order: each order gets one
+    notification per status, listing every line and the order total. Keys
+    in ``exclude`` are skipped as well as keys already in the ledger.
+    """
+    if isinstance(df, SheetRecords):
+        return plan_record_notifications(df, sent_orders, exclude)
+    if df.empty:
+        return []
+    import pandas as pd
+
+    # Status mask: only rows whose status maps to a notification type
+    notification_type = df['status'].map(NOTIFICATION_TYPES)
+    has_type = notification_type.notna()
+    orders = df.loc[has_type]
+    notification_type = notification_type[has_type].astype(str)
+    order_ids = orders['order_id'].astype(str)
+
+    # Anti-join against the sent ledger; repeats within the sheet are lines of the same order
+    keys = pd.MultiIndex.from_arrays([order_ids, notification_type])
+    sent_keys = sent_orders.sent_keys(zip(order_ids, notification_type))
+    pending = pd.Series(True, index=orders.index)
+    if sent_keys:
+        pending &= ~keys.isin(list(sent_keys))
+    if exclude:
+        pending &= ~keys.isin(list(exclude))
+
+    orders = orders.loc[pending]
+    if orders.empty:
+        return []
+    notification_type = notification_type.loc[pending].rename('notification_type')
+    order_ids = order_ids.loc[pending].rename('order_id')
+
+    # Line items computed for the whole column, then grouped into one row per order and type
+    quantity = orders['quantity']
+    unit_price = orders['unit_price']
+    line_details = (
+        _as_text(orders['product_name']) + " x " + _as_text(quantity)
+        + " - $" + unit_price.map('{:.2f}'.format) + " each"
     )
-    
-    msg.add_alternative(
-        f"""
-        <html>
-          <body style="font-family: Arial, sans-serif; line-height: 1.6;">
-            <h2>Delivery Confirmation</h2>
-            <p>Dear {customer_name},</p>
-            <p>Your order <strong>#{order_id}</strong> has been delivered!</p>
-            
-            <p>We hope you're enjoying your purchase. If you have a moment, we'd appreciate it if you could leave a review of the products you purchased.</p>
-            
-            <p>If you have any questions or concerns about your order, please contact our customer service.</p>
-            
-            <p>Thank you for shopping with Amazing Store!</p>
-          </body>
-        </html>
-        """,
-        subtype="html",
+    group_keys = [order_ids, notification_type]
+    # Summing strings concatenates them without a Python call per order
+    order_details = (line_details + "\n").groupby(group_keys, sort=False).sum().str[:-1]
+    total_amount = (quantity * unit_price).astype('float64').groupby(group_keys, sort=False).sum()
+
+    # Order level fields come from the first line that has them
+    columns = ['customer_email', 'customer_name', 'shipping_carrier', 'delivery_date']
+    if 'tracking_number' in orders.columns:
+        columns.append('tracking_number')
+    first = orders[columns].groupby(group_keys, sort=False).first()
+
+    estimated_delivery = first['delivery_date'].dt.strftime('%B %d, %Y').fillna('Unknown')
+    shipping_details = (
+        "Carrier: " + _as_text(first['shipping_carrier'])
+        + "\nEstimated delivery: " + estimated_delivery
     )
-    
-    return msg
 
-def process_and_send_notifications(df):
-    """Process orders and send appropriate notifications"""
-    sent_orders = get_sent_orders()
+    if 'tracking_number' in first.columns:
+        tracking_number = first['tracking_number'].astype(object)
+    else:
+        tracking_number = pd.Series(None, index=first.index, dtype=object)
+    missing_tracking = tracking_number.isna()
+    if missing_tracking.any():
+        tracking_number[missing_tracking] = [
+            f"TRK{random.randint(10000000, 99999999)}" for _ in range(int(missing_tracking.sum()))
+        ]
+
+    return [
+        PendingNotification(*fields)
+        for fields in zip(
+            first.index.get_level_values('notification_type').tolist(),
+            first.index.get_level_values('order_id').tolist(),
+            first['customer_email'].tolist(),
+            first['customer_name'].tolist(),
+            order_details.tolist(),
+            total_amount.tolist(),
+            shipping_details.tolist(),
+            tracking_number.tolist(),
+        )
+    ]
+
+def _first_present(lines, column):
+    """An order's value for a column: the first of its lines that has one"""
+    for row in lines:
+        value = row.get(column)
+        if not is_missing(value):
+            return value
+    return lines[0].get(column)
+
+def plan_record_notifications(records, sent_orders, exclude=None):
+    """Same plan as plan_notifications, for small sheets parsed without pandas"""
+    rows = []
+    for row in records:
+        notification_type = NOTIFICATION_TYPES.get(row['status'])
+        if notification_type is not None:
+            rows.append((str(row['order_id']), notification_type, row))
+    if not rows:
+        return []
+
+    # Anti-join against the sent ledger
+    skip = sent_orders.sent_keys((order_id, notification_type) for order_id, notification_type, _ in rows)
+    if exclude:
+        skip |= set(exclude)
+
+    # Lines of the same order, in the order each order first appears
+    orders = {}
+    for order_id, notification_type, row in rows:
+        key = (order_id, notification_type)
+        if key not in skip:
+            orders.setdefault(key, []).append(row)
+
+    notifications = []
+    for (order_id, notification_type), lines in orders.items():
+        line_details = []
+        total_amount = 0
+        for row in lines:
+            quantity = row['quantity']
+            unit_price = row['unit_price']
+            line_details.append(f"{row['product_name']} x {quantity} - ${unit_price:.2f} each")
+            total_amount += quantity * unit_price
+
+        delivery_date = _first_present(lines, 'delivery_date')
+        estimated_delivery = delivery_date.strftime('%B %d, %Y') if delivery_date is not None else 'Unknown'
+        tracking_number = _first_present(lines, 'tracking_number')
+        if is_missing(tracking_number):
+            tracking_number = f"TRK{random.randint(10000000, 99999999)}"
+        notifications.append(PendingNotification(
+            notification_type,
+            order_id,
+            _first_present(lines, 'customer_email'),
+            _first_present(lines, 'customer_name'),
+            "\n".join(line_details),
+            total_amount,
+            f"Carrier: {_first_present(lines, 'shipping_carrier')}\nEstimated delivery: {estimated_delivery}",
+            tracking_number,
+        ))
+    return notifications
+
+def _notification_template_fields(notification):
+    """Return the template name and fields for a planned notification"""
+    if notification.notification_type == 'confirmation':
+        return 'order_confirmation', order_confirmation_fields(
+            notification.customer_name,
+            notification.order_id,
+            notification.order_details,
+            notification.total_amount
+        )
+    if notification.notification_type == 'shipping':
+        return 'shipping_notification', shipping_notification_fields(
+            notification.customer_name,
+            notification.order_id,
+            notification.shipping_details,
+            notification.tracking_number
+        )
+    return 'delivery_confirmation', delivery_confirmation_fields(
+        notification.customer_name,
+        notification.order_id
+    )
+
+def build_notification_email(notification):
+    """Render the email for a planned notification, ready to send"""
+    name, fields = _notification_template_fields(notification)
+    return get_email_template(name).render(notification.customer_email, fields)
+
+# How each notification type is headed inside a digest
+DIGEST_HEADINGS = {
+    'confirmation': "Confirmed",
+    'shipping': "Shipped",
+    'delivery': "Delivered",
+}
+
+def _digest_update(notification):
+    """Heading and detail lines for one notification inside a digest"""
+    heading = f"Order #{notification.order_id} - {DIGEST_HEADINGS[notification.notification_type]}"
+    if notification.notification_type == 'confirmation':
+        details = [*notification.order_details.split("\n"), f"Total Amount: ${notification.total_amount:.2f}"]
+    elif notification.notification_type == 'shipping':
+        details = [*notification.shipping_details.split("\n"), f"Tracking Number: {notification.tracking_number}"]
+    else:
+        details = []
+    return heading, details
+
+def digest_fields(notifications):
+    """Template fields for a digest of one customer's notifications"""
+    updates = [_digest_update(notification) for notification in notifications]
+    text_blocks = []
+    html_blocks = []
+    for heading, details in updates:
+        text_blocks.append("\n".join(" " * 8 + line for line in [heading, *details]))
+        html_block = " " * 12 + f"<h3>{heading}</h3>"
+        if details:
+            html_block += "\n" + " " * 12 + "<p>" + "<br>".join(details) + "</p>"
+        html_blocks.append(html_block)
+    return {
+        'customer_name': notifications[0].customer_name,
+        'update_count': len(notifications),
+        'updates': "\n\n".join(text_blocks),
+        'updates_html': "\n".join(html_blocks),
+    }
+
+def build_digest_email(notifications):
+    """Render one email covering several notifications for the same customer"""
+    return get_email_template('order_digest').render(notifications[0].customer_email, digest_fields(notifications))
+
+class DigestBuffer:
+    """Planned notifications grouped by customer until their digest is due.
+
+    A customer's digest is due ``window`` seconds after their first held
+    notification; with a window of 0 everything is due as soon as it is added.
+    """
+
+    def __init__(self, window=0, clock=time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._groups = {}
+
+    def __len__(self):
+        return sum(len(notifications) for _, notifications in self._groups.values())
+
+    def keys(self):
+        """(order_id, notification_type) of every held notification"""
+        return {
+            (notification.order_id, notification.notification_type)
+            for _, notifications in self._groups.values()
+            for notification in notifications
+        }
+
+    def add(self, notifications):
+        now = self._clock()
+        for notification in notifications:
+            self._groups.setdefault(notification.customer_email, (now, []))[1].append(notification)
+
+    def pop_due(self, flush=False):
+        """Remove and return the notification groups that are due, one list per customer"""
+        cutoff = self._clock() - self.window
+        due = [email for email, (first_added, _) in self._groups.items() if flush or first_added <= cutoff]
+        return [self._groups.pop(email)[1] for email in due]
+
+def render_notification_emails(notifications):
+    """Render the emails for many planned notifications in one call"""
+    by_template = {}
+    for position, notification in enumerate(notifications):
+        name, fields = _notification_template_fields(notification)
+        by_template.setdefault(name, []).append((position, notification.customer_email, fields))
+
+    rendered = [None] * len(notifications)
+    for name, rows in by_template.items():
+        messages = get_email_template(name).render_batch((to_addr, fields) for _, to_addr, fields in rows)
+        for (position, _, _), msg in zip(rows, messages):
+            rendered[position] = msg
+    return rendered
+
+def open_smtp_sender(keepalive_interval=None, processes=1):
+    """Create the pooled, rate limited SMTP sending engine.
+
+    When ``processes`` processes send through the account at once, each
+    gets an even share of SMTP_RATE, SMTP_BURST and SMTP_POOL_SIZE, so
+    together they stay within what was agreed with the provider.
+    """
+    return SMTPSender(
+        EMAIL_SERVER,
+        PORT,
+        username=sender_email,
+        password=password_email,
+        pool_size=max(1, SMTP_POOL_SIZE // processes),
+        starttls=SMTP_STARTTLS,
+        keepalive_interval=keepalive_interval,
+        rate_limiter=AdaptiveRateLimiter(SMTP_RATE / processes, burst=SMTP_BURST / processes),
+        metrics=METRICS,
+        max_attempts=SMTP_MAX_ATTEMPTS,
+        retry_delay=SMTP_RETRY_DELAY,
+        max_retry_delay=SMTP_MAX_RETRY_DELAY,
+    )
+
+def plan_batches(df, sent_orders, digest=None, flush=False, exclude=frozenset()):
+    """Plan one chunk of orders and group the notifications into emails.
+
+    Returns the number of notifications planned and the batches that are
+    ready to go out, each a list of notifications for one email. Without a
+    DigestBuffer every notification is its own batch.
+    """
+    if digest:
+        exclude = exclude | digest.keys()
+    with METRICS.timer('plan'):
+        notifications = plan_notifications(df, sent_orders, exclude=exclude)
+    METRICS.inc('notifications_planned_total', len(notifications))
+    logging.info(f"Planned {len(notifications)} notifications from {len(df)} order rows")
+    if digest is None:
+        return len(notifications), [[notification] for notification in notifications]
+    digest.add(notifications)
+    batches = digest.pop_due(flush)
+    if digest:
+        logging.info(f"Holding {len(digest)} notifications for customer digests")
+    return len(notifications), batches
+
+def render_batch(batch):
+    """Render the email for a batch: the normal email for one notification, a digest for several"""
+    with METRICS.timer('render'):
+        if len(batch) == 1:
+            return build_notification_email(batch[0])
+        METRICS.inc('digest_emails_total')
+        return build_digest_email(batch)
+
+def process_and_send_notifications(orders, sent_orders=None, sender=None, digest=None, flush=False):
+    """Process orders and send appropriate notifications.
+
+    ``orders`` is a DataFrame, SheetRecords or an iterable of DataFrame chunks; chunks are
+    planned and sent one at a time so memory stays bounded. A ledger and a
+    started sender can be passed in by long-running callers; they are left
+    open. Returns the number of notifications sent and the number planned
+    but not sent.
+
+    With ``digest`` (True, or a DigestBuffer kept across calls) each
+    customer's notifications from a chunk are sent as one email. A
+    DigestBuffer with a window holds them back until they are due, or until
+    a call with ``flush=True``. Held notifications count as not sent.
+    """
+    if hasattr(orders, 'columns'):
+        orders = [orders]
+    if digest is True:
+        digest = DigestBuffer()
+    elif digest is False:
+        digest = None
+    owns_ledger = sent_orders is None
+    owns_sender = sender is None
+    if owns_ledger:
+        sent_orders = get_sent_orders()
     sent_count = 0
+    # Notifications this call is responsible for: newly planned plus those held from earlier calls
+    planned_count = len(digest) if digest else 0
+    # Keys whose send failed this run, so a later chunk does not plan them again
+    failed_keys = set()
+    in_flight = deque()
+
+    def collect_sent(block):
+        """Record notifications whose send has finished, oldest first"""
+        nonlocal sent_count
+        while in_flight and (block or in_flight[0][1].done()):
+            batch, future = in_flight.popleft()
+            kind = "digest" if len(batch) > 1 else "email"
+            try:
+                future.result()
+            except Exception as e:
+                keys = [(notification.order_id, notification.notification_type) for notification in batch]
+                if is_permanent_failure(e):
+                    # e.g. a rejected address: recorded, so later runs skip it
+                    sent_orders.mark_failed(keys, e)
+                    outcome = "permanent failure"
+                else:
+                    # Retries ran out, or the session could not be set up, so a later run tries again
+                    sent_orders.release(keys)
+                    outcome = "will retry next run"
+                failed_keys.update(keys)
+                for notification in batch:
+                    METRICS.inc('messages_failed_total', type=notification.notification_type)
+                    logging.error(f"Failed to send {notification.notification_type} {kind} for order #{notification.order_id} to {notification.customer_email} ({outcome}): {e}")
+                continue
+            for notification in batch:
+                record_sent_order(sent_orders, notification.order_id, notification.customer_email, notification.notification_type)
+                logging.info(f"Sent {notification.notification_type} {kind} for order #{notification.order_id} to {notification.customer_email}")
+                METRICS.inc('messages_sent_total', type=notification.notification_type)
+            sent_count += len(batch)
+
+    def submit_reserved(rendered):
+        """Reserve rendered emails in one ledger transaction, then hand them to the pool"""
+        if not rendered:
+            return
+        # Reserve before sending, so no other process sends it and a crash cannot resend it
+        reserved = sent_orders.reserve_batches(
+            [(n.order_id, n.notification_type, n.customer_email) for n in batch] for batch, _ in rendered
+        )
+        accepted = [item for item, ok in zip(rendered, reserved) if ok]
+        for batch, _ in (item for item, ok in zip(rendered, reserved) if not ok):
+            logging.warning(f"Skipping email to {batch[0].customer_email}: another process has already sent or reserved it")
+        submitted = 0
+        try:
+            for batch, msg in accepted:
+                in_flight.append((batch, sender.submit(msg)))
+                submitted += 1
+                collect_sent(block=False)
+        except Exception:
+            sent_orders.release((n.order_id, n.notification_type) for batch, _ in accepted[submitted:] for n in batch)
+            raise
     
     try:
-        # Login to SMTP server
-        with smtplib.SMTP(EMAIL_SERVER, PORT) as server:
-            server.starttls()
-            server.login(sender_email, password_email)
-            
-            current_date = datetime.datetime.now().date()
-            
-            for _, row in df.iterrows():
-                order_id = str(row['order_id'])
-                customer_email = row['customer_email']
-                customer_name = row['customer_name']
-                
-                # Generate shipping and delivery details for the email
-                order_details = f"{row['product_name']} x {row['quantity']} - ${row['unit_price']:.2f} each"
-                total_amount = row['quantity'] * row['unit_price']
-                shipping_details = f"Carrier: {row['shipping_carrier']}\nEstimated delivery: {row['delivery_date'].strftime('%B %d, %Y') if pd.notna(row['delivery_date']) else 'Unknown'}"
-                tracking_number = row['tracking_number'] if 'tracking_number' in row and pd.notna(row['tracking_number']) else f"TRK{random.randint(10000000, 99999999)}"
-                
-                # 1. Send order confirmation for new orders
-                if row['status'] == 'new' and f"{order_id}_confirmation" not in sent_orders:
-                    msg = create_order_confirmation_email(
-                        customer_email,
-                        customer_name,
-                        order_id,
-                        order_details,
-                        total_amount
-                    )
-                    
-                    server.send_message(msg)
-                    record_sent_order(order_id, customer_email, "confirmation")
-                    logging.info(f"Sent order confirmation email for order #{order_id} to {customer_email}")
-                    sent_count += 1
-                    
-                # 2. Send shipping notification for shipped orders
-                elif row['status'] == 'shipped' and f"{order_id}_shipping" not in sent_orders:
-                    msg = create_shipping_notification_email(
-                        customer_email,
-                        customer_name,
-                        order_id,
-                        shipping_details,
-                        tracking_number
-                    )
-                    
-                    server.send_message(msg)
-                    record_sent_order(order_id, customer_email, "shipping")
-                    logging.info(f"Sent shipping notification email for order #{order_id} to {customer_email}")
-                    sent_count += 1
-                    
-                # 3. Send delivery confirmation for delivered orders
-                elif row['status'] == 'delivered' and f"{order_id}_delivery" not in sent_orders:
-                    msg = create_delivery_confirmation_email(
-                        customer_email,
-                        customer_name,
-                        order_id
-                    )
-                    
-                    server.send_message(msg)
-                    record_sent_order(order_id, customer_email, "delivery")
-                    logging.info(f"Sent delivery confirmation email for order #{order_id} to {customer_email}")
-                    sent_count += 1
-                    
-                # Add a small delay between emails to avoid rate limiting
-                if sent_count > 0 and sent_count % 5 == 0:
-                    time.sleep(2)
+        for df in orders:
+            planned, batches = plan_batches(df, sent_orders, digest, flush, exclude=failed_keys)
+            planned_count += planned
+            if not batches:
+                continue
+
+            if sender is None:
+                sender = open_smtp_sender()
+                sender.start()
+            rendered = []
+            for batch in batches:
+                try:
+                    rendered.append((batch, render_batch(batch)))
+                except Exception as e:
+                    # One bad row must not hold up the rest of the batch
+                    failed_keys.update((n.order_id, n.notification_type) for n in batch)
+                    METRICS.inc('messages_failed_total', type=batch[0].notification_type)
+                    logging.error(f"Could not render the email for order #{batch[0].order_id} to {batch[0].customer_email}: {e}")
+                    continue
+                if len(rendered) >= RESERVE_BATCH_SIZE:
+                    submit_reserved(rendered)
+                    rendered = []
+            submit_reserved(rendered)
+            # Settle this chunk before planning the next one against the ledger
+            collect_sent(block=True)
+            sent_orders.flush()
     
     except Exception as e:
         logging.error(f"Error processing orders and sending notifications: {e}")
+    finally:
+        if sender is not None:
+            if owns_sender:
+                sender.close()
+            collect_sent(block=True)
+            if sent_count or failed_keys:
+                stats = sender.rate_limiter.stats()
+                logging.info(
+                    f"Send rate: {stats['current_rate']:.2f} of {stats['max_rate']:.2f} messages/second "
+                    f"({stats['utilization']:.0%}), {stats['deferrals']} deferrals"
+                )
+        if owns_ledger:
+            sent_orders.close()
+        else:
+            sent_orders.flush()
     
+    return sent_count, planned_count - sent_count
+
+def open_outbox():
+    """Open the outbox, which lives in the same database as the sent ledger"""
+    initialize_sent_orders_file()
+    return Outbox(
+        SENT_ORDERS_DB,
+        visibility_timeout=OUTBOX_VISIBILITY_TIMEOUT,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        retry_delay=OUTBOX_RETRY_DELAY,
+        max_retry_delay=OUTBOX_MAX_RETRY_DELAY,
+    )
+
+def enqueue_notifications(orders, outbox, digest=None, flush=False):
+    """Plan and render notifications into the outbox instead of sending them.
+
+    Takes the same ``orders`` and ``digest`` arguments as
+    process_and_send_notifications. Every chunk's emails are added to the
+    outbox in one transaction, for sender processes to deliver. Returns the
+    number of notifications queued and the number held for digests.
+    """
+    if hasattr(orders, 'columns'):
+        orders = [orders]
+    if digest is True:
+        digest = DigestBuffer()
+    elif digest is False:
+        digest = None
+    queued_count = 0
+    for df in orders:
+        _, batches = plan_batches(df, outbox, digest, flush)
+        messages = [
+            (
+                batch[0].notification_type if len(batch) == 1 else 'digest',
+                [(n.order_id, n.notification_type, n.customer_email) for n in batch],
+                render_batch(batch),
+            )
+            for batch in batches
+        ]
+        if messages:
+            outbox.enqueue(messages)
+            queued_count += sum(len(batch) for batch in batches)
+            METRICS.inc('outbox_enqueued_total', len(messages))
+            logging.info(f"Queued {len(messages)} emails in the outbox")
+    return queued_count, len(digest) if digest else 0
+
+def deliver_outbox(outbox, sender, stop=None, poll_interval=None):
+    """Send messages from the outbox until it is empty.
+
+    Messages are claimed a batch at a time and each one is acknowledged as
+    soon as the server accepts it. With ``stop`` and ``poll_interval`` the
+    outbox is polled for new messages until ``stop`` is set. Returns the
+    number of emails sent and the number that failed.
+    """
+    in_flight = deque()
+    sent_count = failed_count = 0
+
+    def settle(wait):
+        """Acknowledge finished sends, oldest first, waiting for the oldest if ``wait``"""
+        nonlocal sent_count, failed_count
+        while in_flight and (wait or in_flight[0][1].done()):
+            wait = False
+            message, future = in_flight.popleft()
+            recipients = ", ".join(message.email[1])
+            try:
+                future.result()
+            except Exception as e:
+                failed_count += 1
+                if isinstance(e, SMTPSetupError):
+                    # Nothing wrong with the message, so it keeps its attempt
+                    retry = outbox.release(message, e, attempted=False)
+                else:
+                    retry = outbox.release(message, e, permanent=is_permanent_failure(e))
+                METRICS.inc('messages_failed_total', type=message.kind)
+                outcome = "will retry" if retry else f"giving up after {message.attempts} attempts"
+                logging.error(f"Failed to send {message.kind} email {message.message_id} to {recipients} ({outcome}): {e}")
+                continue
+            sent_count += 1
+            METRICS.inc('messages_sent_total', type=message.kind)
+            if outbox.ack(message):
+                logging.info(f"Sent {message.kind} email {message.message_id} to {recipients}")
+            else:
+                logging.warning(f"Sent {message.kind} email {message.message_id} to {recipients}, but its claim had "
+                                f"expired and another sender has claimed it, so it may be sent twice; raise "
+                                f"OUTBOX_VISIBILITY_TIMEOUT if sends take this long")
+
+    while True:
+        stopping = stop is not None and stop.is_set()
+        if not stopping and len(in_flight) <= OUTBOX_CLAIM_SIZE // 2:
+            claimed = deque(outbox.claim(OUTBOX_CLAIM_SIZE - len(in_flight)))
+            while claimed:
+                try:
+                    future = sender.submit(claimed[0].email)
+                except SMTPSetupError as e:
+                    # Hand back what this sender claimed but cannot send, and stop
+                    for message in claimed:
+                        outbox.release(message, e, attempted=False)
+                    while in_flight:
+                        settle(wait=True)
+                    raise
+                in_flight.append((claimed.popleft(), future))
+                # Acknowledge as soon as possible, so a crash resends as little as possible
+                settle(wait=False)
+        if not in_flight:
+            if stopping or stop is None or poll_interval is None:
+                break
+            stop.wait(poll_interval)
+            continue
+        settle(wait=True)
+    return sent_count, failed_count
+
+def run_outbox_sender(interval=None):
+    """Deliver queued emails from the outbox; with an interval keep polling until SIGTERM or SIGINT"""
+    stop = stop_on_signals()
+    outbox = open_outbox()
+    sender = open_smtp_sender(keepalive_interval=SMTP_KEEPALIVE_INTERVAL if interval else None,
+                              processes=OUTBOX_SENDERS)
+    sender.start()
+    metrics_server = None
+    if METRICS_PORT and interval:
+        metrics_server = MetricsServer(METRICS, METRICS_PORT, METRICS_HOST)
+        metrics_server.start()
+    logging.info(f"Delivering emails from the outbox in {SENT_ORDERS_DB}")
+    sent_count = failed_count = 0
+    try:
+        sent_count, failed_count = deliver_outbox(outbox, sender, stop, poll_interval=interval)
+    except SMTPSetupError as e:
+        logging.error(f"Outbox sender stopping, fix the SMTP settings and start it again: {e}")
+    finally:
+        sender.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        counts = outbox.counts()
+        outbox.close()
+        report_metrics()
+        logging.info(
+            f"Outbox sender stopped. Sent {sent_count}, failed {failed_count}; "
+            f"outbox has {counts['ready']} ready, {counts['claimed']} claimed, {counts['retrying']} "
+            f"waiting to retry, {counts['failed']} failed"
+        )
     return sent_count
 
-def main():
+def order_shard(order_id, shard_count):
+    """Shard of an order: a stable hash of its order_id, the same in every process and run"""
+    return zlib.crc32(str(order_id).encode('utf-8')) % shard_count
+
+def shard_orders(df, shard, shard_count):
+    """Keep only the rows of the orders that belong to ``shard``"""
+    if isinstance(df, SheetRecords):
+        return SheetRecords(
+            [row for row in df if order_shard(row['order_id'], shard_count) == shard],
+            columns=df.columns,
+        )
+    if df.empty:
+        return df
+    return df.loc[[order_shard(order_id, shard_count) == shard for order_id in df['order_id'].astype(str).tolist()]]
+
+def run_shard(source, shard, shard_count, digest=False):
+    """Plan, render and send the notifications for one shard of the orders sheet.
+
+    Returns a summary with the shard's row, sent and unsent counts, its
+    run time and a snapshot of its metrics.
+    """
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f'%(asctime)s - %(levelname)s - [shard {shard}/{shard_count}] %(message)s'))
+    start = time.perf_counter()
+    rows = 0
+
+    def owned(df):
+        nonlocal rows
+        df = shard_orders(df, shard, shard_count)
+        rows += len(df)
+        return df
+
+    initialize_sent_orders_file()
+    if ORDERS_CHUNK_SIZE:
+        orders = (owned(chunk) for chunk in iter_orders_data(source, ORDERS_CHUNK_SIZE))
+    else:
+        orders = owned(load_orders_data(source))
+    # Every shard sends through the same account, so each gets its share of the rate and connections
+    sender = open_smtp_sender(processes=shard_count)
+    sender.start()
+    try:
+        sent_count, unsent_count = process_and_send_notifications(orders, sender=sender, digest=digest)
+    finally:
+        sender.close()
+    return {
+        'shard': shard,
+        'rows': rows,
+        'sent': sent_count,
+        'unsent': unsent_count,
+        'seconds': time.perf_counter() - start,
+        'metrics': METRICS.snapshot(),
+    }
+
+def _shard_worker(source, shard, shard_count, digest, results):
+    """Entry point of a worker process started by run_sharded"""
+    try:
+        results.put(run_shard(source, shard, shard_count, digest))
+    except Exception as e:
+        logging.error(f"Shard {shard}/{shard_count} failed: {e}")
+
+def log_shard_summary(summary):
+    stages = ", ".join(
+        f"{histogram['labels']['stage']} {histogram['sum']:.2f}s"
+        for histogram in summary['metrics']['histograms']
+        if histogram['name'] == 'stage_duration_seconds'
+    )
+    logging.info(
+        f"Shard {summary['shard']}: {summary['rows']} rows, {summary['sent']} sent, "
+        f"{summary['unsent']} not sent in {summary['seconds']:.2f}s ({stages})"
+    )
+
+def warn_in_doubt(ledger):
+    """Warn about notifications reserved by processes that stopped before recording whether they were sent"""
+    in_doubt = [row for row in ledger.reserved() if owner_alive(row[3]) is not True]
+    if not in_doubt:
+        return
+    owners = sorted({owner for _, _, _, owner in in_doubt})
+    logging.warning(
+        f"{len(in_doubt)} notifications were reserved by a process that stopped, or runs on another "
+        f"host, before recording whether they were sent ({', '.join(owners)}); they are not sent "
+        f"again. Check them and run with --release-reserved to plan those of stopped processes on this "
+        f"host again, or --release-reserved OWNER for a given owner."
+    )
+
+def release_reserved(ledger, owners):
+    """Release the reservations of ``owners``, or of every stopped process on this host.
+
+    Owners still running on this host are never released, as they may be
+    sending those notifications right now. Owners on another host are only
+    released when named, since whether they still run cannot be told from here.
+    """
+    held = {}
+    for row in ledger.reserved():
+        held.setdefault(row[3], []).append(row)
+    if owners:
+        candidates = owners
+    else:
+        candidates = [owner for owner in held if owner_alive(owner) is False]
+        remote = sorted(owner for owner in held if owner_alive(owner) is None)
+        if remote:
+            logging.warning(f"Not releasing reservations of owners whose state cannot be checked from this host "
+                            f"({', '.join(remote)}); name them after checking they have stopped")
+    release = []
+    for owner in candidates:
+        if owner_alive(owner):
+            logging.warning(f"Not releasing the reservations of {owner}: the process is still running")
+            continue
+        for order_id, notification_type, customer_email, _ in held.get(owner, []):
+            logging.info(f"Releasing {notification_type} for order #{order_id} to {customer_email}, reserved by {owner}")
+        release.append(owner)
+    logging.info(f"Released {ledger.release_reserved(release)} reserved notifications")
+
+def run_sharded(workers, digest=False):
+    """Fetch the orders sheet once and send its notifications from ``workers`` processes.
+
+    Each process handles the orders whose shard matches its own. The
+    per-shard counts, timings and metrics are gathered here. Returns the
+    number of notifications sent and the number not sent.
+    """
+    initialize_sent_orders_file()
+    with METRICS.timer('fetch'):
+        data = read_source(URL)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    summaries = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "orders.csv")
+        with open(source, 'wb') as f:
+            f.write(data)
+        del data
+        processes = [
+            context.Process(target=_shard_worker, args=(source, shard, workers, digest, results), name=f"shard-{shard}")
+            for shard in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        logging.info(f"Started {workers} shard workers")
+        # A worker that dies never reports, so stop waiting once every worker has exited
+        while len(summaries) < workers:
+            alive = any(process.is_alive() for process in processes)
+            try:
+                summary = results.get(timeout=0.5 if alive else 1)
+            except queue.Empty:
+                if not alive:
+                    break
+                continue
+            summaries[summary['shard']] = summary
+        for process in processes:
+            process.join()
+
+    sent_count = unsent_count = 0
+    for shard, process in enumerate(processes):
+        summary = summaries.get(shard)
+        if summary is None:
+            logging.error(f"Shard {shard} did not finish (exit code {process.exitcode})")
+            continue
+        log_shard_summary(summary)
+        METRICS.merge(summary['metrics'])
+        sent_count += summary['sent']
+        unsent_count += summary['unsent']
+
+    with SentLedger(SENT_ORDERS_DB) as ledger:
+        warn_in_doubt(ledger)
+    logging.info(f"All shards finished: {sent_count} sent, {unsent_count} not sent")
+    return sent_count, unsent_count
+
+def report_metrics():
+    """Log the time spent in each stage and export the metrics when METRICS_DIR is set"""
+    summary = METRICS.stage_summary()
+    if summary:
+        logging.info(f"Time per stage (total/calls): {summary}")
+    if METRICS_DIR:
+        METRICS.write(METRICS_DIR)
+
+def stop_on_signals():
+    """Return an Event that is set on SIGTERM or SIGINT"""
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info(f"Received signal {signum}, shutting down after the current poll")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    return stop
+
+def run_daemon(interval, digest=False, outbox=False):
+    """Poll the orders sheet every ``interval`` seconds until SIGTERM or SIGINT.
+
+    The ledger, sheet snapshot and SMTP sessions are set up once and reused
+    by every poll; idle SMTP sessions are kept open with NOOP keepalives.
+    In digest mode a customer's updates are collected for DIGEST_WINDOW
+    seconds and sent as one email; held digests are sent on shutdown.
+    With ``outbox`` the emails are queued in the outbox for sender
+    processes (see run_outbox_sender) instead of being sent.
+    """
+    stop = stop_on_signals()
+
+    logging.info(f"Starting order notification daemon, polling every {interval} seconds")
+    initialize_sent_orders_file()
+    cache = SheetSnapshotCache(SHEET_CACHE_DIR or DAEMON_CACHE_DIR)
+    sender = None
+    if outbox:
+        sent_orders = open_outbox()
+    else:
+        sent_orders = SentLedger(SENT_ORDERS_DB, cache_keys=True)
+        sender = open_smtp_sender(keepalive_interval=SMTP_KEEPALIVE_INTERVAL)
+        sender.start()
+
+    def process(df, flush=False):
+        if outbox:
+            return enqueue_notifications(df, sent_orders, digest=digest, flush=flush)
+        return process_and_send_notifications(df, sent_orders, sender, digest=digest, flush=flush)
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS, METRICS_PORT, METRICS_HOST)
+        metrics_server.start()
+    digest = DigestBuffer(DIGEST_WINDOW) if digest else None
+    total_sent = 0
+    try:
+        while not stop.is_set():
+            df, changes = load_changed_orders(URL, cache)
+            if changes is not None and changes.unchanged:
+                changes.commit()
+            if not df.empty or digest:
+                sent_count, unsent_count = process(df)
+                total_sent += sent_count
+                # Rows behind held digests stay uncommitted so a restart plans them again
+                if changes is not None and not changes.unchanged and unsent_count == 0:
+                    changes.commit()
+            if sender is not None and sender.setup_error is not None:
+                logging.error(f"Daemon stopping, fix the SMTP settings and start it again: {sender.setup_error}")
+                break
+            stop.wait(interval)
+    finally:
+        if digest:
+            sent_count, _ = process(SheetRecords(), flush=True)
+            total_sent += sent_count
+        if sender is not None:
+            sender.close()
+        sent_orders.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        report_metrics()
+        action = "notifications queued" if outbox else "emails sent"
+        logging.info(f"Order notification daemon stopped. Total {action}: {total_sent}")
+
+def parse_shard(text):
+    """Parse --shard INDEX/COUNT, e.g. 0/4"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, e.g. 0/4, not {text!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
+
+def main(argv=None):
     """Main function"""
+    parser = argparse.ArgumentParser(description="Send order notification emails")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and poll the sheet instead of exiting after one pass")
+    parser.add_argument("--interval", type=float, default=DAEMON_POLL_INTERVAL,
+                        help="seconds between polls in daemon mode (default: %(default)s)")
+    parser.add_argument("--digest", action="store_true", default=DIGEST_MODE,
+                        help="send each customer one email covering all of their updates")
+    parser.add_argument("--outbox", action="store_true",
+                        help="queue the emails in the outbox for sender processes instead of sending them")
+    parser.add_argument("--send-outbox", action="store_true",
+                        help="send the emails queued in the outbox; with --daemon keep polling it for new ones")
+    parser.add_argument("--workers", type=int, default=ORDER_WORKERS,
+                        help="split the orders by order_id across this many worker processes (default: %(default)s)")
+    parser.add_argument("--shard", type=parse_shard, metavar="INDEX/COUNT",
+                        help="only handle one shard of the orders, e.g. 0/4 in the first of four processes; "
+                             "all of them must run on the host that holds the ledger")
+    parser.add_argument("--release-reserved", nargs="*", metavar="OWNER",
+                        help="forget notifications left reserved by a crashed worker so they are planned again: "
+                             "those of the given owners, or without any, of every stopped process on this host")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="forget notifications that failed permanently, e.g. after fixing an address, so they are planned again")
+    add_profiling_arguments(parser, PROFILE_DIR)
+    args = parser.parse_args(argv)
+
+    with profiled(METRICS, args.profile_dir, "order_fulfill",
+                  cpu=args.profile, memory=args.profile_memory, report=logging.info):
+        run(args, parser)
+
+def run(args, parser):
+    """Run the mode chosen on the command line"""
+    sharded = args.workers > 1 or args.shard is not None
+    if sharded and (args.daemon or args.outbox or args.send_outbox):
+        parser.error("--workers and --shard cannot be combined with --daemon, --outbox or --send-outbox")
+    if args.release_reserved is None and not args.retry_failed:
+        initialize_sent_orders_file()
+        with SentLedger(SENT_ORDERS_DB) as ledger:
+            warn_in_doubt(ledger)
+    if args.release_reserved is not None:
+        with SentLedger(SENT_ORDERS_DB) as ledger:
+            release_reserved(ledger, args.release_reserved)
+        return
+    if args.retry_failed:
+        with SentLedger(SENT_ORDERS_DB) as ledger:
+            for order_id, notification_type, customer_email, error in ledger.failed():
+                logging.info(f"Retrying {notification_type} for order #{order_id} to {customer_email}, failed with: {error}")
+            logging.info(f"Released {ledger.release_failed()} failed notifications")
+        return
+    if sharded:
+        try:
+            if args.shard is not None:
+                log_shard_summary(run_shard(URL, *args.shard, digest=args.digest))
+            else:
+                run_sharded(args.workers, digest=args.digest)
+        except Exception as e:
+            logging.error(f"Error in main process: {e}")
+        finally:
+            report_metrics()
+        return
+    if args.daemon and args.outbox and args.send_outbox:
+        parser.error("run the planner (--outbox --daemon) and senders (--send-outbox --daemon) as separate processes")
+    if args.send_outbox and not args.outbox:
+        run_outbox_sender(args.interval if args.daemon else None)
+        return
+    if args.daemon:
+        run_daemon(args.interval, digest=args.digest, outbox=args.outbox)
+        return
+
     try:
         start_time = datetime.datetime.now()
         logging.info("Starting order notification process")
         
-        # Initialize tracking file if it doesn't exist
+        # Initialize the ledger if it doesn't exist
         initialize_sent_orders_file()
         
         # Load orders data from Google Sheet
-        df = load_orders_data(URL)
+        changes = None
+        if SHEET_CACHE_DIR:
+            df, changes = load_changed_orders(URL, SheetSnapshotCache(SHEET_CACHE_DIR))
+            if changes is not None and changes.unchanged:
+                logging.info("No new or changed orders since the last run")
+                changes.commit()
+                return
+        elif ORDERS_CHUNK_SIZE:
+            df = iter_orders_data(URL, ORDERS_CHUNK_SIZE)
+        else:
+            df = load_orders_data(URL)
         
-        if df.empty:
+        if hasattr(df, 'empty') and df.empty:
             logging.warning("No orders data loaded. Please check your Google Sheet URL.")
             return
         
-        # Process orders and send notifications
-        sent_count = process_and_send_notifications(df)
+        if args.outbox:
+            # Queue the emails, then optionally send them from the outbox in this process
+            with open_outbox() as outbox:
+                queued_count, unsent_count = enqueue_notifications(df, outbox, digest=args.digest)
+                totals = f"Total notifications queued: {queued_count}"
+                if args.send_outbox:
+                    sender = open_smtp_sender(processes=OUTBOX_SENDERS)
+                    sender.start()
+                    try:
+                        sent_count, failed_count = deliver_outbox(outbox, sender)
+                    finally:
+                        sender.close()
+                    totals += f", emails delivered from the outbox: {sent_count}, failed: {failed_count}"
+        else:
+            # Process orders and send notifications
+            sent_count, unsent_count = process_and_send_notifications(df, digest=args.digest)
+            totals = f"Total emails sent: {sent_count}"
+        
+        # Only skip these rows next time if every notification for them went out
+        if changes is not None and unsent_count == 0:
+            changes.commit()
         
         end_time = datetime.datetime.now()
         duration = (end_time - start_time).total_seconds()
         
         logging.info(f"Order notification process completed in {duration:.2f} seconds")
-        logging.info(f"Total emails sent: {sent_count}")
+        logging.info(totals)
         
     except Exception as e:
         logging.error(f"Error in main process: {e}")
+    finally:
+        report_metrics()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
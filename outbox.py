@@ -0,0 +1,253 @@
+import json
+import time
+import uuid
+import sqlite3
+import contextlib
+from collections import namedtuple
+
+from sent_ledger import ensure_schema
+from sqlite_helpers import find_keys, now_text
+from smtp_pool import backoff_delay
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    message_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    from_addr TEXT NOT NULL,
+    to_addrs TEXT NOT NULL,
+    data BLOB,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    visible_at REAL NOT NULL,
+    claim_token TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_ready
+    ON outbox (visible_at) WHERE state = 'pending';
+CREATE TABLE IF NOT EXISTS outbox_notifications (
+    order_id TEXT NOT NULL,
+    notification_type TEXT NOT NULL,
+    customer_email TEXT,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (order_id, notification_type)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS outbox_notifications_message
+    ON outbox_notifications (message_id);
+"""
+
+# A message claimed by a sender; ``email`` is a (from_addr, to_addrs, data) tuple
+OutboxMessage = namedtuple('OutboxMessage', ['message_id', 'claim_token', 'attempts', 'kind', 'email'])
+
+
+class Outbox:
+    """Durable queue of rendered emails between the planner and any number of senders.
+
+    The planner adds rendered messages in bulk together with the
+    (order_id, notification_type) keys each one covers. Senders, in this or
+    other processes, claim a batch, send it and acknowledge each message.
+    A claimed message is hidden for ``visibility_timeout`` seconds; if its
+    sender dies without acknowledging it, another sender claims it again
+    once the timeout has passed.
+
+    The outbox shares its SQLite file with the sent ledger (see
+    sent_ledger.SentLedger): acknowledging a message records its keys as
+    sent and removes it from the outbox in the same transaction, so nothing
+    is lost between the SMTP server accepting a message and the ledger
+    recording it.
+    """
+
+    def __init__(self, path, visibility_timeout=300, max_attempts=5, retry_delay=60, max_retry_delay=3600):
+        self.path = str(path)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # Transactions are explicit, so claims can take the write lock before reading
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            ensure_schema(self._conn)
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self._conn.execute(statement)
+            # Sent messages used to be kept; the sent ledger already records their notifications
+            self._conn.execute(
+                "DELETE FROM outbox_notifications WHERE message_id IN "
+                "(SELECT message_id FROM outbox WHERE state = ?)",
+                (SENT,),
+            )
+            self._conn.execute("DELETE FROM outbox WHERE state = ?", (SENT,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def enqueue(self, messages):
+        """Add messages in one transaction and return how many were added.
+
+        ``messages`` is an iterable of (kind, notifications, email) where
+        ``notifications`` are the (order_id, notification_type, customer_email)
+        covered by the message and ``email`` is a (from_addr, to_addrs, data) tuple.
+        """
+        now = time.time()
+        count = 0
+        with self._transaction():
+            for kind, notifications, (from_addr, to_addrs, data) in messages:
+                cur = self._conn.execute(
+                    "INSERT INTO outbox (kind, from_addr, to_addrs, data, state, visible_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kind, from_addr, json.dumps(list(to_addrs)), data, PENDING, now, now_text(), now_text()),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO outbox_notifications "
+                    "(order_id, notification_type, customer_email, message_id) VALUES (?, ?, ?, ?)",
+                    [(str(order_id), notification_type, customer_email, cur.lastrowid)
+                     for order_id, notification_type, customer_email in notifications],
+                )
+                count += 1
+        return count
+
+    def sent_keys(self, keys):
+        """Return the (order_id, notification_type) keys already sent or waiting in the outbox.
+
+        Has the same signature as SentLedger.sent_keys, so the planner can
+        plan against the outbox and never queue a notification twice.
+        """
+        by_type = {}
+        for order_id, notification_type in keys:
+            by_type.setdefault(notification_type, set()).add(str(order_id))
+        return (find_keys(self._conn, 'sent_notifications', by_type)
+                | find_keys(self._conn, 'outbox_notifications', by_type))
+
+    def claim(self, limit, now=None):
+        """Claim up to ``limit`` messages that are ready to send, oldest first"""
+        now = time.time() if now is None else now
+        token = uuid.uuid4().hex
+        with self._transaction():
+            rows = self._conn.execute(
+                "SELECT message_id, attempts, kind, from_addr, to_addrs, data FROM outbox "
+                "WHERE state = 'pending' AND visible_at <= ? ORDER BY visible_at, message_id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, visible_at = ?, claim_token = ?, updated_at = ? "
+                "WHERE message_id = ?",
+                [(now + self.visibility_timeout, token, now_text(), row[0]) for row in rows],
+            )
+        return [
+            OutboxMessage(message_id, token, attempts + 1, kind, (from_addr, json.loads(to_addrs), data))
+            for message_id, attempts, kind, from_addr, to_addrs, data in rows
+        ]
+
+    def ack(self, message):
+        """Record a claimed message's notifications in the sent ledger and remove it from the outbox.
+
+        Returns False, changing nothing, if the message is no longer held
+        under this claim: its visibility timeout ran out and another sender
+        claimed it, so that sender records the outcome.
+        """
+        with self._transaction():
+            cur = self._conn.execute(
+                "DELETE FROM outbox WHERE message_id = ? AND claim_token = ?",
+                (message.message_id, message.claim_token),
+            )
+            if not cur.rowcount:
+                return False
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sent_notifications "
+                "(order_id, notification_type, customer_email, sent_timestamp) "
+                "SELECT order_id, notification_type, customer_email, ? FROM outbox_notifications "
+                "WHERE message_id = ?",
+                (now_text(), message.message_id),
+            )
+            self._conn.execute("DELETE FROM outbox_notifications WHERE message_id = ?", (message.message_id,))
+        return True
+
+    def release(self, message, error, permanent=False, attempted=True):
+        """Return a message whose send failed to the queue.
+
+        It becomes visible again after a backoff that starts at
+        ``retry_delay`` seconds and doubles with every attempt, up to
+        ``max_retry_delay``. After ``max_attempts`` it is marked failed and
+        its notifications are forgotten, so the next planning run queues
+        them afresh. A ``permanent`` failure, such as a rejected address,
+        is marked failed at once and its notifications are recorded as
+        failed in the sent ledger, so they are not queued again. A message
+        that was not ``attempted``, e.g. because the SMTP session could not
+        be set up, is ready again at once and gets its attempt back. Returns
+        True if the message will be retried. A message that has since been
+        claimed by another sender is left alone.
+        """
+        retry = not permanent and message.attempts < self.max_attempts
+        with self._transaction():
+            if not attempted:
+                self._conn.execute(
+                    "UPDATE outbox SET attempts = attempts - 1, visible_at = ?, claim_token = NULL, "
+                    "updated_at = ?, error = ? WHERE message_id = ? AND claim_token = ?",
+                    (time.time(), now_text(), str(error), message.message_id, message.claim_token),
+                )
+                return True
+            if retry:
+                delay = backoff_delay(message.attempts, self.retry_delay, self.max_retry_delay)
+                cur = self._conn.execute(
+                    "UPDATE outbox SET visible_at = ?, claim_token = NULL, updated_at = ?, error = ? "
+                    "WHERE message_id = ? AND claim_token = ?",
+                    (time.time() + delay, now_text(), str(error), message.message_id, message.claim_token),
+                )
+            else:
+                cur = self._conn.execute(
+                    "UPDATE outbox SET state = ?, data = NULL, claim_token = NULL, updated_at = ?, error = ? "
+                    "WHERE message_id = ? AND claim_token = ?",
+                    (FAILED, now_text(), str(error), message.message_id, message.claim_token),
+                )
+                if cur.rowcount and permanent:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO sent_notifications "
+                        "(order_id, notification_type, customer_email, sent_timestamp, state, error) "
+                        "SELECT order_id, notification_type, customer_email, ?, 'failed', ? FROM outbox_notifications "
+                        "WHERE message_id = ?",
+                        (now_text(), str(error), message.message_id),
+                    )
+                if cur.rowcount:
+                    self._conn.execute(
+                        "DELETE FROM outbox_notifications WHERE message_id = ?",
+                        (message.message_id,),
+                    )
+        return retry
+
+    def counts(self, now=None):
+        """Return the number of messages that are ready, claimed, waiting to retry and failed"""
+        now = time.time() if now is None else now
+        counts = {'ready': 0, 'claimed': 0, 'retrying': 0, FAILED: 0}
+        cur = self._conn.execute(
+            "SELECT CASE WHEN state != 'pending' THEN state WHEN visible_at <= ? THEN 'ready' "
+            "WHEN claim_token IS NOT NULL THEN 'claimed' ELSE 'retrying' END, COUNT(*) "
+            "FROM outbox GROUP BY 1",
+            (now,),
+        )
+        counts.update(cur.fetchall())
+        return counts
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
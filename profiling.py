@@ -0,0 +1,229 @@
+import os
+import sys
+import pstats
+import cProfile
+import logging
+import datetime
+import threading
+import tracemalloc
+import contextlib
+from pathlib import Path
+
+# Functions and allocation sites listed in the reports, and in the short summary
+TOP_ENTRIES = 25
+SUMMARY_ENTRIES = 8
+
+# Frames of each allocation's traceback kept by tracemalloc. Reports group allocations by the
+# line that made them, which needs one; every extra frame slows traced code down further
+TRACE_FRAMES = 1
+
+# A stage's allocation snapshot is only retaken once traced memory has grown this much past it,
+# so a stage that runs once per message takes a handful of snapshots, not one per message
+SNAPSHOT_GROWTH = 1.25
+
+# Up to Python 3.11 a cProfile profiler covers one thread. From 3.12 it is built on
+# sys.monitoring, which allows a single profiler per process that sees every thread
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+# Allocations made by the profiler itself are left out of the reports
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def add_profiling_arguments(parser, default_dir):
+    """Add the --profile, --profile-memory and --profile-dir options to an ArgumentParser"""
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the run's CPU time with cProfile, in every thread: one profiler per "
+                             "thread up to Python 3.11, one profiler for the whole process from 3.12")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="trace memory allocations with tracemalloc and report the top sites of each stage")
+    parser.add_argument("--profile-dir", default=default_dir,
+                        help="directory for the profile reports, one subdirectory per run (default: %(default)s)")
+
+
+class RunProfiler:
+    """Profile one run of a script and write its reports to a directory of their own.
+
+    With ``cpu`` the run is profiled by cProfile. Up to Python 3.11 each
+    thread started after start(), like the SMTP sender threads, gets a
+    profiler of its own. From 3.12 cProfile allows only one profiler per
+    process, which already sees every thread, so only that one is started.
+
+    With ``memory`` tracemalloc traces every allocation, and at the end of
+    each stage (see stage(), called by MetricsRegistry.timer) a snapshot
+    shows the top allocation sites and how they grew since the run started.
+    Traced memory is process-wide, so a stage's snapshot includes whatever
+    other threads are holding at the time.
+
+    finish() writes into ``<directory>/<name>-<timestamp>-<pid>/``:
+
+    - cpu.prof, for python -m pstats or any pstats viewer
+    - cpu.txt, the top functions by own and by cumulative time
+    - memory-<stage>.txt, the top allocation sites at the end of each stage
+    - summary.txt, the short version of all of the above
+    """
+
+    def __init__(self, directory, name, cpu=True, memory=False, top=TOP_ENTRIES):
+        self.directory = Path(directory)
+        self.name = name
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.run_dir = None
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._main_profile = None
+        self._started_tracing = False
+        self._baseline = None
+        # stage -> traced bytes when its snapshot was taken, peak traced bytes and snapshot
+        self._stages = {}
+
+    def _profile_thread(self, frame, event, arg):
+        # Installed with threading.setprofile: runs once in each new thread and replaces itself
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active; leave this thread unprofiled rather than kill it
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.run_dir = self.directory / f"{self.name}-{timestamp}-{os.getpid()}"
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+                self._started_tracing = True
+            self._baseline = tracemalloc.take_snapshot()
+        if self.cpu:
+            if PER_THREAD_PROFILES:
+                threading.setprofile(self._profile_thread)
+            self._main_profile = cProfile.Profile()
+            try:
+                self._main_profile.enable()
+            except ValueError as e:
+                logging.warning(f"Not profiling CPU time: {e}")
+                threading.setprofile(None)
+                self.cpu = False
+            else:
+                self._profiles.append(self._main_profile)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Note the traced memory at the end of a stage, snapshotting it when it has grown"""
+        try:
+            yield
+        finally:
+            if self.memory and tracemalloc.is_tracing():
+                self._after_stage(name)
+
+    def _after_stage(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            stage = self._stages.setdefault(name, {'calls': 0, 'traced': 0, 'peak': 0, 'snapshot': None})
+            stage['calls'] += 1
+            stage['peak'] = max(stage['peak'], peak)
+            if stage['traced'] and current < stage['traced'] * SNAPSHOT_GROWTH:
+                return
+            # Claimed before snapshotting, so concurrent threads do not snapshot the same growth
+            stage['traced'] = current
+        # Filtering is done in Python and slow, so it waits for finish()
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            stage['snapshot'] = snapshot
+
+    def finish(self):
+        """Stop profiling, write the reports and return the summary text"""
+        if self.cpu:
+            self._main_profile.disable()
+            if PER_THREAD_PROFILES:
+                threading.setprofile(None)
+        if self.memory and self._started_tracing:
+            tracemalloc.stop()
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+
+        summary = [f"Profile of {self.name} written to {self.run_dir}"]
+        if self.cpu:
+            summary += self._write_cpu_report()
+        if self.memory:
+            summary += self._write_memory_reports()
+        text = "\n".join(summary) + "\n"
+        (self.run_dir / "summary.txt").write_text(text, encoding='utf-8')
+        return text
+
+    def _write_cpu_report(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.run_dir / "cpu.prof")
+        threads = f"{len(profiles)} threads" if PER_THREAD_PROFILES else "all threads"
+
+        with open(self.run_dir / "cpu.txt", 'w', encoding='utf-8') as f:
+            stats.stream = f
+            f.write(f"{threads} profiled\n\nBy own time:\n")
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+            f.write("By cumulative time:\n")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+
+        # stats.stats maps (file, line, function) to (calls, primitive calls, own time, cumulative time, callers)
+        by_own_time = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        lines = [f"Top functions by own time ({stats.total_tt:.2f}s profiled in {threads}):"]
+        for (filename, line, function), (_, calls, own, cumulative, _) in by_own_time[:SUMMARY_ENTRIES]:
+            location = f"{Path(filename).name}:{line}" if line else filename
+            lines.append(f"  {own:8.3f}s own {cumulative:8.3f}s cumulative {calls:>9} calls  {function} ({location})")
+        return lines
+
+    def _write_memory_reports(self):
+        with self._lock:
+            stages = dict(self._stages)
+        baseline = self._baseline.filter_traces(_SNAPSHOT_FILTERS)
+        lines = []
+        for name, stage in stages.items():
+            if stage['snapshot'] is None:
+                continue
+            snapshot = stage['snapshot'].filter_traces(_SNAPSHOT_FILTERS)
+            top_sites = snapshot.statistics('lineno')
+            grown = snapshot.compare_to(baseline, 'lineno')
+            with open(self.run_dir / f"memory-{name}.txt", 'w', encoding='utf-8') as f:
+                f.write(f"{name}: {stage['calls']} calls, {stage['traced'] / 1e6:.1f}MB traced at the snapshot, "
+                        f"{stage['peak'] / 1e6:.1f}MB peak so far\n\nTop allocation sites:\n")
+                f.writelines(f"  {statistic}\n" for statistic in top_sites[:self.top])
+                f.write("\nGrowth since the run started:\n")
+                f.writelines(f"  {statistic}\n" for statistic in grown[:self.top])
+            lines.append(f"Top allocation sites after {name} ({stage['traced'] / 1e6:.1f}MB traced, "
+                         f"{stage['peak'] / 1e6:.1f}MB peak so far):")
+            for statistic in top_sites[:SUMMARY_ENTRIES]:
+                frame = statistic.traceback[0]
+                lines.append(f"  {statistic.size / 1e6:8.1f}MB {statistic.count:>9} blocks  "
+                             f"{Path(frame.filename).name}:{frame.lineno}")
+        return lines
+
+
+@contextlib.contextmanager
+def profiled(registry, directory, name, cpu=False, memory=False, report=print):
+    """Profile the block when ``cpu`` or ``memory`` is set, hooking into the registry's stage timers.
+
+    The summary is passed to ``report`` at the end, even if the block
+    raises. With neither set this does nothing, so the run costs the same
+    as without profiling.
+    """
+    if not (cpu or memory):
+        yield None
+        return
+    profiler = RunProfiler(directory, name, cpu=cpu, memory=memory)
+    profiler.start()
+    registry.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        registry.profiler = None
+        report(profiler.finish())
@@ -0,0 +1,86 @@
+import threading
+import time
+
+
+class AdaptiveRateLimiter:
+    """Token bucket that adapts its rate to SMTP server feedback.
+
+    Tokens refill at ``current_rate`` messages per second, up to ``burst``
+    tokens. A temporary failure (421/45x deferral) cuts the rate
+    multiplicatively; every success adds back a small step until the
+    configured ``max_rate`` is reached again.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None,
+                 decrease_factor=0.5, increase_step=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.min_rate = float(min_rate if min_rate is not None else self.max_rate / 20)
+        self.burst = max(1.0, float(burst))
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step if increase_step is not None else self.max_rate / 50
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._rate = min(float(rate), self.max_rate)
+        self._tokens = self.burst
+        self._updated = clock()
+        self._last_decrease = None
+        self.successes = 0
+        self.deferrals = 0
+
+    @property
+    def current_rate(self):
+        """Messages per second currently allowed"""
+        return self._rate
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a message may be sent"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            self._sleep(wait)
+
+    def on_success(self):
+        """Recover the rate gradually after a message was accepted"""
+        with self._lock:
+            self.successes += 1
+            self._rate = min(self.max_rate, self._rate + self.increase_step)
+
+    def on_deferral(self):
+        """Slow down after the server deferred a message with a 4xx reply"""
+        with self._lock:
+            self.deferrals += 1
+            now = self._clock()
+            # Deferrals for messages already in flight belong to the same burst;
+            # only cut the rate once per refill interval.
+            if self._last_decrease is not None and now - self._last_decrease < 1 / self._rate:
+                return
+            self._last_decrease = now
+            self._refill(now)
+            self._rate = max(self.min_rate, self._rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+
+    def stats(self):
+        """Return the current rate and counters"""
+        with self._lock:
+            return {
+                'current_rate': self._rate,
+                'max_rate': self.max_rate,
+                'utilization': self._rate / self.max_rate,
+                'successes': self.successes,
+                'deferrals': self.deferrals,
+            }
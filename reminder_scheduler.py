@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import threading
+import datetime
+from concurrent.futures import Future, wait
+
+
+class ReminderScheduler:
+    """Timer loop over a priority queue of reminder jobs.
+
+    Jobs are kept in a heap ordered by their target time. The loop sleeps
+    until the earliest job is due (or a new job arrives), then hands every
+    due job to ``dispatch(job_id, payload)`` at once. ``dispatch`` returns
+    a Future, so slow sends never hold up the jobs behind them; if it
+    raises, that job is recorded as failed and the others go ahead. Jobs can be
+    added, replaced or cancelled while the loop is running; replaced and
+    cancelled entries are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self, dispatch, clock=datetime.datetime.now):
+        self._dispatch = dispatch
+        self._clock = clock
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._in_flight = set()
+        self._stopped = False
+        # Seconds between each job's target time and the server accepting it
+        self.lateness = {}
+        self.failed = {}
+
+    def schedule(self, job_id, when, payload):
+        """Add a job, or move an existing pending job to a new time"""
+        with self._cond:
+            seq = next(self._seq)
+            self._jobs[job_id] = (when, seq, payload)
+            heapq.heappush(self._heap, (when, seq, job_id))
+            self._cond.notify()
+
+    def cancel(self, job_id):
+        """Cancel a pending job; returns False if it was not pending"""
+        with self._cond:
+            return self._jobs.pop(job_id, None) is not None
+
+    def is_pending(self, job_id):
+        with self._cond:
+            return job_id in self._jobs
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def stop(self):
+        """Stop the loop without dispatching the remaining jobs; returns False if it was already stopped"""
+        with self._cond:
+            stopping = not self._stopped
+            self._stopped = True
+            self._cond.notify()
+        return stopping
+
+    def _drop_stale(self):
+        while self._heap:
+            when, seq, job_id = self._heap[0]
+            job = self._jobs.get(job_id)
+            if job is not None and job[1] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            when, seq, job_id = heapq.heappop(self._heap)
+            due.append((job_id, *self._jobs.pop(job_id)))
+            self._drop_stale()
+        return due
+
+    def _job_done(self, job_id, when, future):
+        error = future.exception()
+        if error is not None:
+            self.failed[job_id] = error
+        else:
+            self.lateness[job_id] = (self._clock() - when).total_seconds()
+
+    def run(self, refresh=None, refresh_interval=None):
+        """Dispatch jobs as they fall due until none are left.
+
+        If ``refresh`` is given it is called every ``refresh_interval``
+        seconds while the loop waits, so it can schedule or cancel jobs.
+        Returns once every dispatched job has finished.
+        """
+        next_refresh = None
+        if refresh is not None and refresh_interval:
+            next_refresh = self._clock() + datetime.timedelta(seconds=refresh_interval)
+
+        while True:
+            with self._cond:
+                now = self._clock()
+                due = [] if self._stopped else self._pop_due(now)
+                if not due:
+                    if self._stopped or not self._heap:
+                        break
+                    wake_at = self._heap[0][0]
+                    if next_refresh is not None:
+                        wake_at = min(wake_at, next_refresh)
+                    if wake_at > now:
+                        self._cond.wait((wake_at - now).total_seconds())
+
+            for job_id, when, _, payload in due:
+                try:
+                    future = self._dispatch(job_id, payload)
+                except Exception as e:
+                    # A job that cannot even be dispatched fails on its own
+                    future = Future()
+                    future.set_exception(e)
+                self._in_flight.add(future)
+                future.add_done_callback(lambda f, job_id=job_id, when=when: self._job_done(job_id, when, f))
+
+            if next_refresh is not None and self._clock() >= next_refresh:
+                refresh()
+                next_refresh = self._clock() + datetime.timedelta(seconds=refresh_interval)
+
+        wait(self._in_flight)
+        self._in_flight = set()
+
+    def lateness_summary(self):
+        """Return count, median, p95, p99 and max lateness in seconds"""
+        values = sorted(self.lateness.values())
+        if not values:
+            return {'count': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+        return {
+            'count': len(values),
+            'p50': values[(len(values) - 1) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+            'max': values[-1],
+        }
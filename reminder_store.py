@@ -0,0 +1,187 @@
+import json
+import sqlite3
+import threading
+import datetime
+
+from sqlite_helpers import now_text, select_in
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminder_jobs (
+    job_id TEXT PRIMARY KEY,
+    scheduled_time TEXT NOT NULL,
+    event_time TEXT NOT NULL,
+    event_details TEXT,
+    recipients TEXT,
+    state TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS reminder_jobs_pending
+    ON reminder_jobs (scheduled_time) WHERE state = 'pending';
+CREATE TABLE IF NOT EXISTS reminder_recipients (
+    job_id TEXT NOT NULL,
+    address TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (job_id, address)
+);
+"""
+
+
+class ReminderJob:
+    """One reminder: the event it is for, when to send it and to whom.
+
+    Slotted rather than a dict, since a sheet can hold a million of them.
+    ``recipients`` are (name, address) pairs; empty means the default
+    receiver.
+    """
+
+    __slots__ = ('event_details', 'scheduled_time', 'event_time', 'recipients')
+
+    def __init__(self, event_details, scheduled_time, event_time, recipients=()):
+        self.event_details = event_details
+        self.scheduled_time = scheduled_time
+        self.event_time = event_time
+        self.recipients = recipients
+
+    def __repr__(self):
+        return (f"ReminderJob({self.event_details!r}, scheduled_time={self.scheduled_time!r}, "
+                f"event_time={self.event_time!r}, recipients={self.recipients!r})")
+
+
+class ReminderStore:
+    """On-disk record of every reminder job and whether it is pending, sent or failed.
+
+    Pending jobs are covered by a partial index, so reloading them after a
+    restart costs O(pending) no matter how many reminders have been sent.
+    Each recipient of a job is recorded once the server has accepted the
+    reminder for them or refused them for good, so a job that is sent again
+    only goes to the recipients still without an outcome.
+    The store is shared by the scheduler thread and the send callbacks,
+    so every call takes a lock.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(reminder_jobs)")}
+        if 'recipients' not in columns:
+            # Stores written before reminders had their own recipients
+            self._conn.execute("ALTER TABLE reminder_jobs ADD COLUMN recipients TEXT")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add_pending(self, jobs):
+        """Record new jobs as pending; jobs the store already knows keep their state"""
+        now = now_text()
+        rows = [
+            (
+                job_id,
+                str(job.scheduled_time),
+                str(job.event_time),
+                job.event_details,
+                json.dumps(job.recipients) if job.recipients else None,
+                PENDING,
+                now,
+            )
+            for job_id, job in jobs.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO reminder_jobs "
+                "(job_id, scheduled_time, event_time, event_details, recipients, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def states(self, job_ids):
+        """Return {job_id: state} for the given jobs that the store knows about"""
+        with self._lock:
+            return dict(select_in(self._conn, "SELECT job_id, state FROM reminder_jobs WHERE job_id IN ({})", job_ids))
+
+    def pending_jobs(self):
+        """Return {job_id: ReminderJob} for every pending job, earliest first"""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT job_id, scheduled_time, event_time, event_details, recipients FROM reminder_jobs "
+                "WHERE state = 'pending' ORDER BY scheduled_time"
+            )
+            rows = cur.fetchall()
+        return {
+            job_id: ReminderJob(
+                event_details,
+                datetime.datetime.fromisoformat(scheduled_time),
+                datetime.datetime.fromisoformat(event_time),
+                tuple(tuple(recipient) for recipient in json.loads(recipients or "[]")),
+            )
+            for job_id, scheduled_time, event_time, event_details, recipients in rows
+        }
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM reminder_jobs WHERE state = 'pending'"
+            ).fetchone()[0]
+
+    def _set_state(self, job_id, state, error=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE reminder_jobs SET state = ?, updated_at = ?, error = ? WHERE job_id = ?",
+                (state, now_text(), error, job_id),
+            )
+
+    def mark_sent(self, job_id):
+        self._set_state(job_id, SENT)
+
+    def mark_failed(self, job_id, error):
+        self._set_state(job_id, FAILED, str(error))
+
+    def record_recipients(self, job_id, delivered, failed):
+        """Record the recipients of a job that were sent the reminder, and those refused for good
+        as {address: error}"""
+        now = now_text()
+        rows = [(job_id, address, SENT, now, None) for address in delivered]
+        rows += [(job_id, address, FAILED, now, str(error)) for address, error in failed.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO reminder_recipients (job_id, address, state, updated_at, error) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def recipient_states(self, job_id):
+        """Return {address: state} for the recipients of a job recorded so far"""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT address, state FROM reminder_recipients WHERE job_id = ?", (job_id,)
+            )
+            return dict(cur.fetchall())
+
+    def cancel(self, job_id):
+        """Forget a pending job, e.g. because its event was removed from the sheet"""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM reminder_jobs WHERE job_id = ? AND state = 'pending'",
+                (job_id,),
+            )
+            if cur.rowcount:
+                self._conn.execute("DELETE FROM reminder_recipients WHERE job_id = ?", (job_id,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,350 @@
+import os
+import csv
+import uuid
+import socket
+import sqlite3
+import datetime
+import logging
+import argparse
+
+from sqlite_helpers import find_keys, now_text
+
+# Number of buffered ledger writes that triggers an automatic commit
+DEFAULT_BATCH_SIZE = 500
+
+SENT = 'sent'
+RESERVED = 'reserved'
+FAILED = 'failed'
+
+# Bumped with PRAGMA user_version whenever the table changes; see ensure_schema()
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sent_notifications (
+    order_id TEXT NOT NULL,
+    notification_type TEXT NOT NULL,
+    customer_email TEXT,
+    sent_timestamp TEXT,
+    state TEXT NOT NULL DEFAULT 'sent',
+    reserved_by TEXT,
+    error TEXT,
+    PRIMARY KEY (order_id, notification_type)
+) WITHOUT ROWID
+"""
+
+
+def ensure_schema(conn):
+    """Create the ledger table, or upgrade one written by an older version.
+
+    Version 1 added ``state`` and ``reserved_by`` so a notification can be
+    reserved before it is sent; older rows are all sent. Version 2 added
+    ``error``, the reason a notification failed permanently.
+    """
+    conn.execute(SCHEMA)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sent_notifications)")}
+        if 'state' not in columns:
+            conn.execute("ALTER TABLE sent_notifications ADD COLUMN state TEXT NOT NULL DEFAULT 'sent'")
+        if 'reserved_by' not in columns:
+            conn.execute("ALTER TABLE sent_notifications ADD COLUMN reserved_by TEXT")
+        if 'error' not in columns:
+            conn.execute("ALTER TABLE sent_notifications ADD COLUMN error TEXT")
+    if version < SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def new_owner():
+    """A name for this process to reserve notifications under"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def owner_alive(owner):
+    """Return whether the process behind a new_owner() name is still running.
+
+    Returns None when that cannot be told from here: the owner ran on
+    another host, or the name is not one new_owner() makes.
+    """
+    host, _, rest = str(owner).partition(":")
+    pid = rest.partition(":")[0]
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, under another user
+        return True
+    return True
+
+
+class SentLedger:
+    """Indexed ledger of notifications that have already been sent.
+
+    Entries live in a SQLite database in WAL mode keyed by
+    (order_id, notification_type), so "already sent?" is an index lookup
+    instead of a scan of the whole history. Writes are buffered and
+    committed in batches.
+
+    Long-running processes can pass ``cache_keys=True`` to also keep every
+    key known to be sent in memory, so repeated lookups skip the database.
+
+    Processes sharing a ledger ``reserve()`` a notification, committed,
+    before sending it. A reserved notification counts as sent for
+    everyone, so two processes can never both send it. If the process
+    dies before recording the outcome, the reservation stays behind "in
+    doubt" rather than risking a second email (see ``reserved()``).
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, cache_keys=False, owner=None):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.owner = owner or new_owner()
+        self._pending = []
+        self._pending_keys = set()
+        self._known_keys = set() if cache_keys else None
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        ensure_schema(self._conn)
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def is_sent(self, order_id, notification_type):
+        """Return True if the notification has already been recorded"""
+        key = (str(order_id), notification_type)
+        if key in self._pending_keys:
+            return True
+        if self._known_keys is not None and key in self._known_keys:
+            return True
+        cur = self._conn.execute(
+            "SELECT 1 FROM sent_notifications WHERE order_id = ? AND notification_type = ?",
+            key,
+        )
+        found = cur.fetchone() is not None
+        if found and self._known_keys is not None:
+            self._known_keys.add(key)
+        return found
+
+    def sent_keys(self, keys):
+        """Return the subset of (order_id, notification_type) keys already recorded"""
+        found = set()
+        by_type = {}
+        for order_id, notification_type in keys:
+            key = (str(order_id), notification_type)
+            if key in self._pending_keys:
+                found.add(key)
+            elif self._known_keys is not None and key in self._known_keys:
+                found.add(key)
+            else:
+                by_type.setdefault(notification_type, set()).add(key[0])
+
+        found |= find_keys(self._conn, 'sent_notifications', by_type)
+        if self._known_keys is not None:
+            self._known_keys.update(found)
+        return found
+
+    def reserve(self, notifications):
+        """Reserve (order_id, notification_type, customer_email) entries before sending them.
+
+        All of them are reserved in one committed transaction, or none are
+        if any is already sent or reserved by another process. Returns True
+        when this process now holds every reservation.
+        """
+        return self.reserve_batches([notifications])[0]
+
+    def reserve_batches(self, batches):
+        """reserve() several emails' notifications in a single committed transaction.
+
+        Each batch is reserved whole or not at all, independently of the
+        others. Returns a list with True for every batch now held by this
+        process.
+        """
+        results = []
+        reserved_keys = []
+        with self._conn:
+            # SAVEPOINT outside a transaction commits on RELEASE, so open one for all the batches
+            self._conn.execute("BEGIN IMMEDIATE")
+            # Buffered sends ride along in the same commit, so a crash leaves few entries in doubt
+            self._write_pending()
+            for notifications in batches:
+                rows = [(str(order_id), notification_type, customer_email, RESERVED, self.owner)
+                        for order_id, notification_type, customer_email in notifications]
+                self._conn.execute("SAVEPOINT reserve")
+                cur = self._conn.executemany(
+                    "INSERT OR IGNORE INTO sent_notifications "
+                    "(order_id, notification_type, customer_email, state, reserved_by) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                reserved = cur.rowcount == len(rows)
+                if reserved:
+                    reserved_keys.extend(row[:2] for row in rows)
+                else:
+                    self._conn.execute("ROLLBACK TO reserve")
+                self._conn.execute("RELEASE reserve")
+                results.append(reserved)
+        self._pending = []
+        self._pending_keys = set()
+        if self._known_keys is not None:
+            self._known_keys.update(reserved_keys)
+        return results
+
+    def release(self, keys):
+        """Drop this process's reservations for (order_id, notification_type) keys that were not sent"""
+        keys = [(str(order_id), notification_type) for order_id, notification_type in keys]
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM sent_notifications "
+                "WHERE order_id = ? AND notification_type = ? AND state = 'reserved' AND reserved_by = ?",
+                [(*key, self.owner) for key in keys],
+            )
+        if self._known_keys is not None:
+            self._known_keys.difference_update(keys)
+
+    def mark_failed(self, keys, error):
+        """Record this process's reservations for keys that can never be sent, e.g. a rejected address.
+
+        A failed notification counts as sent, so later runs skip it until
+        ``release_failed()`` is called.
+        """
+        keys = [(str(order_id), notification_type) for order_id, notification_type in keys]
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE sent_notifications SET state = 'failed', reserved_by = NULL, error = ?, sent_timestamp = ? "
+                "WHERE order_id = ? AND notification_type = ? AND state = 'reserved' AND reserved_by = ?",
+                [(str(error), now_text(), *key, self.owner) for key in keys],
+            )
+
+    def failed(self):
+        """Return (order_id, notification_type, customer_email, error) of notifications that failed permanently"""
+        return self._conn.execute(
+            "SELECT order_id, notification_type, customer_email, error "
+            "FROM sent_notifications WHERE state = 'failed'"
+        ).fetchall()
+
+    def release_failed(self):
+        """Forget every permanently failed notification, so they are planned again"""
+        with self._conn:
+            cur = self._conn.execute("DELETE FROM sent_notifications WHERE state = 'failed'")
+        if self._known_keys is not None:
+            self._known_keys.clear()
+        return cur.rowcount
+
+    def reserved(self, owner=None):
+        """Return (order_id, notification_type, customer_email, reserved_by) of reservations
+        not yet recorded as sent, optionally only those held by ``owner``"""
+        query = ("SELECT order_id, notification_type, customer_email, reserved_by "
+                 "FROM sent_notifications WHERE state = 'reserved'")
+        if owner is None:
+            return self._conn.execute(query).fetchall()
+        return self._conn.execute(query + " AND reserved_by = ?", (owner,)).fetchall()
+
+    def release_reserved(self, owners):
+        """Forget the reservations held by ``owners``, so those notifications are planned again.
+
+        Only pass owners that are known to have stopped: a running process
+        may be sending the notifications it holds.
+        """
+        released = 0
+        with self._conn:
+            for owner in owners:
+                cur = self._conn.execute(
+                    "DELETE FROM sent_notifications WHERE state = 'reserved' AND reserved_by = ?", (owner,)
+                )
+                released += cur.rowcount
+        if self._known_keys is not None:
+            self._known_keys.clear()
+        return released
+
+    def record(self, order_id, customer_email, notification_type, sent_timestamp=None):
+        """Buffer a sent notification; committed once the batch is full"""
+        if sent_timestamp is None:
+            sent_timestamp = datetime.datetime.now()
+        key = (str(order_id), notification_type)
+        if key in self._pending_keys:
+            return
+        self._pending.append((*key, customer_email, str(sent_timestamp)))
+        self._pending_keys.add(key)
+        if self._known_keys is not None:
+            self._known_keys.add(key)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        # A reservation becomes a sent entry; anything already sent is left alone
+        self._conn.executemany(
+            "INSERT INTO sent_notifications "
+            "(order_id, notification_type, customer_email, sent_timestamp) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (order_id, notification_type) DO UPDATE SET "
+            "state = 'sent', reserved_by = NULL, sent_timestamp = excluded.sent_timestamp "
+            "WHERE state = 'reserved'",
+            self._pending,
+        )
+
+    def flush(self):
+        """Commit all buffered writes in a single transaction"""
+        if not self._pending:
+            return
+        with self._conn:
+            self._write_pending()
+        self._pending = []
+        self._pending_keys = set()
+
+    def count(self):
+        """Return the number of committed ledger entries"""
+        return self._conn.execute("SELECT COUNT(*) FROM sent_notifications").fetchone()[0]
+
+    def close(self):
+        """Flush pending writes and close the database"""
+        if self._conn is None:
+            return
+        self.flush()
+        self._conn.close()
+        self._conn = None
+
+
+def migrate_csv(csv_path, db_path, batch_size=50000):
+    """Import a legacy sent_orders.csv ledger into a SQLite ledger.
+
+    Rows already present in the database are skipped, so the migration
+    can safely be re-run. Returns the number of CSV rows read.
+    """
+    imported = 0
+    with SentLedger(db_path, batch_size=batch_size) as ledger, open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip header
+        for row in reader:
+            if len(row) < 3:
+                continue
+            order_id, customer_email, notification_type = row[0], row[1], row[2]
+            sent_timestamp = row[3] if len(row) > 3 else ""
+            ledger.record(order_id, customer_email, notification_type, sent_timestamp)
+            imported += 1
+    logging.info(f"Migrated {imported} rows from {csv_path} into {db_path}")
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a CSV sent-orders ledger to SQLite")
+    parser.add_argument("csv_path", help="Existing sent_orders.csv file")
+    parser.add_argument("db_path", help="SQLite ledger to create or update")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.csv_path):
+        parser.error(f"{args.csv_path} does not exist")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    imported = migrate_csv(args.csv_path, args.db_path)
+    print(f"Imported {imported} rows into {args.db_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import io
+import csv
+import json
+import hashlib
+import logging
+import urllib.request
+import urllib.error
+from collections import namedtuple
+from pathlib import Path
+
+# Result of a conditional fetch. body is None when the source is unchanged.
+FetchResult = namedtuple('FetchResult', ['body', 'etag', 'last_modified'])
+
+_DIGEST_SIZE = 16
+
+
+class HTTPFetcher:
+    """Fetch a sheet over HTTP using ETag / If-Modified-Since validators"""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+
+    def fetch(self, url, etag=None, last_modified=None):
+        request = urllib.request.Request(url)
+        if etag:
+            request.add_header("If-None-Match", etag)
+        if last_modified:
+            request.add_header("If-Modified-Since", last_modified)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return FetchResult(
+                    response.read(),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return FetchResult(None, etag, last_modified)
+            raise
+
+
+class FileFetcher:
+    """Fetch a sheet export from a local file, using its mtime and size as validator"""
+
+    def fetch(self, url, etag=None, last_modified=None):
+        path = url[len("file://"):] if url.startswith("file://") else url
+        stat = os.stat(path)
+        validator = f"{stat.st_mtime_ns}-{stat.st_size}"
+        if validator == etag:
+            return FetchResult(None, etag, last_modified)
+        with open(path, 'rb') as f:
+            return FetchResult(f.read(), validator, None)
+
+
+def fetcher_for(url):
+    """Pick the fetcher matching a sheet URL or local path"""
+    if url.startswith(("http://", "https://")):
+        return HTTPFetcher()
+    return FileFetcher()
+
+
+class SheetChanges:
+    """Rows of a sheet that are new or changed since the last committed snapshot.
+
+    ``csv_text`` holds the header plus the changed rows, or is None when
+    nothing changed; ``full_text`` then holds the whole sheet. Call
+    ``commit()`` once the rows have been processed so the next run skips
+    them.
+    """
+
+    def __init__(self, cache, url, csv_text, total_rows, changed_rows, state, full_text=None):
+        self._cache = cache
+        self._url = url
+        self._state = state
+        self.csv_text = csv_text
+        self.full_text = full_text if csv_text is not None else None
+        self.total_rows = total_rows
+        self.changed_rows = changed_rows
+
+    @property
+    def unchanged(self):
+        return self.csv_text is None
+
+    def commit(self):
+        """Store this snapshot as the baseline for the next run"""
+        if self._state is not None:
+            self._cache._save(self._url, *self._state)
+
+
+class SheetSnapshotCache:
+    """Cache of the last parsed snapshot of each sheet source.
+
+    Each source keeps its HTTP validators, a hash of the whole export and
+    one digest per row in ``cache_dir``. ``load_changes()`` does a
+    conditional fetch and returns only rows whose digest is new.
+    """
+
+    def __init__(self, cache_dir, fetcher=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.fetcher = fetcher
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.rows"
+
+    def _load(self, url):
+        meta_path, rows_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(rows_path, 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return {}, set()
+        digests = {data[i:i + _DIGEST_SIZE] for i in range(0, len(data), _DIGEST_SIZE)}
+        return meta, digests
+
+    def _save(self, url, meta, digests):
+        meta_path, rows_path = self._paths(url)
+        for path, data in ((rows_path, b"".join(digests)), (meta_path, json.dumps(meta).encode('utf-8'))):
+            tmp_path = path.with_suffix(path.suffix + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def load_changes(self, url):
+        """Fetch a sheet and return the rows that changed since the last commit"""
+        meta, old_digests = self._load(url)
+        fetcher = self.fetcher or fetcher_for(url)
+        result = fetcher.fetch(url, meta.get('etag'), meta.get('last_modified'))
+
+        if result.body is None:
+            logging.debug(f"Sheet not modified since last run: {url}")
+            return SheetChanges(self, url, None, meta.get('rows', 0), 0, None)
+
+        content_hash = hashlib.sha256(result.body).hexdigest()
+        new_meta = {
+            'etag': result.etag,
+            'last_modified': result.last_modified,
+            'content_hash': content_hash,
+        }
+        if content_hash == meta.get('content_hash'):
+            # Same bytes behind a new validator; only remember the validator
+            new_meta['header'] = meta.get('header')
+            new_meta['rows'] = meta.get('rows', 0)
+            return SheetChanges(self, url, None, new_meta['rows'], 0, (new_meta, old_digests))
+
+        text = result.body.decode('utf-8-sig')
+        reader = csv.reader(io.StringIO(text))
+        header = next(reader, None)
+        if header is None:
+            new_meta['header'] = None
+            new_meta['rows'] = 0
+            return SheetChanges(self, url, None, 0, 0, (new_meta, set()))
+        if header != meta.get('header'):
+            # New or reordered columns change what every row means
+            old_digests = set()
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(header)
+        digests = set()
+        total_rows = 0
+        changed_rows = 0
+        for row in reader:
+            if not row:
+                continue
+            total_rows += 1
+            digest = hashlib.blake2b("\x1f".join(row).encode('utf-8'), digest_size=_DIGEST_SIZE).digest()
+            digests.add(digest)
+            if digest not in old_digests:
+                writer.writerow(row)
+                changed_rows += 1
+
+        new_meta['header'] = header
+        new_meta['rows'] = total_rows
+        csv_text = out.getvalue() if changed_rows else None
+        logging.info(f"Sheet has {changed_rows} new or changed rows out of {total_rows}: {url}")
+        return SheetChanges(self, url, csv_text, total_rows, changed_rows, (new_meta, digests), text)
@@ -0,0 +1,242 @@
+import math
+import logging
+import datetime
+import importlib.util
+from collections import namedtuple
+
+from light_csv import SheetRecords, UnsupportedSheet, guess_date_format, is_missing, parse_records
+
+# One value that failed validation; ``row`` is the line number in the CSV file
+Problem = namedtuple('Problem', ['row', 'column', 'value', 'reason'])
+
+# Problems listed individually in a validation report; the rest are only counted
+REPORT_EXAMPLES = 20
+
+
+def csv_engine(chunked=False):
+    """The fastest pandas.read_csv engine available: pyarrow when installed.
+
+    The pyarrow engine cannot stream a file in chunks, so chunked reads use
+    the C engine.
+    """
+    if not chunked and importlib.util.find_spec("pyarrow") is not None:
+        return "pyarrow"
+    return "c"
+
+
+class SheetSchema:
+    """Declared column types of a sheet export, and the checks each row must pass.
+
+    ``text`` columns stay strings, ``categories`` become pandas categoricals,
+    ``integers`` and ``floats`` are numbers and ``dates`` maps each date
+    column to its format. A column whose values match none of its declared
+    format is parsed with the format of its first value instead, like
+    pandas infers it. Columns the schema does not mention are inferred.
+
+    Dates, and numbers the CSV parser could not read, are converted whole
+    columns at a time, so every value that does not convert is found in
+    one pass. Rows with a bad number, or with a missing or bad value in a
+    ``required`` column, are dropped; a bad value in any other date column
+    is left missing. Either way the problems are returned for one report.
+    """
+
+    def __init__(self, name, text=(), categories=(), integers=(), floats=(), dates=None, required=()):
+        self.name = name
+        self.text = tuple(text)
+        self.categories = tuple(categories)
+        self.integers = tuple(integers)
+        self.floats = tuple(floats)
+        self.dates = dict(dates or {})
+        self.required = tuple(required)
+
+    def pandas_dtypes(self):
+        """dtype argument for pandas.read_csv; apply() converts the dates and any numbers left as text"""
+        dtypes = {column: 'str' for column in (*self.text, *self.dates)}
+        dtypes.update({column: 'category' for column in self.categories})
+        return dtypes
+
+    def read_csv(self, source, chunksize=None):
+        """pandas.read_csv with the schema's dtypes, streaming chunks when ``chunksize`` is set"""
+        import pandas as pd
+
+        engine = csv_engine(chunked=chunksize is not None)
+        if engine == "pyarrow":
+            try:
+                return pd.read_csv(source, dtype=self.pandas_dtypes(), engine=engine)
+            except (ValueError, TypeError) as e:
+                logging.debug(f"Reading the {self.name} sheet without pyarrow: {e}")
+                if hasattr(source, 'seek'):
+                    source.seek(0)
+        return pd.read_csv(source, dtype=self.pandas_dtypes(), chunksize=chunksize)
+
+    def apply(self, df, date_formats=None):
+        """Convert a DataFrame read with pandas_dtypes() to the schema's types.
+
+        ``date_formats`` carries the format picked for each date column from
+        one chunk of a streamed sheet to the next. Returns the valid rows
+        and a list of Problems.
+        """
+        import pandas as pd
+        from pandas.tseries.api import guess_datetime_format
+
+        if date_formats is None:
+            date_formats = {}
+        problems = []
+        invalid = pd.Series(False, index=df.index)
+
+        def check(column, raw, bad, reason, drop):
+            nonlocal invalid
+            if bad.any():
+                problems.extend(
+                    Problem(int(index) + 2, column, value, reason)
+                    for index, value in raw[bad].items()
+                )
+                if drop:
+                    invalid |= bad
+
+        for column in self.required:
+            if column in df.columns:
+                check(column, df[column], df[column].isna(), "missing", drop=True)
+
+        for column in (*self.integers, *self.floats):
+            if column not in df.columns:
+                continue
+            raw = df[column]
+            # The CSV parser already read columns without bad values as numbers
+            numbers = raw if pd.api.types.is_numeric_dtype(raw) else pd.to_numeric(raw, errors='coerce')
+            bad = (numbers.isna() | numbers.abs().eq(math.inf)) & raw.notna()
+            numbers = numbers.where(~bad)
+            if column in self.integers:
+                fraction = numbers.notna() & (numbers != numbers.round())
+                check(column, raw, fraction, "not a whole number", drop=True)
+                numbers = numbers.where(~fraction).astype('Int64')
+            check(column, raw, bad, "not a number", drop=True)
+            df[column] = numbers
+
+        for column, declared in self.dates.items():
+            if column not in df.columns:
+                continue
+            raw = df[column]
+            date_format = date_formats.get(column, declared)
+            parsed = pd.to_datetime(raw, format=date_format, errors='coerce')
+            present = raw.notna()
+            failed = parsed.isna() & present
+            if failed.any():
+                # Only values that failed are stripped of surrounding spaces
+                raw = raw.copy()
+                raw[failed] = raw[failed].str.strip()
+                parsed[failed] = pd.to_datetime(raw[failed], format=date_format, errors='coerce')
+            if present.any() and parsed[present].isna().all():
+                # Nothing matches the declared format: use the sheet's own, as pandas would
+                first = raw[present].iloc[0]
+                inferred = guess_datetime_format(first)
+                if inferred is not None and inferred != date_format:
+                    logging.info(f"{self.name} column {column} does not use {date_format}; using {inferred}")
+                    date_format = inferred
+                    parsed = pd.to_datetime(raw, format=date_format, errors='coerce')
+            date_formats[column] = date_format
+            check(column, raw, parsed.isna() & present, f"not a date in {date_format} format",
+                  drop=column in self.required)
+            df[column] = parsed
+
+        if problems:
+            df = df.loc[~invalid]
+        return df, problems
+
+    def apply_records(self, records, date_formats=None):
+        """Same as apply(), for SheetRecords parsed without pandas"""
+        if date_formats is None:
+            date_formats = {}
+        present = set(records.columns)
+        integers = [column for column in self.integers if column in present]
+        floats = [column for column in self.floats if column in present]
+        required = [column for column in self.required if column in present]
+
+        dates = {}
+        for column, declared in self.dates.items():
+            if column not in present:
+                continue
+            values = [row[column].strip() for row in records if isinstance(row[column], str)]
+            date_format = date_formats.get(column, declared)
+            if values and (date_format is None or not any(_matches(value, date_format) for value in values)):
+                inferred = guess_date_format(values[0])
+                if inferred is None:
+                    raise UnsupportedSheet(f"unrecognised date format in {column}: {values[0]!r}")
+                if inferred != date_format:
+                    logging.info(f"{self.name} column {column} does not use {date_format}; using {inferred}")
+                    date_format = inferred
+            dates[column] = date_formats[column] = date_format
+
+        problems = []
+        valid = SheetRecords(columns=records.columns)
+        strptime = datetime.datetime.strptime
+        for line, row in enumerate(records, start=2):
+            drop = False
+            for column in required:
+                if is_missing(row[column]):
+                    problems.append(Problem(line, column, row[column], "missing"))
+                    drop = True
+            for column in (*integers, *floats):
+                value = row[column]
+                if is_missing(value):
+                    continue
+                try:
+                    # float() accepts digit separators that pandas does not
+                    if isinstance(value, str) and "_" in value:
+                        raise ValueError(value)
+                    number = float(value)
+                    if not math.isfinite(number):
+                        raise ValueError(value)
+                except ValueError:
+                    problems.append(Problem(line, column, value, "not a number"))
+                    drop = True
+                    continue
+                if column in integers:
+                    if number != round(number):
+                        problems.append(Problem(line, column, value, "not a whole number"))
+                        drop = True
+                        continue
+                    number = int(number)
+                row[column] = number
+            for column, date_format in dates.items():
+                value = row[column]
+                if is_missing(value):
+                    row[column] = None
+                    continue
+                try:
+                    row[column] = strptime(str(value).strip(), date_format)
+                except ValueError:
+                    problems.append(Problem(line, column, value, f"not a date in {date_format} format"))
+                    row[column] = None
+                    drop = drop or column in self.required
+            if not drop:
+                valid.append(row)
+        return valid, problems
+
+    def parse_records(self, data):
+        """Parse a small sheet without pandas; returns the valid SheetRecords and the Problems"""
+        return self.apply_records(parse_records(data, text_columns=(*self.text, *self.categories, *self.dates)))
+
+
+def _matches(value, date_format):
+    try:
+        datetime.datetime.strptime(value, date_format)
+    except ValueError:
+        return False
+    return True
+
+
+def format_problems(name, problems):
+    """Describe every validation problem of one sheet read in a single message"""
+    problems = sorted(problems, key=lambda problem: problem.row)
+    rows = len({problem.row for problem in problems})
+    lines = [f"  line {p.row}, {p.column}: {p.reason} ({p.value!r})" for p in problems[:REPORT_EXAMPLES]]
+    if len(problems) > REPORT_EXAMPLES:
+        lines.append(f"  ... and {len(problems) - REPORT_EXAMPLES} more")
+    return f"{len(problems)} invalid values in {rows} rows of the {name} sheet:\n" + "\n".join(lines)
+
+
+def report_problems(name, problems):
+    """Log every validation problem of one sheet read as a single warning"""
+    if problems:
+        logging.warning(format_problems(name, problems))
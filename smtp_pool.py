@@ -0,0 +1,586 @@
+import re
+import ssl
+import copy
+import heapq
+import random
+import itertools
+import smtplib
+import threading
+import queue
+import time
+import logging
+import contextlib
+from concurrent.futures import Future
+from email.message import Message
+from email.utils import getaddresses
+
+_STOP = object()
+
+_LEADING_PERIOD = re.compile(br'(?m)^\.')
+
+
+class SMTPSetupError(smtplib.SMTPException):
+    """The SMTP session could not be set up: the greeting, STARTTLS or login was refused.
+
+    This is a problem with the configuration or the server, not with any
+    one message, so it is neither retried nor a permanent failure of the
+    messages it stopped. ``error`` is the original exception.
+    """
+
+    def __init__(self, error):
+        super().__init__(f"could not set up the SMTP session: {error}")
+        self.error = error
+
+
+class SMTPSender:
+    """Send email messages over a pool of authenticated SMTP connections.
+
+    Messages are EmailMessage objects or pre-rendered
+    (from_addr, to_addrs, data) tuples such as email_templates.RenderedEmail.
+    EmailMessage objects are flattened to bytes by ``submit()``, on the
+    caller's thread, so connections only ever write ready-made bytes. When
+    the server advertises PIPELINING, MAIL, RCPT and DATA go out in a
+    single round trip.
+    Each worker thread owns one connection. Connections are opened lazily,
+    checked with NOOP after sitting idle and re-established when they drop.
+    ``submit()`` returns a Future that resolves once the message has been
+    accepted by the server, to the recipients it refused as sendmail()
+    returns them. ``close()`` sends everything already queued
+    before the connections are shut down.
+
+    With ``keepalive_interval`` set, idle workers send NOOP at that interval
+    so long-running processes keep their sessions open, and reconnect
+    straight away when a session has dropped.
+
+    An optional ``rate_limiter`` (see rate_limiter.AdaptiveRateLimiter) is
+    shared by all workers and told about every success and deferral.
+
+    An optional ``metrics`` registry (see metrics.MetricsRegistry) records
+    connect, login and per-message send times and the outcome of each send.
+
+    Every message succeeds or fails on its own. A message the server
+    defers with a 4xx reply, or that is caught by a dropped connection, is
+    tried up to ``max_attempts`` times, waiting an exponential backoff with
+    jitter (see backoff_delay()) between attempts without holding up the
+    messages behind it. Recipients the server refuses with a 4xx reply while
+    accepting the message for others are retried the same way, in a copy
+    addressed to them alone. A permanent failure fails its Future straight
+    away.
+
+    If the session itself cannot be set up (see SMTPSetupError), no further
+    connections are attempted: every queued message fails with that error,
+    and so does every later ``submit()``.
+    """
+
+    def __init__(self, host, port, username=None, password=None, pool_size=4,
+                 starttls=True, timeout=30, health_check_interval=30,
+                 keepalive_interval=None, rate_limiter=None, smtp_factory=smtplib.SMTP, metrics=None,
+                 max_attempts=1, retry_delay=1.0, max_retry_delay=60.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pool_size = max(1, int(pool_size))
+        self.starttls = starttls
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.keepalive_interval = keepalive_interval
+        self.rate_limiter = rate_limiter
+        self.smtp_factory = smtp_factory
+        self.metrics = metrics
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._queue = queue.Queue(maxsize=self.pool_size * 4)
+        self._workers = []
+        self._closed = False
+        # Messages waiting out a backoff, as a heap of (due, seq, item). An item is
+        # (msg, future, attempt, refused): ``refused`` is None for a whole message, and
+        # for a copy retrying deferred recipients holds what the earlier attempts refused
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._retry_thread = None
+        # Submitted messages whose Future is not done yet; close() waits for them
+        self._cond = threading.Condition()
+        self._unfinished = 0
+        # The first SMTPSetupError; once set, nothing is sent any more
+        self.setup_error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        """Start the worker threads"""
+        if self._workers:
+            return
+        for i in range(self.pool_size):
+            worker = threading.Thread(target=self._run_worker, name=f"smtp-sender-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        if self.max_attempts > 1:
+            self._retry_thread = threading.Thread(target=self._run_retries, name="smtp-retry", daemon=True)
+            self._retry_thread.start()
+
+    def submit(self, msg):
+        """Queue a message for sending and return a Future for the result"""
+        if self._closed:
+            raise RuntimeError("SMTP sender is closed")
+        if self.setup_error is not None:
+            raise self.setup_error
+        if isinstance(msg, Message):
+            msg = serialize_message(msg)
+        future = Future()
+        with self._cond:
+            self._unfinished += 1
+        future.add_done_callback(self._finished)
+        self._queue.put((msg, future, 1, None))
+        return future
+
+    def close(self):
+        """Send all queued messages, including retries, then close every connection"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._workers:
+            with self._cond:
+                while self._unfinished:
+                    self._cond.wait()
+                self._cond.notify_all()
+        for _ in self._workers:
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._retry_thread is not None:
+            self._retry_thread.join()
+            self._retry_thread = None
+
+    def _finished(self, future):
+        with self._cond:
+            self._unfinished -= 1
+            self._cond.notify_all()
+
+    def _failed(self, item, error):
+        """Retry a message after a temporary failure, or fail its Future"""
+        msg, future, attempt, refused = item
+        retry = is_temporary_failure(error) or is_connection_error(error)
+        if retry and attempt < self.max_attempts:
+            self._retry(item, msg, error)
+        elif refused is None:
+            future.set_exception(error)
+        else:
+            # A retry of deferred recipients: the message already reached the others
+            future.set_result({**refused, **recipient_refusals(error, _recipients(msg))})
+
+    def _accepted(self, item, newly_refused):
+        """Resolve a sent message, retrying the recipients it deferred with a 4xx reply"""
+        msg, future, attempt, refused = item
+        refused = {**(refused or {}), **newly_refused}
+        deferred = [addr for addr, (code, _) in newly_refused.items() if 400 <= code < 500]
+        if not deferred or attempt >= self.max_attempts or isinstance(msg, Message):
+            future.set_result(refused)
+            return
+        for addr in deferred:
+            del refused[addr]
+        error = smtplib.SMTPRecipientsRefused({addr: newly_refused[addr] for addr in deferred})
+        self._retry((msg, future, attempt, refused), _with_recipients(msg, deferred), error)
+
+    def _retry(self, item, msg, error):
+        """Put ``msg`` back on the queue for the Future of ``item`` once its backoff has passed"""
+        _, future, attempt, refused = item
+        delay = backoff_delay(attempt, self.retry_delay, self.max_retry_delay)
+        if self.metrics is not None:
+            self.metrics.inc('smtp_retries_total')
+        recipients = _recipients(msg)
+        if len(recipients) > 3:
+            recipients = [*recipients[:3], f"{len(recipients) - 3} more"]
+        logging.warning(f"Retrying message to {', '.join(recipients)} in {delay:.1f}s "
+                        f"(attempt {attempt} of {self.max_attempts} failed: {error})")
+        with self._cond:
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_seq),
+                                           (msg, future, attempt + 1, refused)))
+            self._cond.notify_all()
+
+    def _run_retries(self):
+        """Put messages back on the queue once their backoff has passed"""
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._unfinished:
+                        return
+                    if self._retries and self._retries[0][0] <= time.monotonic():
+                        _, _, item = heapq.heappop(self._retries)
+                        break
+                    timeout = self._retries[0][0] - time.monotonic() if self._retries else None
+                    self._cond.wait(timeout)
+            self._queue.put(item)
+
+    def _timer(self, stage):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.timer(stage)
+
+    def _connect(self):
+        """Open and log in a new session; raises SMTPSetupError if the server will not have us"""
+        server = None
+        try:
+            with self._timer('smtp_connect'):
+                server = self.smtp_factory(self.host, self.port, timeout=self.timeout)
+                if self.starttls:
+                    server.starttls()
+            if self.username and self.password:
+                with self._timer('smtp_login'):
+                    server.login(self.username, self.password)
+        except Exception as e:
+            if server is not None:
+                _quit(server)
+            if is_setup_failure(e):
+                error = SMTPSetupError(e)
+                with self._cond:
+                    if self.setup_error is None:
+                        self.setup_error = error
+                        logging.error(f"Stopped sending through {self.host}: {error}")
+                raise error from e
+            raise
+        if self.metrics is not None:
+            self.metrics.inc('smtp_connections_total')
+        return server
+
+    def _is_healthy(self, server):
+        try:
+            return server.noop()[0] == 250
+        except OSError:
+            return False
+
+    def _send(self, server, msg):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        try:
+            with self._timer('smtp_send'):
+                refused = _deliver(server, msg)
+        except OSError as e:
+            temporary = is_temporary_failure(e)
+            if temporary and self.rate_limiter is not None:
+                self.rate_limiter.on_deferral()
+            if self.metrics is not None:
+                outcome = 'deferred' if temporary else 'dropped' if is_connection_error(e) else 'rejected'
+                self.metrics.inc('smtp_replies_total', outcome=outcome)
+            raise
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_success()
+        if self.metrics is not None:
+            self.metrics.inc('smtp_replies_total', outcome='accepted')
+        return refused or {}
+
+    def _keepalive(self, server):
+        """Keep an idle session open, reconnecting if it has dropped"""
+        if server is not None and self._is_healthy(server):
+            return server
+        if server is not None:
+            logging.warning(f"Idle SMTP connection to {self.host} dropped, reconnecting")
+            _quit(server)
+        if self.setup_error is not None:
+            return None
+        try:
+            return self._connect()
+        except SMTPSetupError:
+            return None
+        except Exception as e:
+            logging.warning(f"Could not reconnect to {self.host}: {e}")
+            return None
+
+    def _run_worker(self):
+        server = None
+        last_used = 0.0
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.keepalive_interval)
+                except queue.Empty:
+                    server = self._keepalive(server)
+                    last_used = time.monotonic()
+                    continue
+                if item is _STOP:
+                    return
+                msg, future, attempt, _ = item
+                if attempt == 1 and not future.set_running_or_notify_cancel():
+                    continue
+                if self.setup_error is not None:
+                    # Do not log in again for every message once the server has refused us
+                    self._failed(item, self.setup_error)
+                    continue
+
+                if server is not None and time.monotonic() - last_used > self.health_check_interval:
+                    if not self._is_healthy(server):
+                        logging.warning(f"SMTP connection to {self.host} failed health check, reconnecting")
+                        _quit(server)
+                        server = None
+
+                try:
+                    if server is None:
+                        server = self._connect()
+                    try:
+                        refused = self._send(server, msg)
+                    except OSError as e:
+                        if not is_connection_error(e):
+                            raise
+                        # The connection dropped; reconnect once and retry the message
+                        logging.warning(f"SMTP connection to {self.host} dropped ({e}), reconnecting")
+                        _quit(server)
+                        server = None
+                        server = self._connect()
+                        refused = self._send(server, msg)
+                except Exception as e:
+                    if server is not None and is_connection_error(e):
+                        _quit(server)
+                        server = None
+                    self._failed(item, e)
+                else:
+                    self._accepted(item, refused)
+                last_used = time.monotonic()
+        finally:
+            if server is not None:
+                _quit(server)
+
+
+def backoff_delay(attempt, base, cap):
+    """Seconds to wait before retrying after failed attempt number ``attempt`` (1 for the first).
+
+    The delay doubles with every attempt up to ``cap``, and a random half
+    of it is jittered so retries from many messages do not arrive at once.
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _recipients(msg):
+    if isinstance(msg, Message):
+        return [addr for _, addr in getaddresses(msg.get_all('To', []))]
+    return list(msg[1])
+
+
+def _with_recipients(msg, to_addrs):
+    """A copy of a pre-rendered message for other envelope recipients"""
+    if hasattr(msg, '_replace'):
+        return msg._replace(to_addrs=list(to_addrs))
+    return (msg[0], list(to_addrs), msg[2])
+
+
+def serialize_message(msg):
+    """Flatten a Message into a (from_addr, to_addrs, data) tuple the way send_message() would.
+
+    Messages that need SMTPUTF8 or use Resent-* headers are returned
+    unchanged and left to send_message().
+    """
+    if msg.get_all('Resent-Date'):
+        return msg
+    senders = getaddresses([msg['Sender'] or msg['From'] or ""])
+    to_addrs = [
+        addr for _, addr in getaddresses(msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', []))
+        if addr
+    ]
+    from_addr = senders[0][1] if senders else ""
+    if not to_addrs or not all(addr.isascii() for addr in [from_addr, *to_addrs]):
+        return msg
+    if 'Bcc' in msg:
+        msg = copy.copy(msg)
+        del msg['Bcc']
+    return from_addr, to_addrs, msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+
+def _reset(server, *codes):
+    """Get a session back to a clean state after a failed transaction"""
+    if 421 in codes or 354 in codes:
+        # The server is closing, or wants data for a transaction we are abandoning
+        server.close()
+        return
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def pipelined_sendmail(server, from_addr, to_addrs, data):
+    """Like server.sendmail(), but with ESMTP PIPELINING (RFC 2920) when the server offers it.
+
+    MAIL FROM, every RCPT TO and DATA are written at once and their replies
+    read back together, so a message costs two round trips instead of
+    three or more. Raises the same exceptions as sendmail() and returns
+    the refused recipients.
+    """
+    server.ehlo_or_helo_if_needed()
+    if isinstance(data, str) or not server.has_extn('pipelining'):
+        return server.sendmail(from_addr, to_addrs, data)
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+
+    options = f" SIZE={len(data)}" if server.has_extn('size') else ""
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}"]
+    commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}" for addr in to_addrs]
+    commands.append("DATA")
+    server.send("".join(command + "\r\n" for command in commands))
+
+    mail_code, mail_reply = server.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, reply = server.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, reply)
+    data_code, data_reply = server.getreply()
+    rcpt_codes = [code for code, _ in refused.values()]
+
+    if mail_code != 250:
+        _reset(server, mail_code, data_code, *rcpt_codes)
+        raise smtplib.SMTPSenderRefused(mail_code, mail_reply, from_addr)
+    if len(refused) == len(to_addrs):
+        _reset(server, data_code, *rcpt_codes)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_code != 354:
+        _reset(server, data_code, *rcpt_codes)
+        raise smtplib.SMTPDataError(data_code, data_reply)
+
+    payload = _LEADING_PERIOD.sub(b"..", data)
+    if not payload.endswith(b"\r\n"):
+        payload += b"\r\n"
+    server.send(payload + b".\r\n")
+    code, reply = server.getreply()
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
+
+
+def _deliver(server, msg):
+    """Send an EmailMessage, or a pre-rendered (from_addr, to_addrs, data) message"""
+    if isinstance(msg, Message):
+        return server.send_message(msg)
+    from_addr, to_addrs, data = msg
+    return pipelined_sendmail(server, from_addr, to_addrs, data)
+
+
+def batch_recipients(msg, max_recipients):
+    """Split a pre-rendered message into copies of at most ``max_recipients`` envelope recipients.
+
+    Every copy carries the same bytes, so a message for thousands of
+    recipients costs one DATA transfer per batch rather than per recipient.
+    """
+    from_addr, to_addrs, data = msg
+    to_addrs = list(to_addrs)
+    step = max(1, int(max_recipients))
+    batches = [to_addrs[i:i + step] for i in range(0, len(to_addrs), step)]
+    if hasattr(msg, '_replace'):
+        return [msg._replace(to_addrs=batch) for batch in batches]
+    return [(from_addr, batch, data) for batch in batches]
+
+
+def combine_futures(futures):
+    """Return a Future that is done once all ``futures`` are.
+
+    It resolves to the refused recipients of every message merged into one
+    dict, or fails with the first error if any message failed.
+    """
+    futures = list(futures)
+    combined = Future()
+    combined.set_running_or_notify_cancel()
+    if not futures:
+        combined.set_result({})
+        return combined
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+            return
+        refused = {}
+        for future in futures:
+            refused.update(future.result() or {})
+        combined.set_result(refused)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+def is_setup_failure(error):
+    """Return True if an error while opening a session means it cannot be set up at all.
+
+    A refused login, a server without STARTTLS, a failed TLS handshake or a
+    5xx greeting will not go away by retrying; a dropped or refused
+    connection or a 4xx greeting might.
+    """
+    if isinstance(error, SMTPSetupError):
+        return True
+    if isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPNotSupportedError, ssl.SSLError)):
+        return True
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPHeloError)):
+        return error.smtp_code >= 500
+    # starttls() raises RuntimeError when Python has no SSL support
+    return isinstance(error, RuntimeError)
+
+
+def is_connection_error(error):
+    """Return True if an error means the SMTP connection itself is gone"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 421: the server is closing the transmission channel
+        return error.smtp_code == 421
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_temporary_failure(error):
+    """Return True if the server deferred a message with a 4xx reply"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+def is_permanent_failure(error):
+    """Return True if the server refused a message itself with a 5xx reply to MAIL, RCPT or DATA.
+
+    Only these are worth recording as undeliverable. Anything else, like a
+    session that could not be set up, says nothing about the message.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(code >= 500 for code in codes)
+    if isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return error.smtp_code >= 500
+    return False
+
+
+def recipient_refusals(error, to_addrs):
+    """The failure of a message as a refusal of each of its recipients, like sendmail() reports them.
+
+    Errors without an SMTP reply, like a dropped connection, count as a 451
+    deferral, since it is not known whether the server would have accepted them.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return dict(error.recipients)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return {addr: (error.smtp_code, error.smtp_error) for addr in to_addrs}
+    return {addr: (451, str(error).encode()) for addr in to_addrs}
+
+
+def _quit(server):
+    """Close an SMTP connection, ignoring errors from a connection that is already gone"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
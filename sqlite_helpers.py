@@ -0,0 +1,39 @@
+import datetime
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_CHUNK = 400
+
+
+def now_text():
+    """The current time as stored in the updated_at and timestamp columns"""
+    return datetime.datetime.now().isoformat(sep=' ')
+
+
+def select_in(conn, query, values, params=()):
+    """Yield the rows of ``query`` for all of ``values``, LOOKUP_CHUNK of them per statement.
+
+    ``query`` has an ``IN ({})`` that is filled with one placeholder per
+    value; ``params`` are bound before the values.
+    """
+    values = list(values)
+    for i in range(0, len(values), LOOKUP_CHUNK):
+        chunk = values[i:i + LOOKUP_CHUNK]
+        yield from conn.execute(query.format(",".join("?" * len(chunk))), [*params, *chunk])
+
+
+def find_keys(conn, table, by_type):
+    """Return the (order_id, notification_type) keys present in ``table``.
+
+    ``by_type`` maps each notification_type to the order_ids to look up,
+    so every lookup is a range of the table's primary key.
+    """
+    found = set()
+    for notification_type, order_ids in by_type.items():
+        rows = select_in(
+            conn,
+            f"SELECT order_id FROM {table} WHERE notification_type = ? AND order_id IN ({{}})",
+            order_ids,
+            (notification_type,),
+        )
+        found.update((row[0], notification_type) for row in rows)
+    return found
@@ -1,223 +1,655 @@
 import os
-import smtplib
+import io
 import datetime
-import time
-import pandas as pd
-from email.message import EmailMessage
-from email.utils import formataddr, formatdate
+import argparse
+from concurrent.futures import Future
+from email.utils import formataddr, getaddresses
 from pathlib import Path
 from dotenv import load_dotenv
+from sheet_cache import SheetSnapshotCache
+from email_templates import EmailTemplate
+from smtp_pool import SMTPSender, SMTPSetupError, batch_recipients, combine_futures, recipient_refusals
+from reminder_scheduler import ReminderScheduler
+from reminder_store import ReminderJob, ReminderStore, PENDING, SENT
+from metrics import MetricsRegistry, MetricsServer
+from light_csv import SheetRecords, UnsupportedSheet, is_missing, read_source
+from sheet_schema import SheetSchema, format_problems
+from profiling import add_profiling_arguments, profiled
 
 
-PORT = 587
-EMAIL_SERVER = "smtp.gmail.com"
+current_dir = Path(__file__).resolve().parent if "__file__" in locals() else Path.cwd()
+envars = current_dir / ".env"
+load_dotenv(envars)
 
 
-SHEET_ID = "1xCRgkfupWUtHqu2d3DxOPvwOLhYlujiu6HVHwICDV0g"  # Update with your sheet ID
-SHEET_NAME = "Sheet1"  # Update with your sheet name
-URL = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/gviz/tq?tqx=out:csv&sheet={SHEET_NAME}"
+PORT = int(os.getenv("SMTP_PORT", "587"))
+EMAIL_SERVER = os.getenv("EMAIL_SERVER", "smtp.gmail.com")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
 
 
-current_dir = Path(__file__).resolve().parent if "__file__" in locals() else Path.cwd()
-envars = current_dir / ".env"
-load_dotenv(envars)
+SHEET_ID = "1xCRgkfupWUtHqu2d3DxOPvwOLhYlujiu6HVHwICDV0g"  # Update with your sheet ID
+SHEET_NAME = "Sheet1"  # Update with your sheet name
+URL = os.getenv("EVENTS_SHEET_URL") or f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/gviz/tq?tqx=out:csv&sheet={SHEET_NAME}"
 
 
 sender_email = os.getenv("EMAIL")
 password_email = os.getenv("PASSWORD")
 
+# Directory for sheet snapshots; when set, only new or changed events are scheduled
+SHEET_CACHE_DIR = os.getenv("SHEET_CACHE_DIR")
+
+# Number of SMTP connections used to send due reminders concurrently
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+
+# Most envelope recipients per message; RFC 5321 servers must accept at least 100
+SMTP_MAX_RECIPIENTS = int(os.getenv("SMTP_MAX_RECIPIENTS", "100"))
+
+# Attempts per message after temporary failures (4xx replies, dropped connections), and the
+# backoff between them: SMTP_RETRY_DELAY seconds, doubling up to SMTP_MAX_RETRY_DELAY
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", "4"))
+SMTP_RETRY_DELAY = float(os.getenv("SMTP_RETRY_DELAY", "2"))
+SMTP_MAX_RETRY_DELAY = float(os.getenv("SMTP_MAX_RETRY_DELAY", "60"))
+
+# Seconds between re-reads of the sheet while reminders are pending (0 disables)
+EVENTS_REFRESH_INTERVAL = float(os.getenv("EVENTS_REFRESH_INTERVAL", "60"))
+
+FINAL_JOB_ID = "final-notification"
+
+# Minutes between the last reminder and the final notification
+FINAL_NOTIFICATION_DELAY_MINUTES = float(os.getenv("FINAL_NOTIFICATION_DELAY_MINUTES", "5"))
+
+# Reminder job store, and how late a reminder missed during downtime may still be sent
+REMINDER_STORE = os.getenv("REMINDER_STORE", "reminder_jobs.db")
+CATCH_UP_GRACE_MINUTES = float(os.getenv("CATCH_UP_GRACE_MINUTES", "15"))
+
+# Sheets smaller than this many bytes are parsed without importing pandas
+SMALL_SHEET_BYTES = int(os.getenv("SMALL_SHEET_BYTES", "1000000"))
+
+EVENT_DATE_FORMAT = "%m/%d/%Y"
+EVENT_TIME_FORMAT = "%I:%M:%S %p"
+
+# Optional events column with each event's participants, separated by commas or semicolons;
+# events without any are sent to the receiver the script is run for
+EVENT_RECIPIENTS_COLUMN = "Recipients"
+
+# To header of a reminder sent to several participants at once, so they do not see each other
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+
+# Column types of the events sheet; Date and Time are combined into DateTime after parsing
+EVENTS_SCHEMA = SheetSchema(
+    "events",
+    text=['Details', EVENT_RECIPIENTS_COLUMN],
+    integers=['Reminder Before (minutes)'],
+    dates={'Date': EVENT_DATE_FORMAT, 'Time': EVENT_TIME_FORMAT},
+    required=['Date', 'Time', 'Reminder Before (minutes)'],
+)
+
+# Stage metrics: written to METRICS_DIR after the run, served on METRICS_PORT while reminders are pending
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) or None
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS = MetricsRegistry("event_reminder")
+
+# Directory for the reports of runs started with --profile or --profile-memory
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+_email_templates = {}
+
+def get_email_template(name, subject):
+    """Return a compiled email template, loading it on first use"""
+    template = _email_templates.get(name)
+    if template is None:
+        template = EmailTemplate.load(
+            name,
+            subject,
+            formataddr(("Event Reminder", f"{sender_email}")),
+            add_date=True,
+        )
+        _email_templates[name] = template
+    return template
+
+EVENT_REMINDER_SUBJECT = "Reminder: Event at ${event_time}"
+FINAL_NOTIFICATION_SUBJECT = "All Event Reminders Have Been Scheduled"
+
+def event_reminder_fields(name, event_time, event_details):
+    return {
+        'name': name,
+        'event_time': event_time.strftime('%I:%M %p'),
+        'formatted_event_time': event_time.strftime("%I:%M %p on %B %d, %Y"),
+        'event_details': event_details,
+    }
+
+def final_notification_fields(num_scheduled, last_email_time):
+    return {
+        'num_scheduled': num_scheduled,
+        'last_email_time': last_email_time.strftime('%I:%M %p'),
+    }
+
 def create_event_reminder_email(receiver_email, name, event_time, event_details):
     """Create email message for event reminder"""
-    formatted_event_time = event_time.strftime("%I:%M %p on %B %d, %Y")
-    subject = f"Reminder: Event at {event_time.strftime('%I:%M %p')}"
-    
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr(("Event Reminder", f"{sender_email}"))
-    msg["To"] = receiver_email
-    msg["Date"] = formatdate(localtime=True)
-    
-    msg.set_content(
-        f"""
-        Hi {name},
-        
-        This is a reminder about your upcoming event:
-        
-        Event Time: {formatted_event_time}
-        Details: {event_details}
-        
-        Best regards,
-        Your Reminder Service
-        """
-    )
-    
-    msg.add_alternative(
-        f"""
-        <html>
-          <body>
-            <p>Hi {name},</p>
-            <p>This is a reminder about your upcoming event:</p>
-            <p><strong>Event Time:</strong> {formatted_event_time}</p>
-            <p><strong>Details:</strong> {event_details}</p>
-            <p>Best regards,</p>
-            <p>Your Reminder Service</p>
-          </body>
-        </html>
-        """,
-        subtype="html",
-    )
-    
-    return msg
+    template = get_email_template('event_reminder', EVENT_REMINDER_SUBJECT)
+    return template.render_message(receiver_email, event_reminder_fields(name, event_time, event_details))
 
 def create_final_notification_email(receiver_email, num_scheduled, last_email_time):
     """Create final notification email"""
-    subject = "All Event Reminders Have Been Scheduled"
-    
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr(("Event Reminder", f"{sender_email}"))
-    msg["To"] = receiver_email
-    msg["Date"] = formatdate(localtime=True)
-    
-    msg.set_content(
-        f"""
-        Hi Admin,
-        
-        All {num_scheduled} event reminders have been scheduled. 
-        The last one will be sent at {last_email_time.strftime('%I:%M %p')}.
-        
-        Please refresh your Google Sheet and rerun the script for new events.
-        
-        Best regards,
-        Your Reminder Service
-        """
-    )
-    
-    msg.add_alternative(
-        f"""
-        <html>
-          <body>
-            <p>Hi Admin,</p>
-            <p>All {num_scheduled} event reminders have been scheduled.</p>
-            <p>The last one will be sent at {last_email_time.strftime('%I:%M %p')}.</p>
-            <p>Please refresh your Google Sheet and rerun the script for new events.</p>
-            <p>Best regards,</p>
-            <p>Your Reminder Service</p>
-          </body>
-        </html>
-        """,
-        subtype="html",
+    template = get_email_template('final_notification', FINAL_NOTIFICATION_SUBJECT)
+    return template.render_message(receiver_email, final_notification_fields(num_scheduled, last_email_time))
+
+def build_event_reminder_email(receiver_email, name, event_time, event_details):
+    """Render an event reminder straight to the bytes sent over SMTP"""
+    template = get_email_template('event_reminder', EVENT_REMINDER_SUBJECT)
+    return template.render(receiver_email, event_reminder_fields(name, event_time, event_details))
+
+def build_event_reminder_messages(job, default_recipient, skip=()):
+    """Render an event's reminder for every one of its recipients not in ``skip``.
+
+    Recipients listed without a name all get the same message, rendered
+    once and sent with at most SMTP_MAX_RECIPIENTS envelope recipients per
+    copy. Recipients listed with a name are greeted by it, one message each.
+    """
+    template = get_email_template('event_reminder', EVENT_REMINDER_SUBJECT)
+    event_time = job.event_time
+    event_details = job.event_details
+    recipients = [(name, address) for name, address in job.recipients or (("", default_recipient),)
+                  if address not in skip]
+
+    messages = []
+    shared = [address for name, address in recipients if not name]
+    if len(shared) == 1:
+        messages.append(build_event_reminder_email(shared[0], "Event Participant", event_time, event_details))
+    elif shared:
+        msg = template.render(UNDISCLOSED_RECIPIENTS, event_reminder_fields("Event Participant", event_time, event_details))
+        messages.extend(batch_recipients(msg._replace(to_addrs=shared), SMTP_MAX_RECIPIENTS))
+    named = [(name, address) for name, address in recipients if name]
+    rendered = template.render_batch(
+        (formataddr((name, address)), event_reminder_fields(name, event_time, event_details))
+        for name, address in named
     )
-    
-    return msg
+    messages.extend(msg._replace(to_addrs=[address]) for msg, (_, address) in zip(rendered, named))
+    return messages
+
+def build_final_notification_email(receiver_email, num_scheduled, last_email_time):
+    """Render the final notification straight to the bytes sent over SMTP"""
+    template = get_email_template('final_notification', FINAL_NOTIFICATION_SUBJECT)
+    return template.render(receiver_email, final_notification_fields(num_scheduled, last_email_time))
+
+def _report_invalid_rows(problems):
+    if problems:
+        print(format_problems(EVENTS_SCHEMA.name, problems))
+        METRICS.inc('rows_invalid_total', len({problem.row for problem in problems}))
+
+def parse_events_data(source):
+    """Parse an events CSV export from a URL, path or file-like object"""
+    df, problems = EVENTS_SCHEMA.apply(EVENTS_SCHEMA.read_csv(source))
+    _report_invalid_rows(problems)
+    # Both columns are already datetimes: add the time of day to the date
+    df['DateTime'] = df['Date'] + (df['Time'] - df['Time'].dt.normalize())
+    return df
+
+def parse_event_records(data):
+    """Parse an events CSV export into SheetRecords, without pandas"""
+    records, problems = EVENTS_SCHEMA.parse_records(data)
+    _report_invalid_rows(problems)
+    combine = datetime.datetime.combine
+    for row in records:
+        row['DateTime'] = combine(row['Date'].date(), row['Time'].time())
+    records.columns.append('DateTime')
+    return records
+
+def parse_events_bytes(data):
+    """Parse an events CSV export, without pandas when the sheet is small"""
+    if len(data) < SMALL_SHEET_BYTES:
+        try:
+            return parse_event_records(data)
+        except UnsupportedSheet:
+            pass
+    return parse_events_data(io.BytesIO(data))
+
+def _parse_fetched_events(data):
+    with METRICS.timer('parse'):
+        df = parse_events_bytes(data)
+    METRICS.inc('rows_parsed_total', len(df))
+    return df
 
 def load_events_data(url):
     """Load events data from Google Sheet"""
     try:
-        df = pd.read_csv(url)
-        df['Date'] = df['Date'].str.strip()
-        df['Time'] = df['Time'].str.strip()
-        df['DateTime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'], format="%m/%d/%Y %I:%M:%S %p")
-        
-        return df
+        with METRICS.timer('fetch'):
+            data = read_source(url)
+        return _parse_fetched_events(data)
     except Exception as e:
         print(f"Error loading Google Sheet data: {e}")
-        return pd.DataFrame()
+        return SheetRecords()
 
-def schedule_and_send_emails(df, receiver_email=f"{sender_email}"):
-    """Process events and schedule reminder emails"""
-    now = datetime.datetime.now()
-    min_schedule_time = now + datetime.timedelta(minutes=0)
-    
-    scheduled_emails = []
-    ignored_events = []
-    
-    for _, row in df.iterrows():
+def load_changed_events(url, cache, full=False):
+    """Load only the events that are new or changed since the last committed run.
+
+    With ``full``, a sheet with any change is loaded whole, so events that
+    were removed or edited since can be told apart from unchanged ones.
+    """
+    try:
+        with METRICS.timer('fetch'):
+            changes = cache.load_changes(url)
+        if changes.unchanged:
+            return SheetRecords(), changes
+        text = changes.full_text if full else changes.csv_text
+        return _parse_fetched_events(text.encode('utf-8')), changes
+    except Exception as e:
+        print(f"Error loading Google Sheet data: {e}")
+        return SheetRecords(), None
+
+def parse_recipients(value):
+    """Split a Recipients cell into unique (name, address) pairs; the name is empty when not given"""
+    if is_missing(value):
+        return ()
+    recipients = {}
+    for name, address in getaddresses([str(value).replace(";", ",")]):
+        if "@" in address:
+            recipients.setdefault(address.lower(), (name, address))
+        elif name or address:
+            print(f"Skipping invalid recipient: {formataddr((name, address))}")
+    return tuple(recipients.values())
+
+def reminder_job_id(event_details, event_time, reminder_minutes, recipients=()):
+    """Identify a reminder by its content, so an edited event becomes a new job"""
+    job_id = f"{event_time.isoformat()}|{reminder_minutes}|{event_details}"
+    if recipients:
+        job_id += "|" + ",".join(formataddr(recipient) for recipient in recipients)
+    return job_id
+
+def build_reminder_jobs(df, min_schedule_time):
+    """Split events into reminders to schedule and events whose reminder time has passed.
+
+    Both are returned as {job_id: ReminderJob}. For a DataFrame the
+    reminder times, the split and the job ids are computed a whole column
+    at a time, and the only per-row Python objects are the ReminderJobs.
+    """
+    if isinstance(df, SheetRecords):
+        return _build_record_jobs(df, min_schedule_time)
+    if df.empty:
+        return {}, {}
+    import numpy as np
+    import pandas as pd
+
+    event_times = df['DateTime']
+    minutes = df['Reminder Before (minutes)'].astype('int64')
+    reminder_times = event_times - pd.to_timedelta(minutes, unit='m')
+    due = (reminder_times >= min_schedule_time).tolist()
+
+    # Same ids as reminder_job_id(), built for the whole column; numpy formats
+    # ISO timestamps far faster than strftime
+    iso_times = pd.Series(
+        np.datetime_as_string(event_times.to_numpy().astype('datetime64[s]'), unit='s'),
+        index=df.index, dtype='str',
+    )
+    fractional = event_times.dt.microsecond != 0
+    if fractional.any():
+        iso_times[fractional] = np.datetime_as_string(event_times[fractional].to_numpy().astype('datetime64[us]'), unit='us')
+    details = df['Details']
+    job_ids = (iso_times + "|" + minutes.astype(str) + "|" + details.astype(str).fillna('nan')).tolist()
+
+    recipients = [()] * len(df)
+    if EVENT_RECIPIENTS_COLUMN in df.columns:
+        cells = df[EVENT_RECIPIENTS_COLUMN]
+        for position in cells.notna().to_numpy().nonzero()[0].tolist():
+            recipients[position] = parse_recipients(cells.iat[position])
+            if recipients[position]:
+                job_ids[position] += "|" + ",".join(formataddr(recipient) for recipient in recipients[position])
+
+    scheduled = {}
+    ignored = {}
+    for job_id, is_due, event_details, reminder_time, event_time, event_recipients in zip(
+        job_ids, due, details.tolist(), reminder_times.dt.to_pydatetime().tolist(),
+        event_times.dt.to_pydatetime().tolist(), recipients,
+    ):
+        (scheduled if is_due else ignored)[job_id] = ReminderJob(event_details, reminder_time, event_time, event_recipients)
+    return scheduled, ignored
+
+def _build_record_jobs(records, min_schedule_time):
+    """build_reminder_jobs() for small sheets parsed without pandas"""
+    scheduled = {}
+    ignored = {}
+    for row in records:
         event_time = row['DateTime']
         reminder_minutes = int(row['Reminder Before (minutes)'])
-        
+        recipients = parse_recipients(row.get(EVENT_RECIPIENTS_COLUMN))
         reminder_time = event_time - datetime.timedelta(minutes=reminder_minutes)
-        
+        job_id = reminder_job_id(row['Details'], event_time, reminder_minutes, recipients)
+        job = ReminderJob(row['Details'], reminder_time, event_time, recipients)
         if reminder_time >= min_schedule_time:
-            scheduled_emails.append({
-                'event_details': row['Details'],
-                'scheduled_time': reminder_time,
-                'event_time': event_time
-            })
-            print(f"Email will be scheduled for {reminder_time}: {row['Details']}")
+            scheduled[job_id] = job
         else:
-            ignored_events.append({
-                'event_time': event_time,
-                'event_details': row['Details'],
-                'reminder_time': reminder_time
-            })
-            print(f"Ignored event (reminder time too soon): {row['Details']} at {event_time}")
+            ignored[job_id] = job
+    return scheduled, ignored
+
+def recipient_outcomes(sent):
+    """Sort the recipients of done (message, future) pairs by outcome.
+
+    Returns the addresses the server accepted, {address: "code reply"} for
+    those it refused for good, and the addresses still worth retrying.
+    """
+    delivered, failed, deferred = [], {}, []
+    for msg, future in sent:
+        error = future.exception()
+        refused = future.result() if error is None else recipient_refusals(error, msg[1])
+        for address in msg[1]:
+            if address not in refused:
+                delivered.append(address)
+                continue
+            code, reply = refused[address]
+            if code >= 500:
+                failed[address] = f"{code} {reply.decode(errors='replace') if isinstance(reply, bytes) else reply}"
+            else:
+                deferred.append(address)
+    return delivered, failed, deferred
+
+def recover_pending_jobs(store, now, grace_minutes):
+    """Reload pending reminders after a restart, applying the catch-up policy.
+
+    Reminders missed by at most ``grace_minutes`` are kept and go out right
+    away; older ones are marked failed in the store.
+    """
+    recovered = {}
+    oldest_allowed = now - datetime.timedelta(minutes=grace_minutes)
+    for job_id, job in store.pending_jobs().items():
+        if job.scheduled_time >= oldest_allowed:
+            recovered[job_id] = job
+            if job.scheduled_time < now:
+                print(f"Catching up missed reminder from {job.scheduled_time}: {job.event_details}")
+        else:
+            store.mark_failed(job_id, f"missed: process was down at {job.scheduled_time}")
+            print(f"Missed reminder outside the {grace_minutes} minute grace window: {job.event_details}")
+    return recovered
+
+def drop_known_jobs(store, jobs):
+    """Drop jobs the store has already sent or given up on"""
+    states = store.states(jobs)
+    return {
+        job_id: job for job_id, job in jobs.items()
+        if states.get(job_id, PENDING) == PENDING
+    }
+
+def schedule_and_send_emails(df, receiver_email=f"{sender_email}", reload=None, refresh_interval=None,
+                             store=None, grace_minutes=0):
+    """Process events and schedule reminder emails.
+
+    Reminders wait in a priority queue and every reminder that falls due is
+    sent at once over the SMTP connection pool. If ``reload`` is given it is
+    called every ``refresh_interval`` seconds and returns ``(df, complete,
+    done)``: new events in ``df`` are scheduled, when ``complete`` is True
+    pending reminders for events no longer in the sheet are cancelled, and
+    ``done``, unless None, is called once the changes are in the store.
+
+    With a ReminderStore, every reminder's state is persisted, reminders that
+    were already sent are never sent again, and pending reminders left by a
+    previous run are recovered using a ``grace_minutes`` catch-up window.
+    """
+    now = datetime.datetime.now()
+    min_schedule_time = now + datetime.timedelta(minutes=0)
+    
+    with METRICS.timer('plan'):
+        jobs, new_ignored = build_reminder_jobs(df, min_schedule_time)
+    if store is not None:
+        recovered = recover_pending_jobs(store, now, grace_minutes)
+        jobs = drop_known_jobs(store, jobs)
+        new_ignored = {job_id: event for job_id, event in new_ignored.items() if job_id not in recovered}
+        jobs.update(recovered)
+        store.add_pending(jobs)
+    scheduled = {}
+    ignored = {}
+    
+    final_notification = ReminderJob("Final notification", None, None)
+    
+    sender = SMTPSender(
+        EMAIL_SERVER,
+        PORT,
+        username=sender_email,
+        password=password_email,
+        pool_size=SMTP_POOL_SIZE,
+        starttls=SMTP_STARTTLS,
+        metrics=METRICS,
+        max_attempts=SMTP_MAX_ATTEMPTS,
+        retry_delay=SMTP_RETRY_DELAY,
+        max_retry_delay=SMTP_MAX_RETRY_DELAY,
+    )
+    
+    def dispatch(job_id, job):
+        try:
+            with METRICS.timer('render'):
+                if job_id == FINAL_JOB_ID:
+                    messages = [build_final_notification_email(
+                        receiver_email=receiver_email,
+                        num_scheduled=len(scheduled),
+                        last_email_time=job.scheduled_time - datetime.timedelta(minutes=FINAL_NOTIFICATION_DELAY_MINUTES)
+                    )]
+                else:
+                    # Recipients an earlier attempt sent it to or that were refused for good are left out
+                    skip = store.recipient_states(job_id) if store is not None else ()
+                    messages = build_event_reminder_messages(job, receiver_email, skip)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            report_sent(job_id, job, [], future)
+            return future
+        # Every message of one reminder goes out concurrently over the pool
+        futures = []
+        for msg in messages:
+            message_future = sender.submit(msg)
+            message_future.add_done_callback(lambda f, msg=msg: report_message(job, msg, f))
+            futures.append(message_future)
+        sent = list(zip(messages, futures))
+        future = combine_futures(futures)
+        future.add_done_callback(lambda f: report_sent(job_id, job, sent, f))
+        return future
+    
+    def report_message(job, msg, future):
+        error = future.exception()
+        _, to_addrs, _ = msg
+        if error is None:
+            refused = future.result()
+            METRICS.inc('messages_sent_total')
+            METRICS.inc('reminder_recipients_total', len(to_addrs) - len(refused))
+        else:
+            refused = recipient_refusals(error, to_addrs)
+            METRICS.inc('messages_failed_total')
+        for address, (code, reply) in refused.items():
+            if code >= 500:
+                METRICS.inc('reminder_recipients_refused_total')
+                print(f"Recipient refused ({code}): {address}: {job.event_details}")
+            elif error is None:
+                print(f"Recipient deferred ({code}) on every attempt, not sent: {address}: {job.event_details}")
+    
+    def report_sent(job_id, job, sent, future):
+        error = future.exception()
+        delivered, failed, deferred = recipient_outcomes(sent)
+        if error is not None and delivered:
+            print(f"Email sent to {len(delivered)} of {len(delivered) + len(failed) + len(deferred)} "
+                  f"recipients: {job.event_details} ({error})")
+        elif error is not None:
+            print(f"Failed to send email: {job.event_details} ({error})")
+        else:
+            sent_at = datetime.datetime.now()
+            METRICS.observe('reminder_lateness_seconds', (sent_at - job.scheduled_time).total_seconds())
+            if len(sent) > 1:
+                print(f"Email sent at {sent_at} as {len(sent)} messages: {job.event_details}")
+            else:
+                print(f"Email sent at {sent_at}: {job.event_details}")
+        if isinstance(error, SMTPSetupError) and scheduler.stop():
+            print(f"Stopping: fix the SMTP settings and run again; the remaining reminders stay pending ({error})")
+        if store is not None and job_id != FINAL_JOB_ID:
+            store.record_recipients(job_id, delivered, failed)
+            if deferred or (not sent and error is not None):
+                # Still pending, so the next run sends it to the rest within its grace window
+                print(f"Not sent to every recipient, leaving reminder pending: {job.event_details}")
+            elif SENT in store.recipient_states(job_id).values():
+                store.mark_sent(job_id)
+            else:
+                store.mark_failed(job_id, error or "every recipient was refused")
+    
+    scheduler = ReminderScheduler(dispatch)
+    
+    def add_ignored(new_ignored):
+        for job_id, event in new_ignored.items():
+            if job_id not in ignored and job_id not in scheduled:
+                ignored[job_id] = event
+                METRICS.inc('reminders_ignored_total')
+                print(f"Ignored event (reminder time too soon): {event.event_details} at {event.event_time}")
     
-    scheduled_emails.sort(key=lambda x: x['scheduled_time'])
+    def add_jobs(jobs, new_ignored):
+        added = False
+        for job_id, job in jobs.items():
+            if job_id not in scheduled:
+                scheduled[job_id] = job
+                scheduler.schedule(job_id, job.scheduled_time, job)
+                METRICS.inc('reminders_scheduled_total')
+                print(f"Email will be scheduled for {job.scheduled_time}: {job.event_details}")
+                added = True
+        add_ignored(new_ignored)
+        
+        # Keep the final notification FINAL_NOTIFICATION_DELAY_MINUTES after the last reminder
+        if not scheduled:
+            scheduler.cancel(FINAL_JOB_ID)
+            return
+        if not added and not scheduler.is_pending(FINAL_JOB_ID):
+            return
+        last_email_time = max(job.scheduled_time for job in scheduled.values())
+        final_notification.scheduled_time = last_email_time + datetime.timedelta(minutes=FINAL_NOTIFICATION_DELAY_MINUTES)
+        final_notification.event_time = final_notification.scheduled_time
+        scheduler.schedule(FINAL_JOB_ID, final_notification.scheduled_time, final_notification)
+    
+    def refresh():
+        new_df, complete, done = reload()
+        if new_df is not None and not new_df.empty:
+            refresh_jobs(new_df, complete)
+        if done is not None:
+            done()
     
-    if not scheduled_emails:
+    def refresh_jobs(new_df, complete):
+        with METRICS.timer('plan'):
+            jobs, new_ignored = build_reminder_jobs(new_df, datetime.datetime.now())
+        if complete:
+            for job_id in list(scheduled):
+                if job_id not in jobs and scheduler.cancel(job_id):
+                    print(f"Cancelled reminder for removed or changed event: {scheduled[job_id].event_details}")
+                    del scheduled[job_id]
+                    if store is not None:
+                        store.cancel(job_id)
+        jobs = {job_id: job for job_id, job in jobs.items() if job_id not in scheduled}
+        if store is not None:
+            jobs = drop_known_jobs(store, jobs)
+            store.add_pending(jobs)
+        add_jobs(jobs, new_ignored)
+    
+    if not jobs:
+        add_ignored(new_ignored)
         print("No emails to schedule.")
         return {
             'scheduled': [],
-            'ignored': ignored_events,
+            'ignored': list(ignored.values()),
             'total_scheduled': 0,
-            'total_ignored': len(ignored_events)
+            'total_ignored': len(ignored)
         }
     
-    last_email_time = scheduled_emails[-1]['scheduled_time']
-    final_notification_time = last_email_time + datetime.timedelta(minutes=5)
+    add_jobs(jobs, new_ignored)
     
-    scheduled_emails.append({
-        'event_details': "Final notification",
-        'scheduled_time': final_notification_time,
-        'event_time': final_notification_time,
-        'is_final': True
-    })
+    with sender:
+        scheduler.run(refresh if reload else None, refresh_interval)
     
-    with smtplib.SMTP(EMAIL_SERVER, PORT) as server:
-        server.starttls()
-        server.login(sender_email, password_email)
-        
-        for i, email_info in enumerate(scheduled_emails):
-            scheduled_time = email_info['scheduled_time']
-            
-            wait_seconds = (scheduled_time - datetime.datetime.now()).total_seconds()
-            
-            if wait_seconds > 0:
-                print(f"Waiting {wait_seconds} seconds until {scheduled_time} to send email...")
-                time.sleep(wait_seconds)
-            
-            if email_info.get('is_final', False):
-                msg = create_final_notification_email(
-                    receiver_email=receiver_email,
-                    num_scheduled=len(scheduled_emails) - 1,  # Don't count the final notification
-                    last_email_time=last_email_time
-                )
-            else:
-                msg = create_event_reminder_email(
-                    receiver_email=receiver_email,
-                    name="Event Participant",
-                    event_time=email_info['event_time'],
-                    event_details=email_info['event_details']
-                )
-            
-            server.sendmail(sender_email, receiver_email, msg.as_string())
-            print(f"Email sent at {datetime.datetime.now()}: {email_info['event_details']}")
+    lateness = scheduler.lateness_summary()
+    print(
+        f"Reminder lateness over {lateness['count']} emails: "
+        f"p50 {lateness['p50']:.2f}s, p95 {lateness['p95']:.2f}s, max {lateness['max']:.2f}s"
+    )
+    
+    scheduled_emails = sorted(scheduled.values(), key=lambda job: job.scheduled_time)
+    scheduled_emails.append(final_notification)
     
     return {
         'scheduled': scheduled_emails,
-        'ignored': ignored_events,
-        'total_scheduled': len(scheduled_emails) - 1,  # Don't count final notification
-        'total_ignored': len(ignored_events)
+        'ignored': list(ignored.values()),
+        'total_scheduled': len(scheduled),  # Don't count final notification
+        'total_ignored': len(ignored),
+        'failed': len(scheduler.failed),
+        'lateness': lateness
     }
 
-def main():
-    df = load_events_data(URL)
-    if df.empty:
+def report_metrics():
+    """Print the time spent in each stage and export the metrics when METRICS_DIR is set"""
+    summary = METRICS.stage_summary()
+    if summary:
+        print(f"Time per stage (total/calls): {summary}")
+    if METRICS_DIR:
+        METRICS.write(METRICS_DIR)
+        print(f"Metrics written to {METRICS_DIR}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send event reminder emails")
+    add_profiling_arguments(parser, PROFILE_DIR)
+    args = parser.parse_args(argv)
+
+    with profiled(METRICS, args.profile_dir, "static_email_remainder",
+                  cpu=args.profile, memory=args.profile_memory):
+        run()
+
+def run():
+    """Schedule the reminders of the events sheet and send them as they fall due"""
+    # Opened first, so reminders left pending by an earlier run go out even if the sheet is unchanged
+    store = ReminderStore(REMINDER_STORE)
+    changes = None
+    if SHEET_CACHE_DIR:
+        df, changes = load_changed_events(URL, SheetSnapshotCache(SHEET_CACHE_DIR))
+        if changes is not None and changes.unchanged:
+            changes.commit()
+            if store.pending_count() == 0:
+                print("No new or changed events since the last run.")
+                store.close()
+                return
+            print("No new or changed events since the last run; sending the pending reminders.")
+    else:
+        df = load_events_data(URL)
+    
+    if df.empty and store.pending_count() == 0:
         print("No events data loaded. Please check your Google Sheet URL.")
+        store.close()
         return
 
-    result = schedule_and_send_emails(df)
+    reload = None
+    if EVENTS_REFRESH_INTERVAL and changes is not None:
+        cache = SheetSnapshotCache(SHEET_CACHE_DIR)
+        
+        def reload():
+            # A changed sheet is loaded whole, so reminders of removed or edited events are cancelled;
+            # its snapshot is only committed once the new reminders are in the store
+            new_df, new_changes = load_changed_events(URL, cache, full=True)
+            if new_changes is None:
+                return None, False, None
+            if new_changes.unchanged:
+                return None, False, new_changes.commit
+            return new_df, True, new_changes.commit
+    elif EVENTS_REFRESH_INTERVAL:
+        def reload():
+            return load_events_data(URL), True, None
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS, METRICS_PORT, METRICS_HOST)
+        metrics_server.start()
+        print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    try:
+        with store:
+            result = schedule_and_send_emails(
+                df,
+                reload=reload,
+                refresh_interval=EVENTS_REFRESH_INTERVAL,
+                store=store,
+                grace_minutes=CATCH_UP_GRACE_MINUTES,
+            )
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        report_metrics()
+    if changes is not None:
+        changes.commit()
     
     print("\nSummary:")
     print(f"Total emails scheduled and sent: {result['total_scheduled']}")
@@ -226,7 +658,7 @@ def main():
     if result['ignored']:
         print("\nIgnored events:")
         for event in result['ignored']:
-            print(f"  - {event['event_details']} at {event['event_time']}")
+            print(f"  - {event.event_details} at {event.event_time}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,56 @@
+import smtplib
+
+import pytest
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP; ``replies`` decides the outcome of each sendmail() call.
+
+    A reply is an exception to raise, or {address: (code, message)} of the
+    recipients to refuse. Every connection shares the one instance, so
+    ``connections`` and ``sent`` cover the whole pool.
+    """
+
+    def __init__(self, replies=(), login_error=None):
+        self.replies = list(replies)
+        self.login_error = login_error
+        self.connections = 0
+        self.sent = []
+
+    def __call__(self, host, port, timeout=None):
+        self.connections += 1
+        return self
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        if self.login_error is not None:
+            raise self.login_error
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def noop(self):
+        return 250, b"OK"
+
+    def quit(self):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, data):
+        self.sent.append(list(to_addrs))
+        reply = self.replies.pop(0) if self.replies else {}
+        if isinstance(reply, Exception):
+            raise reply
+        refused = {addr: reply[addr] for addr in to_addrs if addr in reply}
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+@pytest.fixture
+def fake_smtp():
+    return FakeSMTP
@@ -0,0 +1,95 @@
+import email
+import email.policy
+from email.message import EmailMessage
+from email.utils import formataddr
+
+import pytest
+
+from email_templates import EmailTemplate
+
+FROM = formataddr(("Amazing Store", "shop@example.com"))
+PLAIN = "Dear $name,\n\nYour order #$order_id has shipped.\n"
+HTML = "<html><body><p>Dear $name,</p><p>Order <strong>#$order_id</strong> has shipped.</p></body></html>\n"
+
+
+def expected_message(subject, to_addr, plain, html):
+    """The message as it was built with EmailMessage before templates were compiled"""
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = FROM
+    msg["To"] = to_addr
+    msg.set_content(plain)
+    msg.add_alternative(html, subtype="html")
+    return msg
+
+
+def parse(data):
+    return email.message_from_bytes(data, policy=email.policy.default)
+
+
+def content(part):
+    return part.get_content().replace("\r\n", "\n")
+
+
+def assert_same_message(rendered, expected):
+    expected = parse(expected.as_bytes(policy=email.policy.SMTP))
+    for name in ("Subject", "From", "To"):
+        assert rendered[name] == expected[name]
+    assert rendered.get_content_type() == expected.get_content_type() == "multipart/alternative"
+    for part, expected_part in zip(rendered.iter_parts(), expected.iter_parts(), strict=True):
+        assert part.get_content_type() == expected_part.get_content_type()
+        assert part.get_content_charset() == "utf-8"
+        assert content(part) == content(expected_part)
+
+
+@pytest.mark.parametrize("name, subject", [
+    ("Ann", "Your Order #$order_id Has Been Shipped"),
+    ("Zoë Müller", "Commande n°$order_id expédiée — merci"),
+])
+def test_render_matches_the_email_message_output(name, subject):
+    template = EmailTemplate(subject, PLAIN, HTML, FROM)
+    fields = {"name": name, "order_id": "1042"}
+    rendered = template.render("ann@example.com", fields)
+
+    assert rendered.from_addr == "shop@example.com"
+    assert rendered.to_addrs == ["ann@example.com"]
+    assert b"\r\n" in rendered.data and b"\n" not in rendered.data.replace(b"\r\n", b"")
+    expected = expected_message(subject.replace("$order_id", "1042"), "ann@example.com",
+                                PLAIN.replace("$name", name).replace("$order_id", "1042"),
+                                HTML.replace("$name", name).replace("$order_id", "1042"))
+    assert_same_message(parse(rendered.data), expected)
+    assert_same_message(template.render_message("ann@example.com", fields), expected)
+
+
+def test_non_ascii_subject_is_encoded():
+    template = EmailTemplate("Réservation $order_id", PLAIN, HTML, FROM)
+    data = template.render("ann@example.com", {"name": "Ann", "order_id": "7"}).data
+    subject_line = next(line for line in data.split(b"\r\n") if line.startswith(b"Subject:"))
+    assert subject_line.startswith(b"Subject: =?utf-8?")
+    assert parse(data)["Subject"] == "Réservation 7"
+
+
+def test_newlines_in_fields_cannot_add_headers():
+    template = EmailTemplate("Order $order_id", PLAIN, HTML, FROM)
+    data = template.render("ann@example.com", {"name": "Ann", "order_id": "7\nBcc: eve@example.com"}).data
+    msg = parse(data)
+    assert msg["Bcc"] is None
+    assert msg["Subject"] == "Order 7 Bcc: eve@example.com"
+
+
+def test_long_lines_are_quoted_printable():
+    template = EmailTemplate("Order", "$text\n", HTML, FROM)
+    text = "x" * 2000
+    data = template.render("ann@example.com", {"text": text, "name": "Ann", "order_id": "7"}).data
+    assert max(len(line) for line in data.split(b"\r\n")) <= 998
+    plain = next(parse(data).iter_parts())
+    assert plain["Content-Transfer-Encoding"] == "quoted-printable"
+    assert content(plain) == text + "\n"
+
+
+def test_body_containing_the_boundary_gets_a_new_one():
+    template = EmailTemplate("Order", "$text\n", HTML, FROM)
+    text = f"--{template.boundary}"
+    msg = parse(template.render("ann@example.com", {"text": text, "name": "Ann", "order_id": "7"}).data)
+    assert msg.get_boundary() != template.boundary
+    assert content(next(msg.iter_parts())) == text + "\n"
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from outbox import Outbox
+from sent_ledger import SentLedger
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    with Outbox(tmp_path / "sent_orders.db", visibility_timeout=60, max_attempts=2,
+                retry_delay=10, max_retry_delay=10) as outbox:
+        yield outbox
+
+
+def enqueue(outbox, order_id):
+    email = ("shop@example.com", [f"{order_id}@example.com"], b"Subject: order\r\n\r\nShipped\r\n")
+    outbox.enqueue([("shipping", [(order_id, "shipping", f"{order_id}@example.com")], email)])
+
+
+def state(outbox):
+    return outbox._conn.execute("SELECT state FROM outbox").fetchone()[0]
+
+
+def rows(outbox, table):
+    return outbox._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_claimed_message_is_hidden_until_the_visibility_timeout(outbox):
+    enqueue(outbox, "1")
+    now = time.time()
+    [message] = outbox.claim(10, now=now)
+    assert message.attempts == 1
+    assert message.email[1] == ["1@example.com"]
+    assert outbox.claim(10, now=now + 59) == []
+
+    [again] = outbox.claim(10, now=now + 61)
+    assert again.message_id == message.message_id
+    assert again.attempts == 2
+    assert again.claim_token != message.claim_token
+
+
+def test_ack_records_the_notifications_as_sent(outbox, tmp_path):
+    enqueue(outbox, "1")
+    assert outbox.sent_keys([("1", "shipping")]) == {("1", "shipping")}
+    [message] = outbox.claim(10)
+    assert outbox.ack(message)
+    with SentLedger(tmp_path / "sent_orders.db") as ledger:
+        assert ledger.is_sent("1", "shipping")
+
+
+def test_ack_removes_the_message_from_the_outbox(outbox):
+    enqueue(outbox, "1")
+    enqueue(outbox, "2")
+    [first, second] = outbox.claim(10)
+    outbox.ack(first)
+    assert rows(outbox, "outbox") == rows(outbox, "outbox_notifications") == 1
+    outbox.ack(second)
+    assert rows(outbox, "outbox") == rows(outbox, "outbox_notifications") == 0
+    assert outbox.sent_keys([("1", "shipping"), ("2", "shipping")]) == {("1", "shipping"), ("2", "shipping")}
+
+
+def test_sent_messages_left_by_earlier_versions_are_pruned(outbox, tmp_path):
+    enqueue(outbox, "1")
+    enqueue(outbox, "2")
+    outbox._conn.execute("UPDATE outbox SET state = 'sent' WHERE message_id = 1")
+    with Outbox(tmp_path / "sent_orders.db") as reopened:
+        assert rows(reopened, "outbox") == rows(reopened, "outbox_notifications") == 1
+        assert reopened.sent_keys([("1", "shipping"), ("2", "shipping")]) == {("2", "shipping")}
+
+
+def test_ack_under_a_stale_claim_changes_nothing(outbox, tmp_path):
+    enqueue(outbox, "1")
+    now = time.time()
+    [stale] = outbox.claim(10, now=now)
+    [current] = outbox.claim(10, now=now + 61)
+
+    assert not outbox.ack(stale)
+    assert state(outbox) == "pending"
+    with SentLedger(tmp_path / "sent_orders.db") as ledger:
+        assert not ledger.is_sent("1", "shipping")
+    assert outbox.ack(current)
+
+
+def test_release_retries_after_a_backoff_then_gives_up(outbox):
+    enqueue(outbox, "1")
+    [message] = outbox.claim(10)
+    assert outbox.release(message, "451 try later")
+    assert outbox.claim(10) == []
+
+    [message] = outbox.claim(10, now=time.time() + 11)
+    assert not outbox.release(message, "451 try later")
+    assert state(outbox) == "failed"
+    # Forgotten, so the next planning run queues the notification again
+    assert outbox.sent_keys([("1", "shipping")]) == set()
+
+
+def test_permanent_release_records_the_notifications_as_failed(outbox, tmp_path):
+    enqueue(outbox, "1")
+    [message] = outbox.claim(10)
+    assert not outbox.release(message, "550 no such user", permanent=True)
+    assert state(outbox) == "failed"
+    with SentLedger(tmp_path / "sent_orders.db") as ledger:
+        assert ledger.failed() == [("1", "shipping", "1@example.com", "550 no such user")]
+
+
+def test_release_without_an_attempt_is_ready_at_once(outbox):
+    enqueue(outbox, "1")
+    [message] = outbox.claim(10)
+    assert outbox.release(message, "login refused", attempted=False)
+    [again] = outbox.claim(10)
+    assert again.attempts == 1
@@ -0,0 +1,107 @@
+import pytest
+
+from rate_limiter import AdaptiveRateLimiter
+
+
+class FakeClock:
+    """A clock that only moves when the limiter sleeps or the test advances it.
+
+    The tests use rates that are powers of two, so every interval is exact.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def limiter(clock, rate, **kwargs):
+    return AdaptiveRateLimiter(rate, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_burst_is_sent_without_waiting(clock):
+    bucket = limiter(clock, 8, burst=5)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [0.125]
+
+
+def test_tokens_refill_at_the_rate_up_to_the_burst(clock):
+    bucket = limiter(clock, 8, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 0.25
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+
+    clock.now += 60
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert len(clock.sleeps) == 1
+
+
+def test_sends_keep_to_the_rate(clock):
+    bucket = limiter(clock, 16)
+    for _ in range(81):
+        bucket.acquire()
+    assert clock.now == 5.0
+
+
+def test_deferral_halves_the_rate_once_per_interval(clock):
+    bucket = limiter(clock, 8, min_rate=1)
+    bucket.on_deferral()
+    bucket.on_deferral()
+    assert bucket.current_rate == 4
+    clock.now += 0.25
+    bucket.on_deferral()
+    assert bucket.current_rate == 2
+    for _ in range(3):
+        clock.now += 1
+        bucket.on_deferral()
+    assert bucket.current_rate == 1
+    assert bucket.deferrals == 6
+
+
+def test_deferral_empties_the_bucket(clock):
+    bucket = limiter(clock, 8, burst=5)
+    bucket.on_deferral()
+    bucket.acquire()
+    assert clock.sleeps == [0.25]
+
+
+def test_successes_recover_the_rate_up_to_the_maximum(clock):
+    bucket = limiter(clock, 8, increase_step=1)
+    bucket.on_deferral()
+    for _ in range(3):
+        bucket.on_success()
+    assert bucket.current_rate == 7
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.stats() == {
+        'current_rate': 8,
+        'max_rate': 8,
+        'utilization': 1,
+        'successes': 13,
+        'deferrals': 1,
+    }
+
+
+def test_rate_must_be_positive():
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter(0)
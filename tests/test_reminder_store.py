@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+from reminder_store import ReminderJob, ReminderStore, FAILED, PENDING, SENT
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "reminder_jobs.db"
+
+
+def job(minutes_from_now, recipients=()):
+    scheduled_time = datetime.datetime(2026, 1, 1, 12, 0) + datetime.timedelta(minutes=minutes_from_now)
+    return ReminderJob(f"Event in {minutes_from_now} minutes", scheduled_time,
+                       scheduled_time + datetime.timedelta(minutes=30), recipients)
+
+
+def test_pending_jobs_are_resumed_after_a_restart(db_path):
+    jobs = {"early": job(5), "late": job(10, (("Ann", "ann@example.com"), ("", "bo@example.com")))}
+    with ReminderStore(db_path) as store:
+        store.add_pending(jobs)
+        store.mark_sent("early")
+
+    with ReminderStore(db_path) as store:
+        pending = store.pending_jobs()
+        assert list(pending) == ["late"]
+        assert pending["late"].scheduled_time == jobs["late"].scheduled_time
+        assert pending["late"].event_time == jobs["late"].event_time
+        assert pending["late"].recipients == jobs["late"].recipients
+        assert store.states(["early", "late", "unknown"]) == {"early": SENT, "late": PENDING}
+
+
+def test_add_pending_keeps_the_state_of_known_jobs(db_path):
+    with ReminderStore(db_path) as store:
+        store.add_pending({"a": job(5)})
+        store.mark_failed("a", "missed")
+        store.add_pending({"a": job(5), "b": job(6)})
+        assert store.states(["a", "b"]) == {"a": FAILED, "b": PENDING}
+        assert store.pending_count() == 1
+
+
+def test_recover_pending_jobs_applies_the_grace_window(db_path):
+    from static_email_remainder import recover_pending_jobs
+
+    now = datetime.datetime(2026, 1, 1, 12, 20)
+    with ReminderStore(db_path) as store:
+        store.add_pending({"missed": job(0), "catch-up": job(10), "future": job(30)})
+        recovered = recover_pending_jobs(store, now, grace_minutes=15)
+        assert sorted(recovered) == ["catch-up", "future"]
+        assert store.states(["missed"]) == {"missed": FAILED}
+
+
+def test_recipient_outcomes_are_kept_until_the_job_is_cancelled(db_path):
+    with ReminderStore(db_path) as store:
+        store.add_pending({"a": job(5)})
+        store.record_recipients("a", ["ann@example.com"], {"bad@example.com": "550 no such user"})
+    with ReminderStore(db_path) as store:
+        assert store.recipient_states("a") == {"ann@example.com": SENT, "bad@example.com": FAILED}
+        store.cancel("a")
+        assert store.recipient_states("a") == {}
+        assert store.pending_count() == 0
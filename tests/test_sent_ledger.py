@@ -0,0 +1,145 @@
+import os
+import socket
+
+import pytest
+
+from sent_ledger import SentLedger, migrate_csv, owner_alive
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "sent_orders.db"
+
+
+def states(ledger):
+    rows = ledger._conn.execute("SELECT order_id, notification_type, state FROM sent_notifications")
+    return {(order_id, notification_type): state for order_id, notification_type, state in rows}
+
+
+def test_recorded_notifications_are_sent_once_flushed(db_path):
+    with SentLedger(db_path, batch_size=10) as ledger:
+        ledger.record(1, "a@example.com", "shipping")
+        # Buffered writes already count for this process
+        assert ledger.is_sent("1", "shipping")
+        assert ledger.count() == 0
+    with SentLedger(db_path) as ledger:
+        assert ledger.count() == 1
+        assert ledger.is_sent(1, "shipping")
+        assert not ledger.is_sent(1, "delivery")
+
+
+def test_sent_keys_looks_up_many_keys_at_once(db_path):
+    with SentLedger(db_path, batch_size=100) as ledger:
+        for order_id in range(0, 1000, 2):
+            ledger.record(order_id, "a@example.com", "confirmation")
+        ledger.flush()
+        keys = [(order_id, "confirmation") for order_id in range(1000)] + [(0, "delivery")]
+        assert ledger.sent_keys(keys) == {(str(order_id), "confirmation") for order_id in range(0, 1000, 2)}
+
+
+def test_recording_twice_keeps_one_entry(db_path):
+    with SentLedger(db_path) as ledger:
+        ledger.record(1, "a@example.com", "shipping")
+        ledger.flush()
+        ledger.record(1, "a@example.com", "shipping")
+    with SentLedger(db_path) as ledger:
+        assert states(ledger) == {("1", "shipping"): "sent"}
+
+
+def test_migrate_csv_can_be_run_again(db_path, tmp_path):
+    csv_path = tmp_path / "sent_orders.csv"
+    csv_path.write_text(
+        "order_id,customer_email,notification_type,sent_timestamp\n"
+        "1,a@example.com,confirmation,2024-01-01 10:00:00\n"
+        "1,a@example.com,shipping,2024-01-02 10:00:00\n"
+        "short,row\n",
+        encoding="utf-8",
+    )
+    assert migrate_csv(csv_path, db_path) == 2
+    assert migrate_csv(csv_path, db_path) == 2
+    with SentLedger(db_path) as ledger:
+        assert ledger.count() == 2
+        assert ledger.sent_keys([("1", "confirmation"), ("1", "shipping")]) == {("1", "confirmation"), ("1", "shipping")}
+
+
+def test_reservation_counts_as_sent_for_other_owners(db_path):
+    with SentLedger(db_path, owner="host:1:a") as first, SentLedger(db_path, owner="host:2:b") as second:
+        assert first.reserve([("1", "shipping", "a@example.com")])
+        assert not second.reserve([("1", "shipping", "a@example.com")])
+        assert second.sent_keys([("1", "shipping"), ("2", "shipping")]) == {("1", "shipping")}
+        assert first.reserved() == [("1", "shipping", "a@example.com", "host:1:a")]
+
+
+def test_reserve_batches_reserves_each_batch_whole_or_not_at_all(db_path):
+    with SentLedger(db_path, owner="host:1:a") as other:
+        other.reserve([("2", "shipping", "b@example.com")])
+    with SentLedger(db_path, owner="host:2:b") as ledger:
+        results = ledger.reserve_batches([
+            [("1", "shipping", "a@example.com")],
+            [("2", "shipping", "b@example.com"), ("3", "shipping", "b@example.com")],
+            [("4", "shipping", "c@example.com")],
+        ])
+        assert results == [True, False, True]
+        assert sorted(row[0] for row in ledger.reserved("host:2:b")) == ["1", "4"]
+        assert not ledger.is_sent("3", "shipping")
+
+
+def test_reserve_batches_commits_all_batches_at_once(db_path):
+    with SentLedger(db_path) as ledger:
+        statements = []
+        ledger._conn.set_trace_callback(statements.append)
+        ledger.reserve_batches([
+            [("2", "shipping", "b@example.com")],
+            [("3", "delivery", "c@example.com")],
+        ])
+        assert statements[0] == "BEGIN IMMEDIATE"
+        assert statements.count("COMMIT") == 1
+        assert ledger.count() == 2
+
+
+def test_record_turns_a_reservation_into_a_sent_entry(db_path):
+    with SentLedger(db_path) as ledger:
+        ledger.reserve([("1", "shipping", "a@example.com")])
+        ledger.record("1", "a@example.com", "shipping")
+        ledger.flush()
+        assert states(ledger) == {("1", "shipping"): "sent"}
+        assert ledger.reserved() == []
+
+
+def test_release_only_drops_this_owners_reservations(db_path):
+    with SentLedger(db_path, owner="host:1:a") as first, SentLedger(db_path, owner="host:2:b") as second:
+        first.reserve([("1", "shipping", "a@example.com")])
+        second.release([("1", "shipping")])
+        assert second.is_sent("1", "shipping")
+        first.release([("1", "shipping")])
+        assert not second.is_sent("1", "shipping")
+
+
+def test_release_reserved_only_releases_the_given_owners(db_path):
+    for owner, order_id in [("host:1:a", "1"), ("host:2:b", "2")]:
+        with SentLedger(db_path, owner=owner) as ledger:
+            ledger.reserve([(order_id, "shipping", "a@example.com")])
+    with SentLedger(db_path) as ledger:
+        assert ledger.release_reserved(["host:1:a"]) == 1
+        assert [row[3] for row in ledger.reserved()] == ["host:2:b"]
+
+
+def test_owner_alive():
+    host = socket.gethostname()
+    assert owner_alive(f"{host}:{os.getpid()}:abcd1234") is True
+    assert owner_alive(f"{host}:999999999:abcd1234") is False
+    assert owner_alive(f"{host}-elsewhere:{os.getpid()}:abcd1234") is None
+    assert owner_alive("not an owner") is None
+
+
+def test_mark_failed_until_release_failed(db_path):
+    with SentLedger(db_path) as ledger:
+        ledger.reserve([("1", "shipping", "a@example.com"), ("2", "shipping", "b@example.com")])
+        ledger.mark_failed([("1", "shipping")], "550 no such user")
+        assert states(ledger) == {("1", "shipping"): "failed", ("2", "shipping"): "reserved"}
+        assert ledger.failed() == [("1", "shipping", "a@example.com", "550 no such user")]
+        assert ledger.is_sent("1", "shipping")
+
+        assert ledger.release_failed() == 1
+        assert not ledger.is_sent("1", "shipping")
+        assert ledger.is_sent("2", "shipping")
@@ -0,0 +1,96 @@
+from sheet_cache import FetchResult, SheetSnapshotCache
+
+URL = "https://example.com/sheet.csv"
+HEADER = "order_id,email,status\r\n"
+
+
+class StubFetcher:
+    """Serves ``body`` with a validator that changes whenever the body is replaced"""
+
+    def __init__(self, body):
+        self.body = body
+        self.version = 0
+
+    def serve(self, body):
+        self.body = body
+        self.version += 1
+
+    def fetch(self, url, etag=None, last_modified=None):
+        validator = f'"v{self.version}"'
+        if validator == etag:
+            return FetchResult(None, etag, last_modified)
+        return FetchResult(self.body.encode('utf-8'), validator, None)
+
+
+def sheet(*rows):
+    return HEADER + "".join(row + "\r\n" for row in rows)
+
+
+def open_cache(tmp_path, body):
+    fetcher = StubFetcher(body)
+    return SheetSnapshotCache(tmp_path / "cache", fetcher=fetcher), fetcher
+
+
+def test_rows_are_new_until_the_snapshot_is_committed(tmp_path):
+    cache, _ = open_cache(tmp_path, sheet("1,a@example.com,shipped", "2,b@example.com,pending"))
+    first = cache.load_changes(URL)
+    assert (first.changed_rows, first.total_rows) == (2, 2)
+    assert cache.load_changes(URL).changed_rows == 2
+
+    first.commit()
+    changes = cache.load_changes(URL)
+    assert changes.unchanged
+    assert changes.total_rows == 2
+    assert changes.full_text is None
+
+
+def test_same_bytes_behind_a_new_validator_are_unchanged(tmp_path):
+    body = sheet("1,a@example.com,shipped")
+    cache, fetcher = open_cache(tmp_path, body)
+    cache.load_changes(URL).commit()
+    fetcher.serve(body)
+    assert cache.load_changes(URL).unchanged
+
+
+def test_only_changed_rows_are_returned(tmp_path):
+    cache, fetcher = open_cache(tmp_path, sheet("1,a@example.com,shipped", "2,b@example.com,pending"))
+    cache.load_changes(URL).commit()
+    fetcher.serve(sheet("1,a@example.com,shipped", "2,b@example.com,shipped", "3,c@example.com,pending"))
+
+    changes = cache.load_changes(URL)
+    assert (changes.changed_rows, changes.total_rows) == (2, 3)
+    assert changes.csv_text == sheet("2,b@example.com,shipped", "3,c@example.com,pending")
+    assert changes.full_text == fetcher.body
+
+
+def test_truncated_sheet_has_no_changed_rows(tmp_path):
+    cache, fetcher = open_cache(tmp_path, sheet("1,a@example.com,shipped", "2,b@example.com,pending"))
+    cache.load_changes(URL).commit()
+    fetcher.serve(sheet("1,a@example.com,shipped"))
+
+    changes = cache.load_changes(URL)
+    assert changes.unchanged
+    assert changes.total_rows == 1
+    changes.commit()
+
+    # The dropped row is no longer in the snapshot, so bringing it back counts as a change
+    fetcher.serve(sheet("1,a@example.com,shipped", "2,b@example.com,pending"))
+    changes = cache.load_changes(URL)
+    assert changes.csv_text == sheet("2,b@example.com,pending")
+
+
+def test_emptied_sheet_has_no_rows(tmp_path):
+    cache, fetcher = open_cache(tmp_path, sheet("1,a@example.com,shipped"))
+    cache.load_changes(URL).commit()
+    fetcher.serve("")
+
+    changes = cache.load_changes(URL)
+    assert changes.unchanged
+    assert changes.total_rows == 0
+
+
+def test_new_header_makes_every_row_new(tmp_path):
+    cache, fetcher = open_cache(tmp_path, sheet("1,a@example.com,shipped"))
+    cache.load_changes(URL).commit()
+    fetcher.serve("order_id,status,email\r\n1,shipped,a@example.com\r\n")
+    assert cache.load_changes(URL).changed_rows == 1
@@ -0,0 +1,177 @@
+import smtplib
+
+import pytest
+
+from smtp_pool import (SMTPSender, SMTPSetupError, is_permanent_failure, is_setup_failure,
+                       pipelined_sendmail, recipient_refusals)
+
+MESSAGE = ("shop@example.com", ["ann@example.com"], b"Subject: hi\r\n\r\nHello\r\n")
+
+
+class PipeliningSMTP:
+    """Stands in for an smtplib.SMTP connection to a server that offers PIPELINING.
+
+    ``replies`` are the (code, message) pairs getreply() returns in order;
+    everything written with send() is kept in ``written``.
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.written = []
+        self.resets = 0
+        self.closed = False
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name == 'pipelining'
+
+    def send(self, data):
+        self.written.append(data)
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def rset(self):
+        self.resets += 1
+
+    def close(self):
+        self.closed = True
+
+
+def send(factory, messages, max_attempts=3):
+    with SMTPSender("smtp.example.com", 587, username="shop", password="secret", pool_size=1,
+                    smtp_factory=factory, max_attempts=max_attempts, retry_delay=0.001) as sender:
+        futures = [sender.submit(msg) for msg in messages]
+    return futures
+
+
+@pytest.mark.parametrize("error, permanent", [
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"no such user")}), True),
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"no"), "b@example.com": (451, b"later")}), False),
+    (smtplib.SMTPSenderRefused(553, b"bad sender", "shop@example.com"), True),
+    (smtplib.SMTPDataError(554, b"rejected"), True),
+    (smtplib.SMTPDataError(451, b"try later"), False),
+    (smtplib.SMTPAuthenticationError(535, b"bad credentials"), False),
+    (SMTPSetupError(smtplib.SMTPAuthenticationError(535, b"bad credentials")), False),
+    (smtplib.SMTPServerDisconnected("gone"), False),
+])
+def test_is_permanent_failure(error, permanent):
+    assert is_permanent_failure(error) is permanent
+
+
+@pytest.mark.parametrize("error, setup", [
+    (smtplib.SMTPAuthenticationError(535, b"bad credentials"), True),
+    (smtplib.SMTPNotSupportedError("no STARTTLS"), True),
+    (smtplib.SMTPConnectError(554, b"go away"), True),
+    (smtplib.SMTPConnectError(421, b"busy"), False),
+    (ConnectionRefusedError(), False),
+])
+def test_is_setup_failure(error, setup):
+    assert is_setup_failure(error) is setup
+
+
+def test_recipient_refusals():
+    to_addrs = ["a@example.com", "b@example.com"]
+    assert recipient_refusals(smtplib.SMTPDataError(554, b"rejected"), to_addrs) == {
+        "a@example.com": (554, b"rejected"), "b@example.com": (554, b"rejected"),
+    }
+    # No reply from the server, so it might still accept them
+    assert {code for code, _ in recipient_refusals(smtplib.SMTPServerDisconnected("gone"), to_addrs).values()} == {451}
+
+
+def test_temporary_failure_is_retried_until_accepted(fake_smtp):
+    factory = fake_smtp([smtplib.SMTPDataError(451, b"try later"), smtplib.SMTPDataError(451, b"try later")])
+    [future] = send(factory, [MESSAGE])
+    assert future.result() == {}
+    assert len(factory.sent) == 3
+
+
+def test_temporary_failure_fails_after_the_last_attempt(fake_smtp):
+    factory = fake_smtp([smtplib.SMTPDataError(451, b"try later")] * 3)
+    [future] = send(factory, [MESSAGE])
+    assert isinstance(future.exception(), smtplib.SMTPDataError)
+    assert not is_permanent_failure(future.exception())
+    assert len(factory.sent) == 3
+
+
+def test_permanent_failure_is_not_retried(fake_smtp):
+    factory = fake_smtp([{"ann@example.com": (550, b"no such user")}])
+    [future] = send(factory, [MESSAGE])
+    assert is_permanent_failure(future.exception())
+    assert len(factory.sent) == 1
+
+
+def test_refused_login_fails_every_message_without_reconnecting(fake_smtp):
+    factory = fake_smtp([], login_error=smtplib.SMTPAuthenticationError(535, b"bad credentials"))
+    futures = send(factory, [MESSAGE] * 5)
+    assert factory.connections == 1
+    for future in futures:
+        assert isinstance(future.exception(), SMTPSetupError)
+        assert not is_permanent_failure(future.exception())
+
+
+def test_deferred_recipients_are_retried_on_their_own(fake_smtp):
+    msg = ("shop@example.com", ["ok@example.com", "bad@example.com", "busy@example.com"], b"data")
+    factory = fake_smtp([{"bad@example.com": (550, b"no such user"), "busy@example.com": (451, b"try later")}])
+    [future] = send(factory, [msg])
+    assert future.result() == {"bad@example.com": (550, b"no such user")}
+    assert factory.sent == [msg[1], ["busy@example.com"]]
+
+
+def test_recipients_deferred_on_every_attempt_are_reported(fake_smtp):
+    msg = ("shop@example.com", ["ok@example.com", "busy@example.com"], b"data")
+    factory = fake_smtp([{"busy@example.com": (451, b"try later")}] * 3)
+    [future] = send(factory, [msg])
+    assert future.result() == {"busy@example.com": (451, b"try later")}
+    assert factory.sent == [msg[1], ["busy@example.com"], ["busy@example.com"]]
+
+
+def test_pipelined_sendmail_sends_the_envelope_in_one_write():
+    server = PipeliningSMTP((250, b"OK"), (250, b"OK"), (354, b"Go ahead"), (250, b"Queued"))
+    assert pipelined_sendmail(server, *MESSAGE) == {}
+    assert server.written == [
+        "MAIL FROM:<shop@example.com>\r\nRCPT TO:<ann@example.com>\r\nDATA\r\n",
+        b"Subject: hi\r\n\r\nHello\r\n.\r\n",
+    ]
+    assert server.replies == []
+
+
+def test_pipelined_sendmail_returns_the_refused_recipients():
+    server = PipeliningSMTP((250, b"OK"), (250, b"OK"), (550, b"no such user"), (354, b"Go ahead"),
+                            (250, b"Queued"))
+    refused = pipelined_sendmail(server, "shop@example.com", ["ann@example.com", "bob@example.com"],
+                                 b"Hello\r\n")
+    assert refused == {"bob@example.com": (550, b"no such user")}
+    assert server.written[-1] == b"Hello\r\n.\r\n"
+
+
+def test_pipelined_sendmail_resets_when_every_recipient_is_refused():
+    server = PipeliningSMTP((250, b"OK"), (550, b"no such user"), (451, b"later"),
+                            (554, b"no valid recipients"))
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as error:
+        pipelined_sendmail(server, "shop@example.com", ["ann@example.com", "bob@example.com"], b"Hello\r\n")
+    assert error.value.recipients == {"ann@example.com": (550, b"no such user"),
+                                      "bob@example.com": (451, b"later")}
+    assert len(server.written) == 1
+    assert server.resets == 1
+
+
+@pytest.mark.parametrize("replies, code", [
+    ([(250, b"OK"), (250, b"OK"), (451, b"try later")], 451),
+    ([(250, b"OK"), (250, b"OK"), (354, b"Go ahead"), (554, b"rejected")], 554),
+])
+def test_pipelined_sendmail_raises_when_data_is_rejected(replies, code):
+    server = PipeliningSMTP(*replies)
+    with pytest.raises(smtplib.SMTPDataError) as error:
+        pipelined_sendmail(server, *MESSAGE)
+    assert error.value.smtp_code == code
+    assert server.resets == 1
+    assert server.replies == []
+
+
+def test_pipelined_sendmail_escapes_lines_starting_with_a_period():
+    server = PipeliningSMTP((250, b"OK"), (250, b"OK"), (354, b"Go ahead"), (250, b"Queued"))
+    pipelined_sendmail(server, "shop@example.com", ["ann@example.com"], b".hidden\r\nmid.dle\r\n.\r\nend")
+    assert server.written[-1] == b"..hidden\r\nmid.dle\r\n..\r\nend\r\n.\r\n"
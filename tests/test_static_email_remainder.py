@@ -0,0 +1,108 @@
+import datetime
+import functools
+import smtplib
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from reminder_store import ReminderJob
+from smtp_pool import SMTPSender
+from static_email_remainder import build_event_reminder_messages, recipient_outcomes
+
+
+def done(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def test_recipient_outcomes_sorts_recipients_by_reply():
+    sent = [
+        (("me@example.com", ["a@example.com", "b@example.com", "c@example.com"], b"data"),
+         done({"b@example.com": (550, b"no such user"), "c@example.com": (452, b"mailbox full")})),
+        (("me@example.com", ["d@example.com"], b"data"), done(error=smtplib.SMTPServerDisconnected("gone"))),
+        (("me@example.com", ["e@example.com"], b"data"), done(error=smtplib.SMTPDataError(554, b"rejected"))),
+    ]
+    delivered, failed, deferred = recipient_outcomes(sent)
+    assert delivered == ["a@example.com"]
+    assert failed == {"b@example.com": "550 no such user", "e@example.com": "554 rejected"}
+    assert deferred == ["c@example.com", "d@example.com"]
+
+
+def test_reminder_messages_leave_out_settled_recipients():
+    event_time = datetime.datetime(2026, 1, 1, 12, 0)
+    job = ReminderJob("Launch", event_time, event_time,
+                      (("", "a@example.com"), ("", "b@example.com"), ("", "c@example.com"), ("Ann", "ann@example.com")))
+    messages = build_event_reminder_messages(job, "me@example.com", skip={"b@example.com": "sent", "ann@example.com": "failed"})
+    assert [msg.to_addrs for msg in messages] == [["a@example.com", "c@example.com"]]
+
+
+def write_events(path, *events):
+    """Write an events sheet of (details, event_time, reminder_minutes, recipients)"""
+    lines = ["Date,Time,Details,Reminder Before (minutes),Recipients"]
+    for details, event_time, minutes, recipients in events:
+        lines.append(f"{event_time:%m/%d/%Y},{event_time:%I:%M:%S %p},{details},{minutes},{recipients}")
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+@pytest.fixture
+def reminders(tmp_path, monkeypatch):
+    """Point the reminder script at a sheet, snapshot cache and store under tmp_path"""
+    import static_email_remainder
+
+    sheet = tmp_path / "events.csv"
+    monkeypatch.setattr(static_email_remainder, "URL", str(sheet))
+    monkeypatch.setattr(static_email_remainder, "SHEET_CACHE_DIR", str(tmp_path / "sheet_cache"))
+    monkeypatch.setattr(static_email_remainder, "REMINDER_STORE", str(tmp_path / "reminder_jobs.db"))
+    monkeypatch.setattr(static_email_remainder, "EVENTS_REFRESH_INTERVAL", 0)
+    monkeypatch.setattr(static_email_remainder, "FINAL_NOTIFICATION_DELAY_MINUTES", 0)
+    monkeypatch.setattr(static_email_remainder, "sender_email", "me@example.com")
+    monkeypatch.setattr(static_email_remainder, "password_email", "secret")
+    monkeypatch.setattr(static_email_remainder, "METRICS_DIR", None)
+    monkeypatch.setattr(static_email_remainder, "METRICS_PORT", None)
+
+    def run(factory):
+        monkeypatch.setattr(static_email_remainder, "SMTPSender",
+                            functools.partial(SMTPSender, smtp_factory=factory, retry_delay=0.001))
+        static_email_remainder.run()
+
+    return sheet, run
+
+
+def test_unchanged_sheet_still_sends_reminders_left_pending(reminders, fake_smtp):
+    sheet, run = reminders
+    write_events(sheet, ("Launch", datetime.datetime.now() + datetime.timedelta(minutes=1, seconds=1), 1, "ann@example.com"))
+
+    refused = fake_smtp(login_error=smtplib.SMTPAuthenticationError(535, b"bad credentials"))
+    run(refused)
+    assert refused.sent == []
+
+    working = fake_smtp()
+    run(working)
+    assert ["ann@example.com"] in working.sent
+
+
+def test_editing_an_event_during_a_run_sends_one_reminder(reminders, fake_smtp, monkeypatch):
+    import static_email_remainder
+
+    monkeypatch.setattr(static_email_remainder, "EVENTS_REFRESH_INTERVAL", 0.2)
+    sheet, run = reminders
+    start = datetime.datetime.now()
+    write_events(sheet, ("Launch", start + datetime.timedelta(minutes=1, seconds=3), 1, "ann@example.com"))
+
+    def edit():
+        time.sleep(0.5)
+        write_events(sheet, ("Launch", start + datetime.timedelta(minutes=1, seconds=5), 1, "ann@example.com"))
+
+    editor = threading.Thread(target=edit)
+    editor.start()
+    factory = fake_smtp()
+    run(factory)
+    editor.join()
+    assert factory.sent.count(["ann@example.com"]) == 1
+    assert datetime.datetime.now() >= start + datetime.timedelta(seconds=4)